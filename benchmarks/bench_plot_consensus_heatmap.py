@@ -0,0 +1,316 @@
+"""Benchmarks for plot_consensus_heatmap.
+
+This times plot_consensus_heatmap (plus rendering the figure, since
+that's when imshow does most of its work) for a grid of matrix sizes,
+Axes sizes and DPIs, with downsampling on and off. For every case it
+records the wall time and the peak resident memory, and writes all of
+it to a JSON file.
+
+Each case is run with each of the --renderers: 'imshow' is the plain
+plot_consensus_heatmap, 'rasterize' passes rasterize=True to it, and
+'png' writes a PNG of the same size with render_consensus_heatmap
+instead of drawing a figure (only with downsampling, which it always
+does).
+
+Each case runs in its own Python process, because peak RSS can only go
+up within a process: otherwise every case would report the peak of the
+biggest case before it. The consensus matrices are written to
+memory-mapped files once per size, in stripes, so building them
+doesn't distort the numbers either.
+
+The benchmarks run against whichever consensuscluster is importable,
+so install the version you want to measure first (e.g. with
+pip install -e .). Usage::
+
+    python benchmarks/bench_plot_consensus_heatmap.py -o results.json
+    python benchmarks/bench_plot_consensus_heatmap.py -o new.json \\
+        --compare results.json
+
+With --compare, the script exits with status 1 if any case got slower
+or used more memory than the given factor (--threshold) allows, so it
+can be used to catch regressions.
+
+A dense n-by-n float64 matrix takes 8 n^2 bytes of disk (20GB for
+n=50000), and plotting it without downsampling makes imshow hold
+several copies of it in memory. Cases which would need more than
+--max-bytes are recorded as skipped rather than run.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+DEFAULT_SIZES = [1000, 5000, 20000, 50000]
+DEFAULT_SCALES = [2.0, 5.0]
+DEFAULT_DPIS = [100, 200]
+DEFAULT_MAX_BYTES = 4 << 30
+RENDERERS = ['imshow', 'rasterize', 'png']
+
+_IMSHOW_COPIES = 4
+"""Rough number of n^2-sized float64 arrays imshow allocates.
+
+This is only used to decide which cases to skip with --max-bytes.
+"""
+
+
+def _peak_rss_bytes():
+    """Return the peak resident set size of this process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else.
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def _write_block_matrix(filename, n, n_blocks=5, seed=0):
+    """Write a noisy block consensus matrix to a memory-mapped file."""
+    rng = np.random.RandomState(seed)
+    labels = np.sort(rng.randint(n_blocks, size=n))
+    mat = np.memmap(filename, dtype=np.float64, mode='w+', shape=(n, n))
+    stripe_rows = max((1 << 22) // n, 1)
+    for start in range(0, n, stripe_rows):
+        stop = min(start + stripe_rows, n)
+        stripe = (labels[start:stop, np.newaxis] ==
+                  labels[np.newaxis, :]).astype(np.float64)
+        # The noise doesn't need to be symmetric; plot_consensus_heatmap
+        # only checks that when IS_TEST is set.
+        stripe -= rng.uniform(0, .2, size=stripe.shape)
+        mat[start:stop] = np.abs(stripe)
+    mat.flush()
+    del mat
+
+
+def _run_case(case):
+    """Run one case in this process and return its measurements."""
+    # Import these here so that their cost isn't part of the parent's
+    # memory, and so that the backend is set before pyplot is touched.
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    from consensuscluster.plotutils import plot_consensus_heatmap
+    from consensuscluster.plotutils import render_consensus_heatmap
+
+    n = case['n']
+    mat = np.memmap(case['filename'], dtype=np.float64, mode='r',
+                    shape=(n, n))
+    renderer = case.get('renderer', 'imshow')
+    if renderer == 'png':
+        rss_before = _peak_rss_bytes()
+        start = time.perf_counter()
+        image = render_consensus_heatmap(
+            mat, int(case['scale'] * case['dpi']), 'Blues',
+            filename=io.BytesIO(), n_jobs=case.get('n_jobs'))
+        total_time = time.perf_counter() - start
+        peak = _peak_rss_bytes()
+        return {
+            'total_seconds': total_time,
+            'image_shape': list(image.shape),
+            'peak_rss_bytes': peak,
+            'peak_rss_increase_bytes': peak - rss_before,
+        }
+    # _get_ax_size scales the width and height by different fudge
+    # factors, and plot_consensus_heatmap needs it to report a square
+    # Axes, so the figure's aspect ratio has to undo them.
+    scale = case['scale']
+    fig = Figure(figsize=(1.365 * scale, 1.411 * scale), dpi=case['dpi'])
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    rss_before = _peak_rss_bytes()
+
+    start = time.perf_counter()
+    img = plot_consensus_heatmap(mat, ax, fig, 'Blues', case['downsample'],
+                                 0, rasterize=renderer == 'rasterize',
+                                 n_jobs=case.get('n_jobs'))
+    plot_time = time.perf_counter() - start
+    start = time.perf_counter()
+    canvas.draw()
+    draw_time = time.perf_counter() - start
+
+    peak = _peak_rss_bytes()
+    return {
+        'plot_seconds': plot_time,
+        'draw_seconds': draw_time,
+        'total_seconds': plot_time + draw_time,
+        'image_shape': list(img.get_array().shape),
+        'peak_rss_bytes': peak,
+        'peak_rss_increase_bytes': peak - rss_before,
+    }
+
+
+def _case_key(case):
+    # Results from before --renderers and --n-jobs were added were all
+    # 'imshow' with a single thread.
+    return (case['n'], case['downsample'], case['scale'], case['dpi'],
+            case.get('renderer', 'imshow'), case.get('n_jobs'))
+
+
+def _estimated_bytes(n, downsample):
+    if downsample:
+        # The downsampled matrix is tiny, and the input is streamed.
+        return 8 * n * n
+    return 8 * n * n * (_IMSHOW_COPIES + 1)
+
+
+def _metadata():
+    import matplotlib
+    import scipy
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'matplotlib': matplotlib.__version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def _cases(n, scales, dpis, renderers, n_jobs, filename):
+    for downsample in (True, False):
+        for renderer in renderers:
+            if renderer == 'png' and not downsample:
+                continue
+            for scale in scales:
+                for dpi in dpis:
+                    yield {'n': n, 'downsample': downsample, 'scale': scale,
+                           'dpi': dpi, 'renderer': renderer,
+                           'n_jobs': n_jobs, 'filename': filename}
+
+
+def run(sizes, scales, dpis, renderers, n_jobs, max_bytes, repeat,
+        workdir):
+    """Run every case and return the list of results."""
+    results = []
+    for n in sizes:
+        filename = os.path.join(workdir, 'cmat-{}.dat'.format(n))
+        made_file = False
+        for case in _cases(n, scales, dpis, renderers, n_jobs, filename):
+            downsample = case['downsample']
+            result = dict(case)
+            del result['filename']
+            if _estimated_bytes(n, downsample) > max_bytes:
+                result['skipped'] = 'needs more than --max-bytes'
+                results.append(result)
+                print('skip  {}'.format(_case_key(case)))
+                continue
+            if not made_file:
+                _write_block_matrix(filename, n)
+                made_file = True
+            runs = []
+            for _ in range(repeat):
+                output = subprocess.check_output(
+                    [sys.executable, __file__, '--case',
+                     json.dumps(case)])
+                runs.append(json.loads(output.decode()))
+            # Report the fastest run (the least disturbed by
+            # whatever else the machine was doing) and the
+            # biggest peak memory.
+            best = min(runs, key=lambda r: r['total_seconds'])
+            result.update(best)
+            result['peak_rss_bytes'] = max(
+                r['peak_rss_bytes'] for r in runs)
+            results.append(result)
+            print('{:.3f}s {:>8.1f}MB  {}'.format(
+                result['total_seconds'],
+                result['peak_rss_bytes'] / 2.0 ** 20,
+                _case_key(case)))
+        if made_file:
+            os.remove(filename)
+    return results
+
+
+def compare(old_results, new_results, threshold):
+    """Find the cases which got worse by more than the threshold factor.
+
+    Returns
+    -------
+    list of str
+        One description per regression.
+    """
+    old_by_key = {_case_key(r): r for r in old_results
+                  if 'skipped' not in r}
+    regressions = []
+    for new in new_results:
+        old = old_by_key.get(_case_key(new))
+        if old is None or 'skipped' in new:
+            continue
+        for field in ('total_seconds', 'peak_rss_bytes'):
+            if new[field] > threshold * old[field]:
+                regressions.append('{}: {} went from {:.4g} to {:.4g}'.format(
+                    _case_key(new), field, old[field], new[field]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark plot_consensus_heatmap.')
+    parser.add_argument('-o', '--output', default='bench_plot.json',
+                        help='Where to write the JSON results.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=DEFAULT_SIZES)
+    parser.add_argument('--scales', type=float, nargs='+',
+                        default=DEFAULT_SCALES,
+                        help='Side lengths of the Axes, in inches.')
+    parser.add_argument('--dpis', type=int, nargs='+', default=DEFAULT_DPIS)
+    parser.add_argument('--renderers', nargs='+', default=RENDERERS,
+                        choices=RENDERERS)
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help='Number of threads used for downsampling.')
+    parser.add_argument('--max-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help='Skip cases estimated to need more memory or '
+                             'disk than this.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of times to run each case.')
+    parser.add_argument('--workdir', default=None,
+                        help='Where to put the matrix files. Defaults to '
+                             'a temporary directory.')
+    parser.add_argument('--compare', default=None,
+                        help='A previous JSON output to compare against.')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='With --compare, the factor by which time or '
+                             'memory may grow before it is a regression.')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case is not None:
+        # We're a child process running a single case.
+        print(json.dumps(_run_case(json.loads(args.case))))
+        return 0
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='bench-consensus-')
+    try:
+        results = run(args.sizes, args.scales, args.dpis, args.renderers,
+                      args.n_jobs, args.max_bytes, args.repeat, workdir)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': _metadata(), 'results': results}, f,
+                  indent=2)
+    print('Wrote {}'.format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(old['results'], results, args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,23 @@
-from ._template import TemplateEstimator
-from ._template import TemplateClassifier
-from ._template import TemplateTransformer
+# Only the numpy-based compute core is imported eagerly. Everything
+# which needs scikit-learn (the estimators) is loaded the first time
+# it's used, so that e.g. worker processes which only accumulate count
+# matrices don't pay for importing it. The plotting code lives in the
+# plotutils module, which isn't imported here at all.
+from .misc import import_from
+from .misc import lazy_attributes
+from ._accumulate import ConsensusRatio
+from .packed import PackedSymmetricMatrix
 
 from ._version import __version__
 
+lazy_attributes(__name__, {
+    'TemplateEstimator': import_from('._template', 'TemplateEstimator'),
+    'TemplateClassifier': import_from('._template', 'TemplateClassifier'),
+    'TemplateTransformer': import_from('._template', 'TemplateTransformer'),
+    'ConsensusCluster': import_from('._consensus', 'ConsensusCluster'),
+    'ArraySource': import_from('.sources', 'ArraySource'),
+})
+
 __all__ = ['TemplateEstimator', 'TemplateClassifier', 'TemplateTransformer',
-           '__version__']
+           'ConsensusCluster', 'ConsensusRatio', 'PackedSymmetricMatrix',
+           'ArraySource', '__version__']
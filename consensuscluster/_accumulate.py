@@ -0,0 +1,404 @@
+"""Functions for accumulating the count matrices of consensus clustering.
+
+Consensus clustering (Monti et al., 2003) keeps track of two n-by-n
+count matrices:
+
+* The connectivity counts: entry (i, j) is the number of resamples in
+  which samples i and j were both drawn AND put in the same cluster.
+* The indicator counts: entry (i, j) is the number of resamples in
+  which samples i and j were both drawn.
+
+The consensus matrix is the elementwise ratio of the two.
+
+The obvious way to update these is a double loop over every pair of
+samples in every resample, but that's hopelessly slow in Python. The
+trick used here is that both updates can be written as matrix
+products. If A is the (n_samples, n_clusters) one-hot membership
+matrix for a resample (with all-zero rows for the samples that weren't
+drawn), then A A^T is exactly that resample's contribution to the
+connectivity counts. Better yet, we can stack the one-hot matrices of
+several resamples side by side, and a single product will then add up
+the contributions of the whole batch. The same goes for the indicator
+counts, using one column per resample.
+
+The count matrices can either be dense ndarrays or
+PackedSymmetricMatrix objects. In the packed case, the products are
+computed one square tile at a time, and only for the tiles on or above
+the diagonal. That halves the arithmetic, and it means each update only
+touches a small, mostly-contiguous piece of the packed data, which
+matters when that data is memory-mapped from disk.
+"""
+import numpy as np
+
+from .packed import PackedSymmetricMatrix
+from .packed import _CHUNK_ELEMENTS
+
+_ROW_BLOCK = 2048
+"""Number of rows of the count matrices updated by a single product.
+
+The product A A^T is computed one block of rows at a time so that we
+never allocate a float temporary the size of the full count matrix.
+For packed count matrices, this is also the number of columns in each
+tile.
+"""
+
+
+def _membership_matrix(n_samples, subsamples, labelings):
+    """Build the stacked one-hot matrix for a batch of resamples.
+
+    Parameters
+    ----------
+    n_samples : int
+        Total number of samples in the dataset.
+
+    subsamples : list of ndarray
+        For each resample, the indices (into the full dataset) of the
+        samples which were drawn.
+
+    labelings : list of ndarray
+        For each resample, the cluster labels assigned to the drawn
+        samples. labelings[h] must be the same length as subsamples[h].
+        The labels can be arbitrary integers; they don't need to be
+        contiguous.
+
+    Returns
+    -------
+    membership : ndarray, shape (n_samples, total_clusters)
+        Stacked one-hot cluster membership matrices, one block of
+        columns per resample.
+    """
+    assert len(subsamples) == len(labelings)
+    inverses = []
+    total_clusters = 0
+    for labels in labelings:
+        # Map the labels onto 0, 1, ..., (number of distinct labels - 1)
+        # so that each one gets its own column.
+        _, inverse = np.unique(labels, return_inverse=True)
+        inverse = inverse.ravel()
+        inverses.append(inverse)
+        if len(inverse) > 0:
+            total_clusters += inverse.max() + 1
+
+    # float32 is plenty here: every entry of the products we compute is
+    # a count no bigger than the batch size, and float32 represents
+    # integers exactly up to 2**24.
+    membership = np.zeros((n_samples, total_clusters), dtype=np.float32)
+    offset = 0
+    for (indices, inverse) in zip(subsamples, inverses):
+        assert len(indices) == len(inverse)
+        membership[indices, offset + inverse] = 1.0
+        if len(inverse) > 0:
+            offset += inverse.max() + 1
+    return membership
+
+
+def _add_gram(counts, factor):
+    """Add factor * factor^T onto counts in place, one row block at a time.
+    """
+    n_samples = counts.shape[0]
+    if isinstance(counts, PackedSymmetricMatrix):
+        for row_start in range(0, n_samples, _ROW_BLOCK):
+            row_stop = min(row_start + _ROW_BLOCK, n_samples)
+            # Tiles to the left of the diagonal are in the lower
+            # triangle, so we don't need them.
+            for col_start in range(row_start, n_samples, _ROW_BLOCK):
+                col_stop = min(col_start + _ROW_BLOCK, n_samples)
+                tile = np.dot(factor[row_start:row_stop],
+                              factor[col_start:col_stop].T)
+                counts.add_upper_tile(row_start, col_start, tile)
+        return
+    for start in range(0, n_samples, _ROW_BLOCK):
+        stop = min(start + _ROW_BLOCK, n_samples)
+        block = np.dot(factor[start:stop], factor.T)
+        # The products are exact small integers, so casting them back
+        # to the (integer) dtype of counts is safe.
+        np.add(counts[start:stop], block, out=counts[start:stop],
+               casting='unsafe')
+
+
+def accumulate_connectivity(connectivity, subsamples, labelings):
+    """Add the connectivity counts of a batch of resamples in place.
+
+    Parameters
+    ----------
+    connectivity : ndarray or PackedSymmetricMatrix
+        The connectivity counts accumulated so far.
+
+    subsamples : list of ndarray
+        For each resample in the batch, the indices of the samples
+        which were drawn.
+
+    labelings : list of ndarray
+        For each resample in the batch, the cluster labels of the drawn
+        samples.
+
+    Returns
+    -------
+    None
+    """
+    if len(subsamples) == 0:
+        return
+    membership = _membership_matrix(connectivity.shape[0], subsamples,
+                                    labelings)
+    _add_gram(connectivity, membership)
+
+
+def accumulate_indicator(indicator, subsamples):
+    """Add the indicator counts of a batch of resamples in place.
+
+    The indicator counts don't depend on the clustering, so when
+    several values of K are run on the same resamples, this only needs
+    to be done once.
+
+    Parameters
+    ----------
+    indicator : ndarray or PackedSymmetricMatrix
+        The indicator counts accumulated so far.
+
+    subsamples : list of ndarray
+        For each resample in the batch, the indices of the samples
+        which were drawn.
+
+    Returns
+    -------
+    None
+    """
+    if len(subsamples) == 0:
+        return
+    drawn = np.zeros((indicator.shape[0], len(subsamples)), dtype=np.float32)
+    for h, indices in enumerate(subsamples):
+        drawn[indices, h] = 1.0
+    _add_gram(indicator, drawn)
+
+
+def accumulate_batch(connectivity, indicator, subsamples, labelings):
+    """Add the contributions of a batch of resamples to the count matrices.
+
+    Both count matrices are updated in place.
+
+    Parameters
+    ----------
+    connectivity : ndarray or PackedSymmetricMatrix
+        The connectivity counts accumulated so far.
+
+    indicator : ndarray or PackedSymmetricMatrix
+        The indicator counts accumulated so far. Must be stored the
+        same way as connectivity.
+
+    subsamples : list of ndarray
+        For each resample in the batch, the indices of the samples
+        which were drawn.
+
+    labelings : list of ndarray
+        For each resample in the batch, the cluster labels of the drawn
+        samples.
+
+    Returns
+    -------
+    None
+    """
+    assert connectivity.shape == indicator.shape
+    accumulate_connectivity(connectivity, subsamples, labelings)
+    accumulate_indicator(indicator, subsamples)
+
+
+def _ratio(connectivity, indicator):
+    """Divide two (dense) arrays of counts, with 0 wherever indicator is 0.
+    """
+    consensus = np.zeros(np.shape(connectivity), dtype=np.float64)
+    np.divide(connectivity, indicator, out=consensus, where=indicator > 0,
+              casting='unsafe')
+    return consensus
+
+
+def consensus_ratio(connectivity, indicator, out=None):
+    """Compute the consensus matrix from the two count matrices.
+
+    Pairs of samples which were never drawn together get a consensus
+    of 0.
+
+    Parameters
+    ----------
+    connectivity : ndarray or PackedSymmetricMatrix
+        Connectivity counts.
+
+    indicator : ndarray or PackedSymmetricMatrix
+        Indicator counts. Must have the same shape (and storage) as
+        connectivity.
+
+    out : PackedSymmetricMatrix, default=None
+        Only used for packed inputs: if given, the result is written
+        into out (for instance, a memory-mapped matrix) instead of a
+        newly allocated one. Must have a floating-point dtype.
+
+    Returns
+    -------
+    ndarray or PackedSymmetricMatrix of float64
+        The consensus values, all in [0,1]. This is stored the same way
+        as the inputs.
+    """
+    assert connectivity.shape == indicator.shape
+    if isinstance(connectivity, PackedSymmetricMatrix):
+        assert isinstance(indicator, PackedSymmetricMatrix)
+        if out is None:
+            out = PackedSymmetricMatrix(connectivity.n, dtype=np.float64)
+        assert out.shape == connectivity.shape
+        # Go one chunk at a time so that the temporaries stay small (and
+        # memory-mapped inputs are streamed rather than loaded).
+        for start in range(0, len(out.data), _CHUNK_ELEMENTS):
+            stop = start + _CHUNK_ELEMENTS
+            out.data[start:stop] = _ratio(connectivity.data[start:stop],
+                                          indicator.data[start:stop])
+        out.flush()
+        return out
+    return _ratio(connectivity, indicator)
+
+
+class ConsensusRatio(object):
+    """A consensus matrix which is computed from the counts on demand.
+
+    Holding a float64 consensus matrix for every K costs 8 bytes per
+    entry on top of the counts it was computed from, even though each
+    consensus value is just the ratio of two counts. This class holds
+    on to the counts instead, and only computes the ratio for the rows,
+    tiles or chunks which are actually read. It has the same accessors
+    as PackedSymmetricMatrix (row, rows, tile, take, to_dense and
+    condensed), so it can be passed to anything in this package which
+    reads a consensus matrix: the metrics, the ordering, the heatmap
+    (where it's read one stripe at a time) and the final clustering.
+
+    Parameters
+    ----------
+    connectivity : ndarray or PackedSymmetricMatrix
+        The connectivity counts.
+
+    indicator : ndarray or PackedSymmetricMatrix
+        The indicator counts. Must be stored the same way as
+        connectivity.
+
+    Attributes
+    ----------
+    connectivity, indicator : ndarray or PackedSymmetricMatrix
+        The counts, as given.
+
+    shape : tuple
+        Always (n, n).
+    """
+    def __init__(self, connectivity, indicator):
+        if connectivity.shape != indicator.shape:
+            raise ValueError('The count matrices have different shapes: {} '
+                             'and {}'.format(connectivity.shape,
+                                             indicator.shape))
+        if isinstance(connectivity, PackedSymmetricMatrix) != \
+                isinstance(indicator, PackedSymmetricMatrix):
+            raise ValueError('The count matrices must be stored the same way')
+        self.connectivity = connectivity
+        self.indicator = indicator
+        self.shape = connectivity.shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float64)
+
+    @property
+    def n(self):
+        return self.shape[0]
+
+    def row(self, i):
+        """Return row i of the matrix, as a 1-dimensional ndarray."""
+        return self.tile(i, i + 1, 0, self.n)[0]
+
+    def rows(self, start, stop):
+        """Return rows [start, stop) of the matrix as a dense ndarray."""
+        return self.tile(start, stop, 0, self.n)
+
+    def tile(self, row_start, row_stop, col_start, col_stop):
+        """Return the dense submatrix [row_start:row_stop, col_start:col_stop].
+        """
+        if isinstance(self.connectivity, PackedSymmetricMatrix):
+            return _ratio(
+                self.connectivity.tile(row_start, row_stop, col_start,
+                                       col_stop),
+                self.indicator.tile(row_start, row_stop, col_start, col_stop))
+        return _ratio(self.connectivity[row_start:row_stop, col_start:col_stop],
+                      self.indicator[row_start:row_stop, col_start:col_stop])
+
+    def take(self, rows, cols):
+        """Return the dense submatrix at the given rows and columns.
+
+        See PackedSymmetricMatrix.take.
+        """
+        if isinstance(self.connectivity, PackedSymmetricMatrix):
+            return _ratio(self.connectivity.take(rows, cols),
+                          self.indicator.take(rows, cols))
+        index = np.ix_(np.asarray(rows), np.asarray(cols))
+        return _ratio(self.connectivity[index], self.indicator[index])
+
+    def to_dense(self):
+        """Return the full matrix as a dense n-by-n ndarray."""
+        return self.tile(0, self.n, 0, self.n)
+
+    def condensed(self):
+        """Return the strict upper triangle as a 1-dimensional ndarray.
+
+        See PackedSymmetricMatrix.condensed.
+        """
+        chunks = [chunk for (chunk,) in _iter_upper_chunks(self)]
+        if not chunks:
+            return np.zeros(0, dtype=np.float64)
+        return np.concatenate(chunks)
+
+    def __repr__(self):
+        return 'ConsensusRatio(n={}, counts={})'.format(
+            self.n, type(self.connectivity).__name__)
+
+
+def _iter_upper_chunks(*mats):
+    """Iterate over the strict upper triangles of some matrices in chunks.
+
+    All of mats must have the same shape and be stored the same way
+    (all dense ndarrays or all PackedSymmetricMatrix objects, where a
+    ConsensusRatio counts as the way its counts are stored). Each
+    iteration yields a tuple with one 1-dimensional chunk per matrix,
+    and the chunks line up: element e of every chunk comes from the
+    same entry (i, j), i < j. Chunks hold roughly _CHUNK_ELEMENTS
+    values, so nothing of size n^2 is ever allocated.
+    """
+    if any(isinstance(mat, ConsensusRatio) for mat in mats):
+        # Read the underlying counts instead, and divide them chunk by
+        # chunk.
+        counts = []
+        for mat in mats:
+            if isinstance(mat, ConsensusRatio):
+                counts.extend([mat.connectivity, mat.indicator])
+            else:
+                counts.append(mat)
+        for chunks in _iter_upper_chunks(*counts):
+            chunks = list(chunks)
+            out = []
+            for mat in mats:
+                if isinstance(mat, ConsensusRatio):
+                    out.append(_ratio(chunks.pop(0), chunks.pop(0)))
+                else:
+                    out.append(chunks.pop(0))
+            yield tuple(out)
+        return
+    n = mats[0].shape[0]
+    if isinstance(mats[0], PackedSymmetricMatrix):
+        offsets = mats[0]._offsets
+        total = len(mats[0].data)
+        for start in range(0, total, _CHUNK_ELEMENTS):
+            stop = min(start + _CHUNK_ELEMENTS, total)
+            # Drop the diagonal entries which fall in this chunk.
+            lo, hi = np.searchsorted(offsets, [start, stop])
+            diagonal = offsets[lo:hi] - start
+            yield tuple(np.delete(mat.data[start:stop], diagonal)
+                        for mat in mats)
+        return
+    stripe_rows = max(_CHUNK_ELEMENTS // max(n, 1), 1)
+    for start in range(0, n, stripe_rows):
+        stop = min(start + stripe_rows, n)
+        (rows, cols) = np.triu_indices(stop - start, 1, n - start)
+        yield tuple(np.asarray(mat[start:stop, start:])[rows, cols]
+                    for mat in mats)
+
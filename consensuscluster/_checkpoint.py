@@ -0,0 +1,133 @@
+"""Checkpoints of a ConsensusCluster fit in progress.
+
+A checkpoint is a directory holding one .npy file per count matrix and
+a small JSON file, checkpoint.json, which says which files make up the
+latest checkpoint and holds everything else needed to carry on (the
+fit's entropy, the number of resamples run so far, and the CDFs from
+the last convergence check).
+
+The array files of each checkpoint have the number of resamples in
+their names, so writing a new checkpoint never touches the files of
+the previous one. checkpoint.json is only replaced (atomically, with
+os.replace) once all of the new files are safely on disk, and the old
+files are deleted after that. So if the process is killed while
+writing, the directory still holds a complete previous checkpoint.
+
+Count matrices are saved in whatever layout they're stored in (the
+full n-by-n array, or the packed upper triangle) and read back from a
+memory-mapped .npy, one chunk at a time, so neither saving nor loading
+needs another copy of the counts in memory.
+"""
+import json
+import os
+
+import numpy as np
+
+from .packed import PackedSymmetricMatrix
+from .packed import _CHUNK_ELEMENTS
+
+VERSION = 1
+"""Version of the checkpoint format. Bumped on incompatible changes."""
+
+_META_FILENAME = 'checkpoint.json'
+
+
+def _layout(counts):
+    return 'packed' if isinstance(counts, PackedSymmetricMatrix) else 'dense'
+
+
+def _raw(counts):
+    """Return the array actually holding a count matrix's values."""
+    if isinstance(counts, PackedSymmetricMatrix):
+        return counts.data
+    return counts
+
+
+def _write_synced(path, write):
+    """Call write(f) on a new file at path, then sync it to disk."""
+    with open(path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_checkpoint(directory, connectivities, indicator, meta):
+    """Write a checkpoint, replacing the previous one in directory.
+
+    Parameters
+    ----------
+    directory : str
+        The checkpoint directory. It's created if needed.
+
+    connectivities : dict
+        Maps each K to its connectivity counts.
+
+    indicator : ndarray or PackedSymmetricMatrix
+        The indicator counts.
+
+    meta : dict
+        JSON-serializable state to save along with the counts. It must
+        include 'n_resamples', which is used to name the files.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    arrays = [('indicator', indicator)]
+    arrays.extend(('connectivity-k{}'.format(k), connectivities[k])
+                  for k in sorted(connectivities))
+    files = {}
+    for (name, counts) in arrays:
+        filename = '{}-{}.npy'.format(name, meta['n_resamples'])
+        _write_synced(os.path.join(directory, filename),
+                      lambda f: np.save(f, _raw(counts)))
+        files[name] = filename
+    meta = dict(meta, version=VERSION, layout=_layout(indicator),
+                dtype=np.dtype(indicator.dtype).name, files=files)
+    tmp_path = os.path.join(directory, _META_FILENAME + '.tmp')
+    _write_synced(tmp_path, lambda f: f.write(
+        json.dumps(meta, sort_keys=True).encode('utf-8')))
+    os.replace(tmp_path, os.path.join(directory, _META_FILENAME))
+    keep = set(files.values())
+    for filename in os.listdir(directory):
+        if filename.endswith('.npy') and filename not in keep:
+            os.remove(os.path.join(directory, filename))
+
+
+def load_checkpoint(directory):
+    """Read the metadata of the checkpoint in directory.
+
+    Returns
+    -------
+    dict or None
+        The meta passed to save_checkpoint, plus 'version', 'layout',
+        'dtype' and 'files'. None if directory holds no checkpoint.
+    """
+    path = os.path.join(directory, _META_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        meta = json.loads(f.read().decode('utf-8'))
+    if meta.get('version') != VERSION:
+        raise ValueError('The checkpoint in {} has format version {}, but '
+                         'only version {} can be read'.format(
+                             directory, meta.get('version'), VERSION))
+    return meta
+
+
+def read_counts(directory, meta, name, counts):
+    """Copy one saved count matrix into counts, a chunk at a time.
+
+    counts must have the same layout and shape as the saved matrix. Its
+    dtype can be wider.
+    """
+    saved = np.load(os.path.join(directory, meta['files'][name]),
+                    mmap_mode='r')
+    target = _raw(counts)
+    if saved.shape != target.shape:
+        raise ValueError('The checkpointed {} counts have shape {}, '
+                         'expected {}'.format(name, saved.shape,
+                                              target.shape))
+    saved = saved.reshape(-1)
+    flat = target.reshape(-1)
+    for start in range(0, len(flat), _CHUNK_ELEMENTS):
+        stop = start + _CHUNK_ELEMENTS
+        flat[start:stop] = saved[start:stop]
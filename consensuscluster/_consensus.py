@@ -0,0 +1,1525 @@
+"""The ConsensusCluster estimator.
+"""
+import os
+import shutil
+import tempfile
+import weakref
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+import numpy as np
+from scipy.cluster.hierarchy import fcluster
+from scipy.cluster.hierarchy import linkage as hierarchical_linkage
+from scipy.spatial.distance import squareform
+from sklearn.base import BaseEstimator, ClusterMixin, clone
+from sklearn.cluster import KMeans
+from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import NearestNeighbors
+from sklearn.utils import check_random_state
+from sklearn.utils import gen_batches
+from sklearn.utils.validation import check_array
+from sklearn.utils.validation import check_is_fitted
+
+from ._accumulate import accumulate_connectivity
+from ._accumulate import accumulate_indicator
+from ._accumulate import ConsensusRatio
+from ._accumulate import consensus_ratio
+from ._checkpoint import load_checkpoint
+from ._checkpoint import read_counts
+from ._checkpoint import save_checkpoint
+from .metrics import cdf_from_counts
+from .metrics import evaluate_cdf
+from .misc import printif
+from .packed import PackedSymmetricMatrix
+from .packed import _CHUNK_ELEMENTS
+from .sources import ArraySource
+from .sources import _shared
+from .sources import spill_chunks
+from .sparse import threshold_consensus
+from .misc import (DEBUGLVL, USERLVL)
+from .misc import effective_n_jobs
+from .misc import is_sparse
+from . import tracing
+
+_CDF_GRID = np.linspace(0.0, 1.0, 101)
+"""Points at which the consensus CDFs are compared when tol is set."""
+
+_PREDICT_BATCH_SIZE = 1024
+"""Number of samples assigned to clusters at once by predict."""
+
+_RESAMPLE_BATCH_SIZE = 32
+"""Number of resamples whose results are folded into the counts at once.
+
+Larger batches mean fewer (but bigger) matrix products. See
+_accumulate.py for the details.
+"""
+
+
+class ConsensusCluster(ClusterMixin, BaseEstimator):
+    """Consensus clustering, as introduced by Monti et al. (2003).
+
+    The dataset is resampled many times, and a base clustering
+    algorithm is run on each resample. For each pair of samples, we
+    count the number of resamples in which both samples were drawn
+    (the indicator counts) and the number of resamples in which they
+    were also put in the same cluster (the connectivity counts). The
+    ratio of the two is the consensus matrix. Finally, the samples are
+    clustered with hierarchical clustering, using 1 - consensus as the
+    distance between samples.
+
+    Parameters
+    ----------
+    clusterer : sklearn clusterer, default=None
+        The base clustering algorithm which is run on each resample.
+        It will be cloned for every resample. If it has an
+        'n_clusters' parameter, that will be set to n_clusters; if it
+        has a 'random_state' parameter, that will be set to a value
+        derived from random_state. If None, KMeans is used.
+
+        X can be a scipy.sparse matrix (e.g. for text or single-cell
+        data), in which case each resample is a sparse gather of rows
+        of X. If the clusterer accepts sparse input (according to its
+        scikit-learn tags; KMeans does), it gets the sparse resample.
+        Otherwise, or if its tags don't say (before scikit-learn 1.6),
+        only the resample is densified, so the memory needed is
+        subsample_size * n_features floats rather than the whole of X.
+        With precompute, the clusterer only ever sees the precomputed
+        matrix.
+
+        X can also be too big to load into memory: see the fit method.
+
+    n_clusters : int, default=2
+        The number of clusters to find. If k_range is given, this must
+        be one of its values, and it picks which K the connectivity_,
+        consensus_matrix_ and labels_ attributes refer to.
+
+    k_range : iterable of int or None, default=None
+        If given, consensus clustering is run for every K in k_range
+        at once. Each resample is drawn only once, the base clusterer
+        is run on it for every K, and the indicator counts (which don't
+        depend on K) are only computed once. The results for all K are
+        in the connectivities_, consensus_matrices_ and labels_by_k_
+        attributes.
+
+    n_resamples : int, default=100
+        The number of resamples (H in the Monti paper). If tol is set,
+        this is the maximum number of resamples. For partial_fit, it's
+        the number of resamples added by each call.
+
+    resample_frac : float, default=0.8
+        The fraction of the samples drawn (without replacement) in each
+        resample. Must be in (0,1].
+
+    linkage : str, default='average'
+        The linkage method used for the final hierarchical clustering
+        of the consensus matrix. Can be any method accepted by
+        scipy.cluster.hierarchy.linkage.
+
+    random_state : int, RandomState instance or None, default=None
+        Controls the resampling as well as the random_state of the
+        base clusterer. Each resample gets its own random stream
+        derived from this, so for a fixed random_state the result
+        doesn't depend on n_jobs.
+
+    precompute : str, callable or None, default=None
+        If set, the pairwise distances (or affinities) between all the
+        samples are computed once, at the start of the fit, and each
+        resample is clustered on the corresponding block of that
+        matrix instead of on its rows of X. The same block is used for
+        every K. A str is the name of a metric accepted by
+        sklearn.metrics.pairwise_distances, e.g. 'euclidean'. A
+        callable is called as precompute(X_rows, X) for chunks of rows
+        of X and must return the corresponding rows of the matrix;
+        e.g. sklearn.metrics.pairwise.rbf_kernel gives affinities for
+        SpectralClustering. (If X is an ArraySource, it's called with
+        chunks of rows of X for both arguments instead, and must
+        return the corresponding block.) The base clusterer must accept a
+        precomputed matrix; its 'metric' (or, if it has none, its
+        'affinity') parameter is set to 'precomputed'. The matrix is
+        kept in the distances_ attribute, in float32, so it takes
+        4 n_samples^2 bytes (in a file in memmap_dir if storage is
+        'memmap').
+
+    n_jobs : int or None, default=None
+        The number of workers used to run the resamples in parallel.
+        None means 1; -1 means use all CPUs. Each worker accumulates
+        its own partial count matrices, which are added together at
+        the end, so every worker needs memory for two extra count
+        matrices.
+
+    executor : {'process', 'thread'} or Executor, default='process'
+        What runs the resamples when there's more than one worker.
+        'process' and 'thread' start a local ProcessPoolExecutor or
+        ThreadPoolExecutor with n_jobs workers, once per call to fit or
+        partial_fit; a process pool gets X when each worker starts,
+        rather than with every batch (on Python >= 3.7). Threads avoid
+        copying X and the partial counts between processes, and work
+        well when the base clusterer releases the GIL. When tol or
+        checkpoint split the resamples into rounds of fewer than
+        n_jobs resamples, later rounds are started before the earlier
+        ones are checked, so that every worker is busy; they're still
+        folded in and checked in order, so the result is the same.
+
+        Anything with the submit method of a
+        concurrent.futures.Executor can be given instead, e.g. one
+        which runs tasks on other machines. It's used as is (and never
+        shut down), and each round of resamples is split into n_jobs
+        batches (or one, if n_jobs is None). The tasks are
+        module-level functions, so it has to be able to pickle them
+        and their arguments; with storage='memmap', the workers must
+        also see memmap_dir, since partial counts are passed around as
+        file names.
+
+        Each batch returns its partial count matrices, and these are
+        merged pairwise in a fixed binary tree, each merge starting as
+        soon as both of its inputs are ready. The counts are integers,
+        so the result is identical to a single-worker fit. Merges run
+        on the executor when it's a ThreadPoolExecutor or storage is
+        'memmap' (so that nothing big needs copying), and in this
+        process otherwise.
+
+    storage : {'dense', 'packed', 'memmap'}, default='dense'
+        How the count and consensus matrices are stored. 'dense' uses
+        full n-by-n ndarrays. 'packed' uses PackedSymmetricMatrix,
+        which only stores the upper triangle and needs about half the
+        memory. 'memmap' also uses PackedSymmetricMatrix, but keeps the
+        packed data in np.memmap files in memmap_dir, so the matrices
+        don't need to fit in memory. Note that the final hierarchical
+        clustering step still needs the condensed distances in memory.
+
+    memmap_dir : str or None, default=None
+        Directory in which the files are created when storage is
+        'memmap'. Each fit creates its own new subdirectory of it (see
+        the memmap_dir_ attribute), so several estimators, or a refit,
+        can share memmap_dir without overwriting each other's files.
+        If None, the subdirectory is created in the system's temporary
+        directory. With n_jobs workers, the subdirectory temporarily
+        holds n_jobs partial copies of each count matrix.
+
+    lazy_consensus : bool, default=False
+        If True, the consensus matrices are not stored. Instead,
+        consensus_matrix_ and consensus_matrices_ hold ConsensusRatio
+        objects, which compute the consensus values from the counts
+        whenever they're read (one tile or stripe at a time). Together
+        with the compact count dtypes (see the connectivity_
+        attribute), this cuts the memory needed for every K by 2x-4x
+        compared with keeping float64 consensus matrices around.
+
+    sparse_threshold : float or None, default=None
+        If set, the consensus matrices are stored as sparse matrices
+        which only keep the values of at least sparse_threshold (see
+        consensuscluster.sparse.threshold_consensus). The labels are
+        still computed from the full consensus matrices. With many
+        clusters most consensus values are close to 0, so this can
+        take far less memory than even lazy_consensus. Must be in
+        (0,1].
+
+    warm_start : bool, default=False
+        When True, calling fit again keeps the counts accumulated so
+        far and only runs the resamples needed to reach n_resamples
+        in total. X must be the same as before.
+
+    tol : float or None, default=None
+        If set, resampling stops early once the consensus matrices
+        have settled down. Every check_interval resamples, the CDF of
+        the consensus values is computed for each K and evaluated at
+        101 evenly spaced points in [0,1]; once the largest change in
+        any CDF since the previous check is below tol, no more
+        resamples are run.
+
+    check_interval : int, default=32
+        Number of resamples between two convergence checks when tol is
+        set, and between two checkpoints when checkpoint is set.
+
+    checkpoint : str or None, default=None
+        If set, a directory in which the progress of the fit is saved
+        every check_interval resamples: the counts, the entropy_ every
+        resample's random stream is derived from, the number of
+        resamples run so far and the state of the convergence check.
+        Each checkpoint replaces the previous one, and a fit which is
+        killed while writing one leaves the previous one intact. See
+        resume.
+
+    resume : bool, default=False
+        If True, fit carries on from the checkpoint in checkpoint (if
+        there is one yet) instead of starting from scratch, and gives
+        the same result as if it had never been interrupted. X and
+        the parameters must be the same as for the interrupted fit,
+        except that n_resamples may be raised. Ignored by partial_fit,
+        and by fit when warm_start continues an existing fit.
+
+    verbose : non-negative int, default=0
+        Verbosity level of print statements. If this is 0, no output
+        will be produced.
+
+    Attributes
+    ----------
+    connectivity_ : ndarray or PackedSymmetricMatrix
+        The connectivity counts, shape (n_samples, n_samples). The
+        counts are stored in the smallest unsigned integer dtype which
+        can hold n_resamples_ (uint16 unless there are more than 65535
+        resamples).
+
+    indicator_ : ndarray or PackedSymmetricMatrix
+        The indicator counts, shape (n_samples, n_samples). Stored the
+        same way as connectivity_.
+
+    consensus_matrix_ : ndarray, PackedSymmetricMatrix, ConsensusRatio or csr_matrix
+        The consensus matrix, shape (n_samples, n_samples). Each value
+        is in [0,1]. This is a scipy.sparse.csr_matrix if
+        sparse_threshold is set, and otherwise a ConsensusRatio if
+        lazy_consensus is True.
+
+    labels_ : ndarray, shape (n_samples,)
+        The final cluster label of each sample.
+
+    connectivities_ : dict
+        Maps each K to its connectivity counts. If k_range is None,
+        the only K is n_clusters.
+
+    consensus_matrices_ : dict
+        Maps each K to its consensus matrix.
+
+    labels_by_k_ : dict
+        Maps each K to the final cluster labels for that K.
+
+    n_resamples_ : int
+        The total number of resamples run so far.
+
+    converged_ : bool
+        Whether resampling was stopped early because of tol.
+
+    entropy_ : int
+        The entropy from which every resample's seed is derived.
+
+    memmap_dir_ : str
+        The directory holding the memory-mapped matrices. Only set when
+        storage is 'memmap'. It's created by fit, and deleted (along
+        with everything in it) when the estimator is garbage collected
+        or fit from scratch again. Use consensuscluster.results to keep
+        the results around for longer.
+
+    distances_ : ndarray of float32, shape (n_samples, n_samples)
+        The precomputed distances or affinities. Only set when
+        precompute is.
+
+    neighbors_ : sklearn.neighbors.NearestNeighbors or None
+        An index of the samples seen by fit, used by predict. It uses
+        a KD or ball tree where it can. Its metric is precompute if
+        that is a str, and euclidean otherwise. The index holds a copy
+        of X, so it's None when X was an ArraySource or an iterator.
+    """
+    def __init__(self, clusterer=None, n_clusters=2, k_range=None,
+                 n_resamples=100, resample_frac=0.8, linkage='average',
+                 random_state=None, precompute=None, n_jobs=None,
+                 executor='process',
+                 storage='dense', memmap_dir=None, lazy_consensus=False,
+                 sparse_threshold=None, warm_start=False, tol=None,
+                 check_interval=32, checkpoint=None, resume=False,
+                 verbose=0):
+        self.clusterer = clusterer
+        self.n_clusters = n_clusters
+        self.k_range = k_range
+        self.n_resamples = n_resamples
+        self.resample_frac = resample_frac
+        self.linkage = linkage
+        self.random_state = random_state
+        self.precompute = precompute
+        self.n_jobs = n_jobs
+        self.executor = executor
+        self.storage = storage
+        self.memmap_dir = memmap_dir
+        self.lazy_consensus = lazy_consensus
+        self.sparse_threshold = sparse_threshold
+        self.warm_start = warm_start
+        self.tol = tol
+        self.check_interval = check_interval
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.verbose = verbose
+
+    def _check_params(self, n_samples):
+        """Validate the parameters.
+
+        Returns
+        -------
+        subsample_size : int
+            The number of samples drawn in each resample.
+
+        k_values : list of int
+            The sorted values of K to run.
+        """
+        if self.k_range is None:
+            k_values = [self.n_clusters]
+        else:
+            k_values = sorted(set(self.k_range))
+            if self.n_clusters not in k_values:
+                raise ValueError('n_clusters={} is not in k_range'.format(
+                    self.n_clusters))
+        for k in k_values:
+            if not isinstance(k, (int, np.integer)) or k < 1:
+                raise ValueError('The number of clusters must be a positive '
+                                 'int, got {}'.format(k))
+        if not isinstance(self.n_resamples, (int, np.integer)) or \
+                self.n_resamples < 1:
+            raise ValueError('n_resamples must be a positive int, got '
+                             '{}'.format(self.n_resamples))
+        if self.storage not in ('dense', 'packed', 'memmap'):
+            raise ValueError("storage must be 'dense', 'packed' or 'memmap', "
+                             "got {}".format(self.storage))
+        if self.executor not in ('process', 'thread') and \
+                not hasattr(self.executor, 'submit'):
+            raise ValueError("executor must be 'process', 'thread' or an "
+                             "Executor, got {!r}".format(self.executor))
+        if self.tol is not None and self.tol < 0:
+            raise ValueError('tol must be non-negative, got '
+                             '{}'.format(self.tol))
+        if not isinstance(self.check_interval, (int, np.integer)) or \
+                self.check_interval < 1:
+            raise ValueError('check_interval must be a positive int, got '
+                             '{}'.format(self.check_interval))
+        if self.resume and self.checkpoint is None:
+            raise ValueError('resume=True needs a checkpoint directory')
+        if self.sparse_threshold is not None and \
+                not 0.0 < self.sparse_threshold <= 1.0:
+            raise ValueError('sparse_threshold must be in (0,1], got '
+                             '{}'.format(self.sparse_threshold))
+        if self.precompute is not None:
+            if not isinstance(self.precompute, str) and \
+                    not callable(self.precompute):
+                raise ValueError('precompute must be None, a str or a '
+                                 'callable, got {!r}'.format(self.precompute))
+            if _precomputed_param(self.clusterer) is None:
+                raise ValueError('precompute needs a clusterer with a '
+                                 "'metric' or 'affinity' parameter")
+        if not 0.0 < self.resample_frac <= 1.0:
+            raise ValueError('resample_frac must be in (0,1], got '
+                             '{}'.format(self.resample_frac))
+        subsample_size = int(round(self.resample_frac * n_samples))
+        if subsample_size < k_values[-1]:
+            raise ValueError(
+                'Each resample would contain {} samples, which is fewer '
+                'than the {} clusters requested'.format(subsample_size,
+                                                        k_values[-1])
+            )
+        return subsample_size, k_values
+
+    def _make_clusterer(self, rng, n_clusters):
+        """Clone the base clusterer and set its parameters."""
+        if self.clusterer is None:
+            est = KMeans(n_init=10)
+        else:
+            est = clone(self.clusterer)
+        params = est.get_params()
+        if 'n_clusters' in params:
+            est.set_params(n_clusters=n_clusters)
+        if 'random_state' in params:
+            est.set_params(
+                random_state=int(rng.integers(np.iinfo(np.int32).max)))
+        if self.precompute is not None:
+            est.set_params(**{_precomputed_param(est): 'precomputed'})
+        return est
+
+    def _init_state(self, X, k_values):
+        """Set up the fitted state for a fit starting from scratch."""
+        n_samples = X.shape[0]
+        self.n_features_in_ = X.shape[1]
+        # All of the randomness in the fit is derived from this one
+        # number; see _resample_rng.
+        self.entropy_ = check_random_state(self.random_state).randint(
+            np.iinfo(np.int32).max)
+        self.n_resamples_ = 0
+        self.converged_ = False
+        self._previous_cdfs = None
+        if self.storage == 'memmap':
+            self.memmap_dir_ = self._owned_dir('memmap', self.memmap_dir)
+            prefix = self.memmap_dir_ + os.sep
+        else:
+            prefix = None
+        (self.connectivities_, self.indicator_) = _new_counts(
+            n_samples, self.storage, k_values, prefix,
+            dtype=_count_dtype(self.n_resamples))
+        metric = self.precompute if isinstance(self.precompute, str) else \
+            'euclidean'
+        if isinstance(X, ArraySource):
+            self.neighbors_ = None
+        else:
+            with tracing.span('index', n=n_samples):
+                self.neighbors_ = NearestNeighbors(n_neighbors=1,
+                                                   metric=metric).fit(X)
+        if self.precompute is not None:
+            printif(self.verbose >= USERLVL,
+                    'Precomputing the pairwise distances')
+            if prefix is None:
+                out = np.empty((n_samples, n_samples), dtype=np.float32)
+            else:
+                out = np.memmap(prefix + 'distances-float32.dat',
+                                dtype=np.float32, mode='w+',
+                                shape=(n_samples, n_samples))
+            with tracing.span('precompute', n=n_samples):
+                self.distances_ = _pairwise_matrix(X, self.precompute, out)
+
+    def _owned_dir(self, key, parent):
+        """Create a new directory which lives as long as the fitted state.
+
+        The directory is deleted when the estimator is garbage collected,
+        or when _owned_dir is called again with the same key (i.e. when
+        the state it held is replaced). Files which are still mapped
+        stay readable until they're unmapped, on systems which allow
+        deleting them at all.
+        """
+        cleanups = self.__dict__.setdefault('_cleanups', {})
+        if key in cleanups:
+            cleanups.pop(key)()
+        path = tempfile.mkdtemp(prefix='consensuscluster-', dir=parent)
+        cleanups[key] = weakref.finalize(self, shutil.rmtree, path, True)
+        return path
+
+    def __getstate__(self):
+        # A copy (e.g. an unpickled one) doesn't own the directories;
+        # the finalizers can't be pickled anyway.
+        try:
+            state = super(ConsensusCluster, self).__getstate__()
+        except AttributeError:
+            state = self.__dict__
+        state = dict(state)
+        state.pop('_cleanups', None)
+        return state
+
+    def _check_state(self, X, k_values):
+        """Check that X and the parameters match an existing fitted state.
+        """
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(
+                'X has {} features, but ConsensusCluster is expecting {} '
+                'features as input'.format(X.shape[1], self.n_features_in_))
+        if X.shape[0] != self.indicator_.shape[0]:
+            raise ValueError(
+                'X has {} samples, but the fitted counts are for {} '
+                'samples'.format(X.shape[0], self.indicator_.shape[0]))
+        if k_values != sorted(self.connectivities_):
+            raise ValueError('The values of K changed since the last fit')
+
+    def __sklearn_tags__(self):
+        # Only used by scikit-learn >= 1.6, whose checks need to be told
+        # that sparse X is supported.
+        tags = super(ConsensusCluster, self).__sklearn_tags__()
+        tags.input_tags.sparse = True
+        return tags
+
+    def _check_X(self, X, continuing):
+        """Validate X, leaving data sources on disk.
+
+        An iterator of chunks is spilled to a file first, in a
+        directory (under memmap_dir, if that's set) which the estimator
+        owns, so the file is deleted along with the estimator or by the
+        next spill. An iterator can't be used to continue a fit (i.e.
+        when continuing is True), since it would have to be spilled all
+        over again. An np.memmap is wrapped in an ArraySource. An
+        ArraySource is checked one chunk of rows at a time.
+        """
+        if isinstance(X, Iterator):
+            if continuing:
+                raise ValueError(
+                    'An iterator of chunks can only be given to the first '
+                    'call of partial_fit, or to fit without warm_start. To '
+                    'continue a fit, pass the rows to spill_chunks once '
+                    'and give the ArraySource it returns to every call.')
+            printif(self.verbose >= USERLVL, 'Writing the chunks of X to disk')
+            with tracing.span('spill'):
+                X = spill_chunks(X, self._owned_dir('spill',
+                                                    self.memmap_dir))
+        elif isinstance(X, np.memmap):
+            X = ArraySource(X)
+        if not isinstance(X, ArraySource):
+            return check_array(X, accept_sparse='csr', ensure_min_samples=2)
+        if X.shape[0] < 2:
+            raise ValueError('Found array with {} sample(s) (shape={}) while '
+                             'a minimum of 2 is required.'.format(X.shape[0],
+                                                                  X.shape))
+        with tracing.span('check_source', n=X.shape[0]):
+            for (_, chunk) in X.iter_chunks():
+                check_array(chunk)
+        return X
+
+    def fit(self, X, y=None):
+        """Run consensus clustering on X.
+
+        If warm_start is True and the estimator has already been fit,
+        the counts are kept and only the resamples needed to bring the
+        total up to n_resamples are run.
+
+        Parameters
+        ----------
+        X : {array-like, sparse matrix, ArraySource, iterator}, shape (n_samples, n_features)
+            The samples to cluster. Sparse matrices are converted to
+            CSR (if they aren't already) and never densified as a
+            whole; see the class docstring.
+
+            X doesn't have to fit in memory. An ArraySource (see
+            consensuscluster.sources) or np.memmap is never read as a
+            whole: each resample reads only its own rows, and the
+            checks (and precompute) read X a chunk of rows at a time.
+            An iterator (e.g. a generator) of 2-D chunks of rows is
+            first written to a memory-mapped file under memmap_dir (or
+            in a new temporary directory) and then used the same way;
+            the file is deleted along with the estimator, or by the
+            next fit. An iterator can't be used to continue a fit with
+            warm_start; pass it to consensuscluster.sources.spill_chunks
+            once and give the ArraySource that returns to every fit
+            instead. In both cases, the neighbors_ index isn't built, so
+            predict can't be used.
+
+        y : None
+            Ignored; present for API consistency.
+
+        Returns
+        -------
+        self : object
+            Returns self.
+        """
+        X = self._check_X(X, self.warm_start and hasattr(self, 'indicator_'))
+        (subsample_size, k_values) = self._check_params(X.shape[0])
+        # A resumed checkpoint can be from after resampling stopped
+        # early, in which case there's nothing left to run. A warm start
+        # carries on regardless (the params may have changed), and
+        # _resample checks for convergence again.
+        resumed_converged = False
+        if self.warm_start and hasattr(self, 'indicator_'):
+            self._check_state(X, k_values)
+            if self.n_resamples < self.n_resamples_:
+                raise ValueError(
+                    'n_resamples={} must be at least the {} resamples '
+                    'which were already run when warm_start is '
+                    'True'.format(self.n_resamples, self.n_resamples_))
+        else:
+            self._init_state(X, k_values)
+            if self.resume:
+                resumed_converged = self._load_checkpoint(subsample_size,
+                                                          k_values)
+        with tracing.span('fit'):
+            if not resumed_converged:
+                self._resample(X, self.n_resamples - self.n_resamples_,
+                               subsample_size, k_values)
+            self._finalize(k_values)
+        return self
+
+    def partial_fit(self, X, y=None):
+        """Run n_resamples more resamples and fold them into the counts.
+
+        The first call starts from scratch, just like fit. Every later
+        call must be given the same X. Since every resample gets its own
+        seed, calling partial_fit repeatedly gives the same result as a
+        single fit with the same total number of resamples.
+
+        Parameters
+        ----------
+        X : {array-like, sparse matrix, ArraySource, iterator}, shape (n_samples, n_features)
+            The samples to cluster. Sparse matrices are converted to
+            CSR (if they aren't already) and never densified as a
+            whole; see the class docstring.
+
+            X doesn't have to fit in memory. An ArraySource (see
+            consensuscluster.sources) or np.memmap is never read as a
+            whole: each resample reads only its own rows, and the
+            checks (and precompute) read X a chunk of rows at a time.
+            An iterator (e.g. a generator) of 2-D chunks of rows is
+            first written to a memory-mapped file under memmap_dir (or
+            in a new temporary directory) and then used the same way;
+            the file is deleted along with the estimator. An iterator
+            can only be given to the first call, since every later call
+            would have to write all of it out again: to use one, pass
+            it to consensuscluster.sources.spill_chunks once and give
+            the ArraySource that returns to every call instead. In both
+            cases, the neighbors_ index isn't built, so predict can't
+            be used.
+
+        y : None
+            Ignored; present for API consistency.
+
+        Returns
+        -------
+        self : object
+            Returns self.
+        """
+        X = self._check_X(X, hasattr(self, 'indicator_'))
+        (subsample_size, k_values) = self._check_params(X.shape[0])
+        if hasattr(self, 'indicator_'):
+            self._check_state(X, k_values)
+        else:
+            self._init_state(X, k_values)
+        with tracing.span('fit'):
+            self._resample(X, self.n_resamples, subsample_size, k_values)
+            self._finalize(k_values)
+        return self
+
+    def predict(self, X, k=None):
+        """Assign new samples to the clusters found by fit.
+
+        Each sample gets the label of the nearest sample seen by fit
+        (as found with the neighbors_ index). The samples are looked up
+        _PREDICT_BATCH_SIZE at a time, so the memory used doesn't grow
+        with the number of samples, and with a tree index no distance
+        matrix is ever built. When the index has to use brute force
+        (for sparse X, or metrics the trees don't support), the
+        distances are computed in chunks bounded by scikit-learn's
+        working_memory setting.
+
+        Parameters
+        ----------
+        X : {array-like, sparse matrix}, shape (n_samples, n_features)
+            The samples to assign.
+
+        k : int or None, default=None
+            Which K's clusters to assign the samples to. Must be one of
+            the values in k_range. If None, n_clusters is used.
+
+        Returns
+        -------
+        labels : ndarray, shape (n_samples,)
+            The cluster label of each sample.
+        """
+        check_is_fitted(self, 'neighbors_')
+        if self.neighbors_ is None:
+            raise ValueError('predict needs the neighbors_ index, which '
+                             "isn't built when fit is given an ArraySource "
+                             'or an iterator')
+        X = check_array(X, accept_sparse='csr')
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(
+                'X has {} features, but ConsensusCluster is expecting {} '
+                'features as input'.format(X.shape[1], self.n_features_in_))
+        if k is None:
+            k = self.n_clusters
+        if k not in self.labels_by_k_:
+            raise ValueError('k={} is not one of the fitted values of K, '
+                             '{}'.format(k, sorted(self.labels_by_k_)))
+        fitted_labels = self.labels_by_k_[k]
+        labels = np.empty(X.shape[0], dtype=fitted_labels.dtype)
+        with tracing.span('predict', n=X.shape[0]):
+            for batch in gen_batches(X.shape[0], _PREDICT_BATCH_SIZE):
+                nearest = self.neighbors_.kneighbors(
+                    X[batch], return_distance=False)[:, 0]
+                labels[batch] = fitted_labels[nearest]
+        return labels
+
+    def _resample(self, X, n_more, subsample_size, k_values):
+        """Run up to n_more resamples, stopping early if tol is met.
+
+        The resamples are run in rounds of check_interval when tol or
+        checkpoint is set (and in a single round otherwise), and the
+        convergence check and checkpoint follow each round.
+        """
+        if n_more <= 0:
+            # Nothing has changed, so neither has converged_.
+            return
+        stop = self.n_resamples_ + n_more
+        self._widen_counts(stop)
+        self.converged_ = False
+        if self.tol is None and self.checkpoint is None:
+            interval = n_more
+        else:
+            interval = self.check_interval
+        rounds = [range(start, min(start + interval, stop))
+                  for start in range(self.n_resamples_, stop, interval)]
+        n_workers = min(effective_n_jobs(self.n_jobs), n_more)
+        if n_workers <= 1 and isinstance(self.executor, str):
+            # No need for partial counts; accumulate straight into the
+            # fitted state.
+            for resample_ids in rounds:
+                _partial_counts(self, X, subsample_size, k_values,
+                                self.entropy_, resample_ids,
+                                counts=(self.connectivities_, self.indicator_))
+                if self._end_round(resample_ids, subsample_size, k_values):
+                    break
+            return
+
+        # The executor is only started once per call. Rounds are folded
+        # into the counts (and checked and checkpointed) strictly in
+        # order, so how far ahead of that they run doesn't change the
+        # result. Running ahead means every worker has a batch even when
+        # a round has fewer resamples than there are workers; whatever
+        # ran ahead of convergence is thrown away.
+        runner = _BatchRunner(self, X, subsample_size, k_values, n_workers)
+        ahead = max(-(-n_workers // interval), 1)
+        pending = deque()
+        next_round = 0
+        try:
+            while not self.converged_:
+                while next_round < len(rounds) and len(pending) < ahead:
+                    resample_ids = rounds[next_round]
+                    pending.append((resample_ids, runner.submit(
+                        resample_ids, min(n_workers, len(resample_ids)))))
+                    next_round += 1
+                if not pending:
+                    break
+                (resample_ids, futures) = pending.popleft()
+                self._add_counts(runner.reduce(futures), k_values)
+                self._end_round(resample_ids, subsample_size, k_values)
+        finally:
+            for (_, futures) in pending:
+                runner.discard(futures)
+            runner.close()
+
+    def _end_round(self, resample_ids, subsample_size, k_values):
+        """Record a finished round; return whether resampling converged."""
+        self.n_resamples_ = resample_ids.stop
+        tracing.sample_memory('resample')
+        if self.tol is not None:
+            with tracing.span('convergence_check'):
+                self._check_convergence(k_values)
+        if self.checkpoint is not None:
+            with tracing.span('checkpoint'):
+                self._save_checkpoint(subsample_size, k_values)
+        return self.converged_
+
+    def _add_counts(self, partial_counts, k_values):
+        """Add a round's merged partial counts to the fitted state."""
+        (partial_connectivities, partial_indicator) = partial_counts
+        with tracing.span('merge'):
+            for k in k_values:
+                self.connectivities_[k] += partial_connectivities[k]
+                _discard_counts(partial_connectivities[k])
+            self.indicator_ += partial_indicator
+            _discard_counts(partial_indicator)
+
+    def _save_checkpoint(self, subsample_size, k_values):
+        """Save everything needed to carry on from here."""
+        printif(self.verbose >= DEBUGLVL,
+                'Writing a checkpoint after {} resamples'.format(
+                    self.n_resamples_))
+        if self._previous_cdfs is None:
+            cdfs = None
+        else:
+            cdfs = dict((str(k), self._previous_cdfs[k].tolist())
+                        for k in k_values)
+        meta = {
+            'n_samples': int(self.indicator_.shape[0]),
+            'n_features': int(self.n_features_in_),
+            'subsample_size': int(subsample_size),
+            'k_values': [int(k) for k in k_values],
+            'entropy': int(self.entropy_),
+            'n_resamples': int(self.n_resamples_),
+            'converged': bool(self.converged_),
+            'previous_cdfs': cdfs,
+        }
+        save_checkpoint(self.checkpoint, self.connectivities_,
+                        self.indicator_, meta)
+
+    def _load_checkpoint(self, subsample_size, k_values):
+        """Replace the freshly initialized state with the checkpoint's.
+
+        Returns whether resampling had already converged when the
+        checkpoint was written (False if there's no checkpoint yet).
+        """
+        meta = load_checkpoint(self.checkpoint)
+        if meta is None:
+            printif(self.verbose >= USERLVL,
+                    'No checkpoint in {} yet; starting from '
+                    'scratch'.format(self.checkpoint))
+            return False
+        expected = {
+            'n_samples': self.indicator_.shape[0],
+            'n_features': self.n_features_in_,
+            'subsample_size': subsample_size,
+            'k_values': list(k_values),
+            'layout': 'dense' if self.storage == 'dense' else 'packed',
+        }
+        for (name, value) in sorted(expected.items()):
+            if meta[name] != value:
+                raise ValueError(
+                    "The checkpoint's {} is {}, but this fit's is {}; was "
+                    'it written for different data or '
+                    'parameters?'.format(name, meta[name], value))
+        if meta['n_resamples'] > self.n_resamples:
+            raise ValueError(
+                'The checkpoint already has {} resamples, more than '
+                'n_resamples={}'.format(meta['n_resamples'],
+                                        self.n_resamples))
+        printif(self.verbose >= USERLVL,
+                'Resuming from the checkpoint after {} resamples'.format(
+                    meta['n_resamples']))
+        # The counts may have been widened by an earlier partial_fit.
+        self._widen_counts(np.iinfo(np.dtype(meta['dtype'])).max)
+        with tracing.span('load_checkpoint'):
+            read_counts(self.checkpoint, meta, 'indicator', self.indicator_)
+            for k in k_values:
+                read_counts(self.checkpoint, meta,
+                            'connectivity-k{}'.format(k),
+                            self.connectivities_[k])
+        self.entropy_ = meta['entropy']
+        self.n_resamples_ = meta['n_resamples']
+        self.converged_ = meta['converged']
+        if meta['previous_cdfs'] is not None:
+            self._previous_cdfs = dict(
+                (k, np.array(meta['previous_cdfs'][str(k)]))
+                for k in k_values)
+        return self.converged_
+
+    def _widen_counts(self, total):
+        """Make sure the count dtype can hold counts up to total.
+
+        This is only ever needed when partial_fit or warm_start take the
+        total number of resamples past what the counts were allocated
+        for.
+        """
+        dtype = _count_dtype(total)
+        if np.iinfo(dtype).max <= np.iinfo(self.indicator_.dtype).max:
+            return
+        printif(self.verbose >= DEBUGLVL,
+                'Widening the counts to {}'.format(np.dtype(dtype).name))
+        for k in list(self.connectivities_):
+            self.connectivities_[k] = _widen(self.connectivities_[k], dtype)
+        self.indicator_ = _widen(self.indicator_, dtype)
+
+    def _check_convergence(self, k_values):
+        """Compare the consensus CDFs to the ones from the last check."""
+        cdfs = {}
+        for k in k_values:
+            (values, cdf) = cdf_from_counts(self.connectivities_[k],
+                                            self.indicator_)
+            cdfs[k] = evaluate_cdf(values, cdf, _CDF_GRID)
+        if self._previous_cdfs is not None:
+            change = max(np.max(np.abs(cdfs[k] - self._previous_cdfs[k]))
+                         for k in k_values)
+            printif(self.verbose >= USERLVL,
+                    'After {} resamples, the consensus CDF changed by '
+                    '{:.5f}'.format(self.n_resamples_, change))
+            if change < self.tol:
+                printif(self.verbose >= USERLVL, 'Converged')
+                self.converged_ = True
+        self._previous_cdfs = cdfs
+
+    def _worker_copy(self):
+        """Return an unfitted copy of self, plus distances_ if it's set.
+
+        This is what's sent to the workers. It doesn't use clone, since
+        the executor param needn't be copyable (and it isn't needed by
+        the workers anyway). With memmap storage, distances_ is sent as
+        its filename and reopened by each worker, rather than copied
+        into the pickle.
+        """
+        params = self.get_params(deep=False)
+        params['executor'] = 'process'
+        worker = type(self)(**params)
+        if self.precompute is not None:
+            if isinstance(self.distances_, np.memmap):
+                self.distances_.flush()
+            worker.distances_ = _shared(self.distances_)
+        return worker
+
+    def _finalize(self, k_values):
+        """Compute the consensus matrices and labels from the counts."""
+        n_samples = self.indicator_.shape[0]
+        self.consensus_matrices_ = {}
+        self.labels_by_k_ = {}
+        for k in k_values:
+            printif(self.verbose >= DEBUGLVL,
+                    'Clustering the consensus matrix for K={}'.format(k))
+            if self.storage == 'memmap':
+                self.connectivities_[k].flush()
+            if self.lazy_consensus or self.sparse_threshold is not None:
+                # With sparse_threshold, the float matrix would only be
+                # thrown away after clustering, so don't build it.
+                self.consensus_matrices_[k] = ConsensusRatio(
+                    self.connectivities_[k], self.indicator_)
+            else:
+                if self.storage == 'memmap':
+                    out = PackedSymmetricMatrix.memmap(
+                        os.path.join(self.memmap_dir_,
+                                     'consensus-k{}.dat'.format(k)),
+                        n_samples)
+                else:
+                    out = None
+                with tracing.span('consensus', k=k):
+                    self.consensus_matrices_[k] = consensus_ratio(
+                        self.connectivities_[k], self.indicator_, out=out)
+            with tracing.span('linkage', k=k):
+                self.labels_by_k_[k] = _cluster_consensus(
+                    self.consensus_matrices_[k], k, self.linkage)
+            if self.sparse_threshold is not None:
+                with tracing.span('threshold', k=k):
+                    self.consensus_matrices_[k] = threshold_consensus(
+                        self.consensus_matrices_[k], self.sparse_threshold)
+        if self.storage == 'memmap':
+            self.indicator_.flush()
+        tracing.sample_memory('finalize')
+        self.connectivity_ = self.connectivities_[self.n_clusters]
+        self.consensus_matrix_ = self.consensus_matrices_[self.n_clusters]
+        self.labels_ = self.labels_by_k_[self.n_clusters]
+
+
+class _BatchRunner(object):
+    """Runs batches of resamples on the executor, for one fit.
+
+    Parameters
+    ----------
+    estimator : ConsensusCluster
+        The estimator being fit.
+
+    X : ndarray, scipy.sparse.csr_matrix or ArraySource
+        The samples.
+
+    subsample_size : int
+        Number of samples to draw in each resample.
+
+    k_values : list of int
+        The values of K to run the base clusterer with.
+
+    n_workers : int
+        The number of workers to start, if the executor is ours.
+    """
+    def __init__(self, estimator, X, subsample_size, k_values, n_workers):
+        self.estimator = estimator
+        self.subsample_size = subsample_size
+        self.k_values = k_values
+        # Only send the parameters (and distances_), not the fitted
+        # state; the counts and the neighbors_ index would otherwise be
+        # copied to every worker.
+        self.shared_args = (estimator._worker_copy(), X)
+        self.preloaded = False
+        if estimator.executor == 'process':
+            try:
+                # Send X and the parameters to each worker once, when
+                # it starts, rather than with every batch.
+                self.pool = ProcessPoolExecutor(
+                    max_workers=n_workers, initializer=_set_worker_args,
+                    initargs=self.shared_args)
+                self.preloaded = True
+            except TypeError:
+                # Python < 3.7 has no initializer.
+                self.pool = ProcessPoolExecutor(max_workers=n_workers)
+        elif estimator.executor == 'thread':
+            self.pool = ThreadPoolExecutor(max_workers=n_workers)
+        else:
+            self.pool = estimator.executor
+        self.own_pool = isinstance(estimator.executor, str)
+        shares_memory = isinstance(self.pool, ThreadPoolExecutor)
+        # Workers in other processes can't see our collectors, so when
+        # tracing is on they record into their own and send back a
+        # summary.
+        self.trace_workers = not shares_memory and tracing.enabled()
+        # Merge on the workers only when that doesn't mean copying the
+        # partial counts back and forth.
+        if shares_memory or estimator.storage == 'memmap':
+            self.submit_merge = self.pool.submit
+        else:
+            self.submit_merge = _run_now
+
+    def submit(self, resample_ids, n_batches):
+        """Start running some resamples, split into n_batches batches.
+
+        Every resample gets its own seed, so it doesn't matter which
+        batch runs it, and the counts are integers, so it doesn't matter
+        in which order the partial counts are added up. Hence the result
+        is the same for any number of batches.
+
+        Returns
+        -------
+        list of Future
+            One per batch.
+        """
+        estimator = self.estimator
+        printif(estimator.verbose >= USERLVL,
+                'Running {} resamples in {} batches'.format(
+                    len(resample_ids), n_batches))
+        bounds = np.linspace(resample_ids.start, resample_ids.stop,
+                             n_batches + 1).astype(int)
+        # The batches are merged into one another, so each one's counts
+        # must be able to hold the total for the round.
+        dtype = _count_dtype(len(resample_ids))
+        futures = []
+        for b in range(n_batches):
+            batch = range(bounds[b], bounds[b + 1])
+            prefix = None
+            if estimator.storage == 'memmap':
+                prefix = os.path.join(estimator.memmap_dir_,
+                                      'batch{}-'.format(batch.start))
+            args = (self.subsample_size, self.k_values, estimator.entropy_,
+                    batch, prefix)
+            if self.preloaded:
+                func = _preloaded_partial_counts
+            else:
+                func = _partial_counts
+                args = self.shared_args + args
+            if self.trace_workers:
+                futures.append(self.pool.submit(tracing._run_collected, func,
+                                                *args, dtype=dtype))
+            else:
+                futures.append(self.pool.submit(func, *args, dtype=dtype))
+        return futures
+
+    def reduce(self, futures):
+        """Wait for some batches and return their merged partial counts."""
+        printif(self.estimator.verbose >= DEBUGLVL,
+                'Merging the partial counts')
+        return _tree_reduce(futures, _merge_counts, self.submit_merge,
+                            leaf=_merge_summary if self.trace_workers else None)
+
+    def discard(self, futures):
+        """Throw away some batches which are no longer needed."""
+        for future in futures:
+            if future.cancel():
+                continue
+            try:
+                result = future.result()
+            except Exception:
+                continue
+            if self.trace_workers:
+                (result, _) = result
+            (connectivities, indicator) = result
+            for k in connectivities:
+                _discard_counts(connectivities[k])
+            _discard_counts(indicator)
+
+    def close(self):
+        if self.own_pool:
+            self.pool.shutdown()
+
+
+_WORKER_ARGS = None
+"""The (estimator, X) pair in each worker process of our own pool."""
+
+
+def _set_worker_args(estimator, X):
+    global _WORKER_ARGS
+    _WORKER_ARGS = (estimator, X)
+
+
+def _preloaded_partial_counts(*args, **kwargs):
+    """_partial_counts, with the arguments set by _set_worker_args."""
+    return _partial_counts(*(_WORKER_ARGS + args), **kwargs)
+
+
+def _resample_rng(entropy, resample_id):
+    """Get the random number generator for a single resample.
+
+    Each resample gets its own independent stream, spawned from the
+    fit's entropy with the resample's index as the spawn key. This is
+    equivalent to SeedSequence(entropy).spawn(n_resamples)[resample_id],
+    but doesn't require creating all of the children first.
+    """
+    seed_seq = np.random.SeedSequence(entropy, spawn_key=(resample_id,))
+    return np.random.default_rng(seed_seq)
+
+
+def _count_dtype(total):
+    """Return the smallest unsigned integer dtype which can count to total.
+
+    uint8 isn't used, since it would have to be widened as soon as
+    partial_fit went past 255 resamples.
+    """
+    for dtype in (np.uint16, np.uint32):
+        if total <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def _zero_counts(n_samples, storage, filename=None, dtype=np.uint16):
+    """Allocate an all-zero count matrix with the given storage.
+
+    filename is only used (and required) for memmap storage.
+    """
+    if storage == 'memmap':
+        return PackedSymmetricMatrix.memmap(filename, n_samples, dtype=dtype)
+    if storage == 'packed':
+        return PackedSymmetricMatrix(n_samples, dtype=dtype)
+    return np.zeros((n_samples, n_samples), dtype=dtype)
+
+
+def _count_filename(memmap_prefix, name, dtype):
+    # The dtype is part of the name so that _widen can write the
+    # widened copy next to the original.
+    return '{}{}-{}.dat'.format(memmap_prefix, name, np.dtype(dtype).name)
+
+
+def _new_counts(n_samples, storage, k_values, memmap_prefix=None,
+                dtype=np.uint16):
+    """Allocate all-zero connectivity counts for each K and indicator counts.
+
+    For memmap storage, memmap_prefix is the path prefix of the files.
+    dtype is the (integer) dtype of the counts.
+
+    Returns
+    -------
+    connectivities : dict
+        Maps each K in k_values to its connectivity counts.
+
+    indicator : ndarray or PackedSymmetricMatrix
+        The indicator counts.
+    """
+    connectivities = {}
+    for k in k_values:
+        filename = None
+        if memmap_prefix is not None:
+            filename = _count_filename(memmap_prefix,
+                                       'connectivity-k{}'.format(k), dtype)
+        connectivities[k] = _zero_counts(n_samples, storage, filename, dtype)
+    filename = None
+    if memmap_prefix is not None:
+        filename = _count_filename(memmap_prefix, 'indicator', dtype)
+    indicator = _zero_counts(n_samples, storage, filename, dtype)
+    return connectivities, indicator
+
+
+def _widen(counts, dtype):
+    """Return a copy of a count matrix with a bigger integer dtype.
+
+    A memory-mapped matrix is copied (chunk by chunk) into a new file,
+    and the old file is deleted.
+    """
+    if not isinstance(counts, PackedSymmetricMatrix):
+        return counts.astype(dtype)
+    filename = counts.filename
+    if filename is None:
+        return PackedSymmetricMatrix(counts.n, data=counts.data.astype(dtype))
+    old_name = np.dtype(counts.dtype).name
+    assert filename.endswith('-{}.dat'.format(old_name))
+    new_filename = filename[:-len(old_name) - 4] + \
+        '{}.dat'.format(np.dtype(dtype).name)
+    wide = PackedSymmetricMatrix.memmap(new_filename, counts.n, dtype=dtype)
+    for start in range(0, len(wide.data), _CHUNK_ELEMENTS):
+        stop = start + _CHUNK_ELEMENTS
+        wide.data[start:stop] = counts.data[start:stop]
+    wide.flush()
+    _discard_counts(counts)
+    return wide
+
+
+def _discard_counts(counts):
+    """Free a count matrix which has been merged into another one.
+
+    This only does anything for memory-mapped matrices, whose backing
+    file is deleted.
+    """
+    if isinstance(counts, PackedSymmetricMatrix):
+        filename = counts.filename
+        if filename is not None:
+            # Drop the mapping first; Windows won't delete a file
+            # which is still mapped.
+            counts.data = None
+            os.remove(filename)
+
+
+def _precomputed_param(clusterer):
+    """Return the parameter of clusterer which can be set to 'precomputed'.
+
+    That's 'metric' if it has one, else 'affinity', else None. The
+    default clusterer (KMeans) has neither.
+    """
+    if clusterer is None:
+        return None
+    params = clusterer.get_params()
+    for name in ('metric', 'affinity'):
+        if name in params:
+            return name
+    return None
+
+
+def _accepts_sparse(clusterer):
+    """Return whether a base clusterer (None meaning KMeans) accepts
+    sparse input, according to its scikit-learn tags.
+
+    Before scikit-learn 1.6 the tags don't say, so we assume it doesn't
+    and densify the resamples: that's only slower for a clusterer which
+    could have taken them sparse, whereas the opposite guess breaks
+    every one which can't.
+    """
+    if clusterer is None:
+        return True
+    try:
+        return clusterer.__sklearn_tags__().input_tags.sparse
+    except AttributeError:
+        return False
+
+
+def _pairwise_matrix(X, precompute, out):
+    """Fill out with the pairwise distances (or affinities) of X.
+
+    The matrix is computed a chunk of rows at a time, so the only
+    float64 temporaries are the size of a chunk. For an ArraySource,
+    each chunk of rows is paired with each chunk of columns in turn,
+    so X is never loaded as a whole.
+
+    Parameters
+    ----------
+    X : ndarray, scipy.sparse.csr_matrix or ArraySource, shape (n_samples, n_features)
+
+    precompute : str or callable
+        See the precompute param of ConsensusCluster.
+
+    out : ndarray of float32, shape (n_samples, n_samples)
+        Where to write the matrix. It can be an np.memmap.
+
+    Returns
+    -------
+    out
+    """
+    n_samples = X.shape[0]
+    chunk_rows = max(_CHUNK_ELEMENTS // n_samples, 1)
+    for start in range(0, n_samples, chunk_rows):
+        stop = min(start + chunk_rows, n_samples)
+        X_rows = X[start:stop]
+        if isinstance(X, ArraySource):
+            column_chunks = X.iter_chunks()
+        else:
+            column_chunks = [(0, X)]
+        for (col_start, X_cols) in column_chunks:
+            cols = slice(col_start, col_start + X_cols.shape[0])
+            if callable(precompute):
+                out[start:stop, cols] = precompute(X_rows, X_cols)
+            else:
+                out[start:stop, cols] = pairwise_distances(
+                    X_rows, X_cols, metric=precompute)
+        if not callable(precompute):
+            # Some metrics (e.g. euclidean) can leave rounding errors
+            # on the diagonal.
+            rows = np.arange(start, stop)
+            out[rows, rows] = 0.0
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def _partial_counts(estimator, X, subsample_size, k_values, entropy,
+                    resample_ids, memmap_prefix=None, counts=None,
+                    dtype=None):
+    """Run some of the resamples and return their count matrices.
+
+    This is the unit of work handed to each worker, so it has to be a
+    module-level function (otherwise it can't be pickled).
+
+    Parameters
+    ----------
+    estimator : ConsensusCluster
+        The estimator being fit. Only its parameters are used.
+
+    X : ndarray, scipy.sparse.csr_matrix or ArraySource, shape (n_samples, n_features)
+        The full dataset. If estimator.precompute is set, the
+        resamples are taken from estimator.distances_ instead.
+
+    subsample_size : int
+        Number of samples to draw in each resample.
+
+    k_values : list of int
+        The values of K to run the base clusterer with.
+
+    entropy : int
+        The fit's entropy; see _resample_rng.
+
+    resample_ids : range
+        Indices of the resamples to run.
+
+    memmap_prefix : str or None, default=None
+        For memmap storage, the path prefix of the files in which this
+        worker's count matrices are kept.
+
+    counts : tuple or None, default=None
+        If given, a (connectivities, indicator) pair of existing counts
+        to accumulate into, instead of allocating new ones.
+
+    dtype : numpy dtype or None, default=None
+        The dtype of newly allocated counts. If None, the smallest one
+        which can count len(resample_ids) resamples. The partial counts
+        of a batch are added up with those of the rest of its round, so
+        they need a dtype which can count the whole round.
+
+    Returns
+    -------
+    connectivities : dict
+        Maps each K to the connectivity counts (an ndarray or
+        PackedSymmetricMatrix) of only these resamples.
+
+    indicator : ndarray or PackedSymmetricMatrix
+        The indicator counts of only these resamples.
+    """
+    n_samples = X.shape[0]
+    if counts is None:
+        if dtype is None:
+            dtype = _count_dtype(len(resample_ids))
+        counts = _new_counts(n_samples, estimator.storage, k_values,
+                             memmap_prefix, dtype=dtype)
+    (connectivities, indicator) = counts
+    densify = is_sparse(X) and estimator.precompute is None and \
+        not _accepts_sparse(estimator.clusterer)
+    for batch_start in range(resample_ids.start, resample_ids.stop,
+                             _RESAMPLE_BATCH_SIZE):
+        batch_stop = min(batch_start + _RESAMPLE_BATCH_SIZE,
+                         resample_ids.stop)
+        printif(estimator.verbose >= USERLVL,
+                'Running resamples {} through {}'.format(batch_start + 1,
+                                                         batch_stop))
+        subsamples = []
+        labelings = dict((k, []) for k in k_values)
+        for resample_id in range(batch_start, batch_stop):
+            with tracing.span('resample'):
+                rng = _resample_rng(entropy, resample_id)
+                # Sorting the indices doesn't change the result, but it
+                # makes the row gathers below more cache-friendly.
+                indices = np.sort(rng.choice(n_samples, subsample_size,
+                                             replace=False))
+                if estimator.precompute is None:
+                    # For CSR input, this is a sparse row gather, and
+                    # for an ArraySource it reads only these rows.
+                    X_sub = X[indices]
+                    if densify:
+                        X_sub = X_sub.toarray()
+                else:
+                    X_sub = estimator.distances_[np.ix_(indices, indices)]
+            for k in k_values:
+                with tracing.span('cluster', k=k):
+                    est = estimator._make_clusterer(rng, k)
+                    labelings[k].append(est.fit_predict(X_sub))
+            subsamples.append(indices)
+        with tracing.span('accumulate'):
+            for k in k_values:
+                accumulate_connectivity(connectivities[k], subsamples,
+                                        labelings[k])
+            accumulate_indicator(indicator, subsamples)
+        tracing.count('resamples', batch_stop - batch_start)
+        tracing.count('clusterer_fits',
+                      (batch_stop - batch_start) * len(k_values))
+    if memmap_prefix is not None:
+        for k in k_values:
+            connectivities[k].flush()
+        indicator.flush()
+    return connectivities, indicator
+
+
+def _merge_counts(left, right):
+    """Add one batch's partial counts to another's.
+
+    Both are (connectivities, indicator) pairs, as returned by
+    _partial_counts. right is added into left (in place) and then
+    discarded. This is a module-level function so that it can run on
+    the workers.
+
+    Returns
+    -------
+    left
+    """
+    (left_connectivities, left_indicator) = left
+    (right_connectivities, right_indicator) = right
+    with tracing.span('merge'):
+        for k in left_connectivities:
+            left_connectivities[k] += right_connectivities[k]
+            _discard_counts(right_connectivities[k])
+            if isinstance(left_connectivities[k], PackedSymmetricMatrix):
+                left_connectivities[k].flush()
+        left_indicator += right_indicator
+        _discard_counts(right_indicator)
+        if isinstance(left_indicator, PackedSymmetricMatrix):
+            left_indicator.flush()
+    return left
+
+
+def _run_now(func, *args):
+    """Call func right away, returning its result as a done Future."""
+    future = Future()
+    future.set_result(func(*args))
+    return future
+
+
+def _merge_summary(result):
+    """Fold a worker's tracing summary into ours; return its result."""
+    (result, summary) = result
+    tracing.merge(summary)
+    return result
+
+
+def _tree_reduce(futures, merge, submit, leaf=None):
+    """Combine the results of some futures pairwise, in a binary tree.
+
+    Level 0 of the tree holds the results of futures, in order. Node i
+    of each following level is merge(a, b) of nodes 2i and 2i+1 of the
+    level below (a lone last node is passed up as it is). The shape of
+    the tree only depends on len(futures), so which results are merged
+    with which never depends on which futures finish first. Each merge
+    is started, with submit(merge, a, b), as soon as both of its inputs
+    are ready.
+
+    Parameters
+    ----------
+    futures : list of Future
+        At least one.
+
+    merge : callable
+        Takes two results and returns their combination.
+
+    submit : callable
+        Called as submit(merge, a, b); must return a Future.
+
+    leaf : callable or None, default=None
+        If given, each result of futures is replaced by leaf(result)
+        (in this thread) before it's merged.
+
+    Returns
+    -------
+    The result at the root of the tree.
+    """
+    sizes = [len(futures)]
+    while sizes[-1] > 1:
+        sizes.append((sizes[-1] + 1) // 2)
+    pending = dict((future, (0, i)) for (i, future) in enumerate(futures))
+    ready = {}
+    while True:
+        (done, _) = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            (level, i) = pending.pop(future)
+            result = future.result()
+            if level == 0 and leaf is not None:
+                result = leaf(result)
+            while True:
+                if level == len(sizes) - 1:
+                    return result
+                sibling = i ^ 1
+                if sibling >= sizes[level]:
+                    # The lone last node; pass it up.
+                    (level, i) = (level + 1, i // 2)
+                elif (level, sibling) in ready:
+                    other = ready.pop((level, sibling))
+                    (a, b) = (result, other) if i < sibling else \
+                        (other, result)
+                    pending[submit(merge, a, b)] = (level + 1, i // 2)
+                    break
+                else:
+                    ready[(level, i)] = result
+                    break
+
+
+def _cluster_consensus(consensus_matrix, n_clusters, method):
+    """Hierarchically cluster the samples using a consensus matrix.
+
+    Parameters
+    ----------
+    consensus_matrix : ndarray, PackedSymmetricMatrix or ConsensusRatio
+        The consensus matrix, shape (n_samples, n_samples).
+        1 - consensus_matrix is used as the distance between samples.
+
+    n_clusters : int
+        The number of clusters to form.
+
+    method : str
+        The linkage method; see scipy.cluster.hierarchy.linkage.
+
+    Returns
+    -------
+    labels : ndarray, shape (n_samples,)
+        Cluster labels in {0, ..., n_clusters - 1}.
+    """
+    if not isinstance(consensus_matrix, np.ndarray):
+        condensed = consensus_matrix.condensed()
+    else:
+        # squareform expects a distance matrix and would complain
+        # that the diagonal isn't 0. The diagonal is dropped anyway,
+        # so we skip the checks.
+        condensed = squareform(consensus_matrix, checks=False)
+    condensed = 1.0 - condensed
+    tree = hierarchical_linkage(condensed, method=method)
+    labels = fcluster(tree, n_clusters, criterion='maxclust')
+    return labels - 1
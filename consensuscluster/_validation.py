@@ -0,0 +1,162 @@
+"""Checks that a consensus matrix is what it claims to be.
+
+A consensus matrix must be square, symmetric, and have all its values
+in [0,1]. Checking that naively (e.g. with np.array_equal(mat, mat.T))
+allocates several n-by-n temporaries, which defeats the purpose of all
+the care taken elsewhere to never do that. The checks here work one
+tile at a time instead, and also come in a cheap sampled flavor which
+only looks at O(n) entries.
+"""
+import numpy as np
+
+from ._accumulate import ConsensusRatio
+from .packed import PackedSymmetricMatrix
+from .packed import _CHUNK_ELEMENTS
+from .misc import is_sparse
+
+CHECK_INPUT_MODES = ('none', 'sampled', 'full')
+
+_TILE = 1024
+"""Side length of the tiles compared by the full check."""
+
+_SAMPLE_TILE = 32
+"""Side length of the tiles compared by the sampled check."""
+
+
+def _check_range(values, name):
+    """Raise a ValueError unless every value is in [0,1].
+
+    Written this way round, NaNs fail the check too.
+    """
+    if values.size > 0 and not (values.min() >= 0.0 and
+                                values.max() <= 1.0):
+        raise ValueError('{} must only contain values in [0,1]'.format(name))
+
+
+def _read_tile(mat, rows, cols):
+    """Read mat[rows, cols], where rows and cols are slices."""
+    if isinstance(mat, ConsensusRatio):
+        return mat.tile(rows.start, rows.stop, cols.start, cols.stop)
+    return np.asarray(mat[rows, cols])
+
+
+def _check_tile_pair(mat, rows, cols, name):
+    """Check the range of mat[rows, cols] and that it mirrors mat[cols, rows].
+    """
+    tile = _read_tile(mat, rows, cols)
+    _check_range(tile, name)
+    if not np.array_equal(tile, _read_tile(mat, cols, rows).T):
+        raise ValueError('{} must be symmetric'.format(name))
+
+
+def _check_sparse(mat, mode, random_state, name):
+    """Check a scipy.sparse consensus matrix.
+
+    Entries which aren't stored are 0, so they're always valid; only
+    the stored ones need checking.
+    """
+    if mode == 'none':
+        return
+    mat = mat.tocsr(copy=True)
+    mat.sum_duplicates()
+    if mode == 'full':
+        _check_range(mat.data, name)
+        if (mat != mat.T).nnz != 0:
+            raise ValueError('{} must be symmetric'.format(name))
+        return
+    if mat.nnz == 0:
+        return
+    rng = np.random.default_rng(random_state)
+    picked = rng.integers(mat.nnz, size=min(mat.nnz, 32 * mat.shape[0]))
+    _check_range(mat.data[picked], name)
+    # Look up the mirror image of each checked entry.
+    rows = np.searchsorted(mat.indptr, picked, side='right') - 1
+    cols = mat.indices[picked]
+    mirrored = np.asarray(mat[cols, rows]).ravel()
+    if not np.array_equal(mirrored, mat.data[picked]):
+        raise ValueError('{} must be symmetric'.format(name))
+
+
+def check_consensus_matrix(mat, mode='full', random_state=None,
+                           name='The consensus matrix'):
+    """Check that mat is a valid consensus matrix.
+
+    Parameters
+    ----------
+    mat : ndarray, PackedSymmetricMatrix, ConsensusRatio or sparse matrix
+        The matrix to check. It can be an np.memmap. For a
+        ConsensusRatio, the consensus values computed from its counts
+        are checked. For a scipy.sparse matrix, only the stored entries
+        are checked (in 'sampled' mode, about 32 n of them).
+
+    mode : {'none', 'sampled', 'full'}, default='full'
+        How thoroughly to check.
+
+        * 'none' only checks the type and shape.
+        * 'sampled' also checks the range of the diagonal (of an
+          ndarray) and the range and symmetry of randomly placed
+          tiles, about 32 n entries in total. It catches matrices
+          which are wrong all over (e.g. not consensus values at all),
+          not isolated bad entries.
+        * 'full' checks the range and symmetry of every entry, one tile
+          at a time, so the only temporaries are a couple of tiles.
+
+    random_state : int or None, default=None
+        Seed for choosing the tiles in 'sampled' mode.
+
+    name : str, default='The consensus matrix'
+        What to call mat in error messages.
+
+    Raises
+    ------
+    ValueError
+        If mat fails any of the checks.
+    """
+    if mode not in CHECK_INPUT_MODES:
+        raise ValueError("check_input must be one of 'none', 'sampled' or "
+                         "'full', got {!r}".format(mode))
+    if isinstance(mat, PackedSymmetricMatrix):
+        # Symmetric by construction, so only the range needs checking.
+        if mode == 'full':
+            for start in range(0, len(mat.data), _CHUNK_ELEMENTS):
+                _check_range(mat.data[start:start + _CHUNK_ELEMENTS], name)
+        elif mode == 'sampled':
+            rng = np.random.default_rng(random_state)
+            n_samples = min(_SAMPLE_TILE * mat.n, len(mat.data))
+            positions = np.sort(rng.integers(len(mat.data), size=n_samples))
+            _check_range(mat.data[positions], name)
+            _check_range(mat.data[mat._offsets], name)
+        return
+
+    if not isinstance(mat, (np.ndarray, ConsensusRatio)) and \
+            not is_sparse(mat):
+        raise ValueError('{} must be an ndarray, a PackedSymmetricMatrix, '
+                         'a ConsensusRatio or a scipy.sparse matrix, got '
+                         '{}'.format(name, type(mat).__name__))
+    if len(mat.shape) != 2 or mat.shape[0] != mat.shape[1]:
+        raise ValueError('{} must be square, got shape {}'.format(
+            name, mat.shape))
+    if is_sparse(mat):
+        _check_sparse(mat, mode, random_state, name)
+        return
+    n = mat.shape[0]
+    if mode == 'full':
+        for row_start in range(0, n, _TILE):
+            rows = slice(row_start, min(row_start + _TILE, n))
+            # Tiles below the diagonal are checked as the mirror image
+            # of the ones above it.
+            for col_start in range(row_start, n, _TILE):
+                cols = slice(col_start, min(col_start + _TILE, n))
+                _check_tile_pair(mat, rows, cols, name)
+    elif mode == 'sampled':
+        rng = np.random.default_rng(random_state)
+        if isinstance(mat, np.ndarray):
+            _check_range(np.diagonal(mat), name)
+        tile = min(_SAMPLE_TILE, n)
+        if tile == 0:
+            return
+        n_tiles = max(n // tile, 8)
+        starts = rng.integers(n - tile + 1, size=(n_tiles, 2))
+        for (row_start, col_start) in starts:
+            _check_tile_pair(mat, slice(row_start, row_start + tile),
+                             slice(col_start, col_start + tile), name)
@@ -0,0 +1,245 @@
+"""Summaries of consensus matrices, used to choose the number of clusters.
+
+Monti et al. (2003) choose K by looking at the empirical CDF of the
+consensus values (over all pairs of distinct samples) for each K, the
+area under each CDF, and the relative change in that area from one K
+to the next.
+
+The naive way to get the CDF is to pull out all n(n-1)/2 values and
+sort them, which takes an enormous amount of scratch memory for large
+n. Instead, everything here streams over the matrices in chunks and
+builds histograms. When the count matrices are available, the
+histogram is exact: every consensus value is the ratio of two small
+integers (a connectivity count over an indicator count, both at most
+the number of resamples), so we simply count how many pairs have each
+(indicator, connectivity) combination.
+"""
+import numpy as np
+
+from ._accumulate import _iter_upper_chunks
+from .misc import is_sparse
+
+
+_KEY_BASE = 1 << 32
+"""Multiplier which packs an (indicator, connectivity) pair into one key.
+
+Counts are below 2^32 (that would take billions of resamples), so the
+keys fit in a uint64.
+"""
+
+
+def _joint_count_histogram(connectivity, indicator):
+    """Count the pairs of samples with each combination of counts.
+
+    Only the combinations which actually occur are kept, so the memory
+    needed doesn't depend on the number of resamples: each chunk is
+    reduced to its distinct combinations before being folded into the
+    running totals. That's done with a dense histogram when it's no
+    bigger than the chunk, and with np.unique otherwise.
+
+    Returns
+    -------
+    ind : ndarray of uint64
+        The distinct indicator counts m of the combinations, sorted
+        along with conn.
+
+    conn : ndarray of uint64
+        The connectivity count c of each combination.
+
+    pairs : ndarray of int64
+        The number of pairs (i, j), i < j, with indicator count m and
+        connectivity count c.
+    """
+    keys = np.zeros(0, dtype=np.uint64)
+    pairs = np.zeros(0, dtype=np.int64)
+    for (conn, ind) in _iter_upper_chunks(connectivity, indicator):
+        if len(ind) == 0:
+            continue
+        size = int(ind.max()) + 1
+        if size * size <= len(ind):
+            # Few enough resamples that a dense histogram is no bigger
+            # than the chunk, and bincount is much faster than sorting.
+            # The connectivity counts are never bigger than the
+            # indicator counts, so it's big enough for both.
+            joint = np.bincount(ind.astype(np.int64) * size + conn,
+                                minlength=size * size)
+            chunk_keys = np.flatnonzero(joint)
+            chunk_pairs = joint[chunk_keys]
+            chunk_keys = (chunk_keys // size).astype(np.uint64) * \
+                np.uint64(_KEY_BASE) + (chunk_keys % size).astype(np.uint64)
+        else:
+            chunk_keys = ind.astype(np.uint64) * np.uint64(_KEY_BASE) + \
+                conn.astype(np.uint64)
+            (chunk_keys, chunk_pairs) = np.unique(chunk_keys,
+                                                  return_counts=True)
+        (keys, inverse) = np.unique(np.concatenate([keys, chunk_keys]),
+                                    return_inverse=True)
+        merged = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(merged, inverse.ravel(),
+                  np.concatenate([pairs, chunk_pairs]))
+        pairs = merged
+    return keys // np.uint64(_KEY_BASE), keys % np.uint64(_KEY_BASE), pairs
+
+
+def cdf_from_counts(connectivity, indicator):
+    """Compute the exact CDF of the consensus values from the counts.
+
+    The CDF is over all pairs of distinct samples which were drawn
+    together at least once. The matrices are read in chunks, and the
+    only other memory used is a histogram with one entry per distinct
+    (indicator, connectivity) combination which actually occurs. That
+    is never more than the number of pairs, nor about H^2 / 2 for H
+    resamples, and in practice far fewer than either.
+
+    Parameters
+    ----------
+    connectivity : ndarray or PackedSymmetricMatrix
+        The connectivity counts.
+
+    indicator : ndarray or PackedSymmetricMatrix
+        The indicator counts. Must be stored the same way as
+        connectivity.
+
+    Returns
+    -------
+    values : ndarray
+        The distinct consensus values which occur, in increasing order.
+
+    cdf : ndarray
+        cdf[i] is the fraction of pairs whose consensus is at most
+        values[i]. Same length as values.
+    """
+    (ind, conn, pairs) = _joint_count_histogram(connectivity, indicator)
+    drawn = ind > 0
+    # Equal fractions (like 1/2 and 2/4) produce exactly equal floats,
+    # since division is correctly rounded.
+    ratios = conn[drawn] / ind[drawn].astype(np.float64)
+    (values, inverse) = np.unique(ratios, return_inverse=True)
+    hist = np.bincount(inverse.ravel(), weights=pairs[drawn],
+                       minlength=len(values))
+    total = hist.sum()
+    if total == 0:
+        return values, np.zeros(len(values))
+    return values, np.cumsum(hist) / total
+
+
+def cdf_from_matrix(consensus_matrix, n_bins=100):
+    """Approximate the CDF of the values in a consensus matrix.
+
+    Use this when only the consensus matrix (and not the counts it came
+    from) is available. The values are put into n_bins equal-width bins
+    covering [0,1], so the result is only exact at the bin edges.
+
+    Parameters
+    ----------
+    consensus_matrix : ndarray, PackedSymmetricMatrix, ConsensusRatio or sparse matrix
+        The consensus matrix. Only the strict upper triangle is read.
+        For a scipy.sparse matrix, the pairs which aren't stored count
+        as 0.
+
+    n_bins : int, default=100
+        The number of bins.
+
+    Returns
+    -------
+    values : ndarray, shape (n_bins,)
+        The right edges of the bins.
+
+    cdf : ndarray, shape (n_bins,)
+        cdf[i] is the fraction of pairs whose consensus is at most
+        values[i].
+    """
+    values = np.linspace(0.0, 1.0, n_bins + 1)[1:]
+    hist = np.zeros(n_bins, dtype=np.int64)
+    if is_sparse(consensus_matrix):
+        # Only imported here so that this module doesn't need scipy.
+        from .sparse import _upper_values
+        n = consensus_matrix.shape[0]
+        stored = _upper_values(consensus_matrix)
+        chunks = [stored]
+        hist[0] += n * (n - 1) // 2 - len(stored)
+    else:
+        chunks = (chunk for (chunk,) in _iter_upper_chunks(consensus_matrix))
+    for chunk in chunks:
+        # Unlike np.histogram, make the bins closed on the right, so
+        # that the CDF at each edge includes the values equal to it.
+        bins = np.searchsorted(values, chunk, side='left')
+        hist += np.bincount(np.minimum(bins, n_bins - 1), minlength=n_bins)
+    total = hist.sum()
+    if total == 0:
+        return values, np.zeros(n_bins)
+    return values, np.cumsum(hist) / float(total)
+
+
+def evaluate_cdf(values, cdf, points):
+    """Evaluate a CDF (as returned by the functions above) at some points.
+
+    The CDF is a step function, so this is just a lookup of the last
+    value which is at most each point.
+
+    Parameters
+    ----------
+    values, cdf : ndarray
+        The CDF, as returned by cdf_from_counts or cdf_from_matrix.
+
+    points : array-like
+        Where to evaluate it.
+
+    Returns
+    -------
+    ndarray
+        The CDF at each point.
+    """
+    positions = np.searchsorted(values, points, side='right')
+    padded = np.concatenate([[0.0], cdf])
+    return padded[positions]
+
+
+def cdf_area(values, cdf):
+    """Compute the area under a consensus CDF, as defined by Monti et al.
+
+    A = sum over i >= 1 of (values[i] - values[i-1]) * cdf[i].
+
+    Parameters
+    ----------
+    values, cdf : ndarray
+        The CDF, as returned by cdf_from_counts or cdf_from_matrix.
+
+    Returns
+    -------
+    float
+    """
+    if len(values) < 2:
+        return 0.0
+    return float(np.sum(np.diff(values) * cdf[1:]))
+
+
+def delta_area(areas):
+    """Compute the relative change in CDF area from each K to the next.
+
+    Following ConsensusClusterPlus, the delta for the smallest K is its
+    area, and the delta for every other K is
+    (A(K) - A(K')) / A(K'), where K' is the previous K.
+
+    Parameters
+    ----------
+    areas : dict
+        Maps each K to the area under its CDF (see cdf_area).
+
+    Returns
+    -------
+    dict
+        Maps each K to its delta.
+    """
+    ks = sorted(areas)
+    deltas = {}
+    for (i, k) in enumerate(ks):
+        if i == 0:
+            deltas[k] = areas[k]
+        else:
+            previous = areas[ks[i - 1]]
+            if previous == 0:
+                deltas[k] = np.inf if areas[k] > 0 else 0.0
+            else:
+                deltas[k] = (areas[k] - previous) / previous
+    return deltas
@@ -2,7 +2,10 @@
 """
 
 
+import importlib
+import os
 import sys
+import types
 # We're using pytest to run tests. It's set up so that when tests are
 # being run, pytest will set the attribute '_called_from_test' on the
 # sys module. This means we can tell whether we're inside a testing
@@ -33,3 +36,86 @@ DEBUGLVL = 4
 
 USERLVL = 1
 """User-level verbosity: less verbose, intended for the end user."""
+
+
+def effective_n_jobs(n_jobs):
+    """Translate an n_jobs param into a number of workers.
+
+    None means 1. Negative values follow the same convention as
+    joblib: -1 means all CPUs, -2 means all but one, and so on.
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    if n_jobs == 0:
+        raise ValueError('n_jobs == 0 has no meaning')
+    return n_jobs
+
+
+def is_sparse(mat):
+    """Return whether mat is a scipy.sparse matrix (or array).
+
+    Unlike scipy.sparse.issparse, this doesn't import scipy: if
+    scipy.sparse hasn't been imported yet, nothing can be an instance
+    of it.
+    """
+    module = sys.modules.get('scipy.sparse')
+    return module is not None and module.issparse(mat)
+
+
+class _LazyModule(types.ModuleType):
+    """Module type whose missing attributes are looked up in _lazy_attrs.
+
+    See lazy_attributes.
+    """
+    def __getattr__(self, name):
+        # This is only called when normal lookup fails, so once an
+        # attribute has been loaded (and stored below) it costs nothing.
+        loaders = self.__dict__.get('_lazy_attrs', {})
+        if name not in loaders:
+            raise AttributeError('module {!r} has no attribute '
+                                 '{!r}'.format(self.__name__, name))
+        value = loaders[name]()
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        names = set(self.__dict__)
+        names.update(self.__dict__.get('_lazy_attrs', {}))
+        return sorted(names)
+
+
+def lazy_attributes(module_name, loaders):
+    """Make some attributes of a module load the first time they're used.
+
+    This is how we keep heavy dependencies (scikit-learn, matplotlib)
+    from being imported until they're actually needed. Python 3.7 has
+    module-level __getattr__ for this, but we still support older
+    versions, so instead we change the class of the module object,
+    which works from Python 3.5 on.
+
+    Parameters
+    ----------
+    module_name : str
+        The __name__ of the module. It must already be in sys.modules,
+        which is the case while the module itself is being executed.
+
+    loaders : dict
+        Maps each lazy attribute name to a function with no arguments
+        which returns its value.
+    """
+    module = sys.modules[module_name]
+    module._lazy_attrs = loaders
+    module.__class__ = _LazyModule
+
+
+def import_from(module_name, name, package=__package__):
+    """Return a function which imports and returns module_name.name.
+
+    This is just a convenience for building the loaders of
+    lazy_attributes.
+    """
+    def load():
+        return getattr(importlib.import_module(module_name, package), name)
+    return load
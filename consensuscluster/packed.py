@@ -0,0 +1,340 @@
+"""Packed storage for symmetric matrices.
+
+The consensus matrix, as well as the two count matrices it is computed
+from, are symmetric. Storing them as full n-by-n arrays wastes almost
+half of the memory, which matters a lot since these matrices are by
+far the biggest things we hold on to. This module provides a
+representation which only stores the upper triangle.
+
+For really big matrices, even that is too much to hold in memory. The
+packed data can then live in a file instead, via np.memmap; see
+PackedSymmetricMatrix.memmap.
+"""
+import numpy as np
+
+_CHUNK_ELEMENTS = 1 << 22
+"""Number of entries processed at once by chunked operations.
+
+This is used for the elementwise operations on packed data, and also
+by everything else in the package which reads a big matrix a stripe of
+rows at a time. Working in chunks keeps the temporaries small, and
+when the data is memory-mapped it means we stream through the file
+instead of pulling all of it into memory at once.
+"""
+
+
+class PackedSymmetricMatrix(object):
+    """A symmetric matrix which only stores its upper triangle.
+
+    The upper triangle (including the diagonal) is stored row by row in
+    a 1-dimensional array of length n * (n + 1) / 2. That is, the array
+    holds entries (0,0), (0,1), ..., (0,n-1), (1,1), (1,2), ..., and so
+    on. Entry (i, j) with i > j is read from (j, i).
+
+    Rows, tiles or the full dense matrix can be extracted with the
+    accessor methods. Only the full-matrix accessor allocates anything
+    of size n^2.
+
+    Parameters
+    ----------
+    n : int
+        The number of rows (and columns) of the matrix.
+
+    dtype : numpy dtype, default=np.float64
+        The dtype of the entries. Ignored if data is given.
+
+    data : ndarray, default=None
+        The packed upper triangle, in the layout described above. It
+        can be an np.memmap. If None, the matrix is initialized to all
+        zeros.
+
+    Attributes
+    ----------
+    data : ndarray, shape (n * (n + 1) / 2,)
+        The packed upper triangle.
+
+    shape : tuple
+        Always (n, n).
+
+    Notes
+    -----
+    When data is an np.memmap backed by a file, pickling the matrix
+    only records the file name (after flushing the data to disk), and
+    unpickling reopens the file. This is what lets memory-mapped count
+    matrices be passed between processes cheaply.
+    """
+    def __init__(self, n, dtype=np.float64, data=None):
+        n = int(n)
+        size = n * (n + 1) // 2
+        if data is None:
+            data = np.zeros(size, dtype=dtype)
+        if data.shape != (size,):
+            raise ValueError('Packed data for a {0}x{0} matrix must have shape '
+                             '({1},), got {2}'.format(n, size, data.shape))
+        self.data = data
+        self.shape = (n, n)
+        # offsets[i] is the position in data of the diagonal entry
+        # (i, i). Row i of the upper triangle is
+        # data[offsets[i]:offsets[i] + n - i].
+        i = np.arange(n, dtype=np.int64)
+        self._offsets = i * n - i * (i - 1) // 2
+
+    @classmethod
+    def from_dense(cls, mat):
+        """Pack a dense symmetric matrix.
+
+        Only the upper triangle of mat is read; the lower triangle is
+        assumed to mirror it.
+
+        Parameters
+        ----------
+        mat : ndarray, shape (n, n)
+            The matrix to pack.
+
+        Returns
+        -------
+        PackedSymmetricMatrix
+        """
+        mat = np.asarray(mat)
+        if mat.ndim != 2 or mat.shape[0] != mat.shape[1]:
+            raise ValueError('Expected a square matrix, got shape '
+                             '{}'.format(mat.shape))
+        (rows, cols) = np.triu_indices(mat.shape[0])
+        return cls(mat.shape[0], data=np.ascontiguousarray(mat[rows, cols]))
+
+    @classmethod
+    def memmap(cls, filename, n, dtype=np.float64, mode='w+'):
+        """Create a matrix whose packed data is memory-mapped from a file.
+
+        Parameters
+        ----------
+        filename : str
+            Path of the file holding the packed data.
+
+        n : int
+            The number of rows (and columns) of the matrix.
+
+        dtype : numpy dtype, default=np.float64
+            The dtype of the entries.
+
+        mode : str, default='w+'
+            The np.memmap mode. The default creates (or overwrites) the
+            file and fills it with zeros; use 'r+' or 'r' to open an
+            existing file.
+
+        Returns
+        -------
+        PackedSymmetricMatrix
+        """
+        n = int(n)
+        data = np.memmap(filename, dtype=dtype, mode=mode,
+                         shape=(n * (n + 1) // 2,))
+        return cls(n, data=data)
+
+    @property
+    def filename(self):
+        """Path of the backing file, or None if the data is in memory."""
+        if isinstance(self.data, np.memmap):
+            return self.data.filename
+        return None
+
+    def flush(self):
+        """Write any changes to the backing file, if there is one."""
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def n(self):
+        return self.shape[0]
+
+    def _check_range(self, start, stop):
+        if not 0 <= start <= stop <= self.n:
+            raise IndexError('Invalid range [{}, {}) for a matrix with {} '
+                             'rows'.format(start, stop, self.n))
+
+    def row(self, i):
+        """Return row i of the matrix, as a 1-dimensional ndarray."""
+        return self.tile(i, i + 1, 0, self.n)[0]
+
+    def rows(self, start, stop):
+        """Return rows [start, stop) of the matrix as a dense ndarray."""
+        return self.tile(start, stop, 0, self.n)
+
+    def tile(self, row_start, row_stop, col_start, col_stop):
+        """Return the dense submatrix [row_start:row_stop, col_start:col_stop].
+
+        Returns
+        -------
+        ndarray, shape (row_stop - row_start, col_stop - col_start)
+        """
+        self._check_range(row_start, row_stop)
+        self._check_range(col_start, col_stop)
+        out = np.empty((row_stop - row_start, col_stop - col_start),
+                       dtype=self.dtype)
+        for i in range(row_start, row_stop):
+            out_row = out[i - row_start]
+            # Columns >= i are a contiguous piece of the packed row i.
+            split = min(max(i, col_start), col_stop)
+            if split < col_stop:
+                first = self._offsets[i] + split - i
+                out_row[split - col_start:] = \
+                    self.data[first:first + col_stop - split]
+            # Columns < i have to be gathered from the rows above.
+            if col_start < split:
+                cols = np.arange(col_start, split)
+                out_row[:split - col_start] = \
+                    self.data[self._offsets[cols] + i - cols]
+        return out
+
+    def take(self, rows, cols):
+        """Return the dense submatrix at the given rows and columns.
+
+        This is like mat[np.ix_(rows, cols)] for a dense matrix. The
+        indices don't need to be sorted or contiguous, which is what
+        makes it possible to read a reordered matrix without building
+        it.
+
+        Parameters
+        ----------
+        rows : array-like of int
+            The row indices.
+
+        cols : array-like of int
+            The column indices.
+
+        Returns
+        -------
+        ndarray, shape (len(rows), len(cols))
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        for indices in (rows, cols):
+            if len(indices) > 0 and (indices.min() < 0 or
+                                     indices.max() >= self.n):
+                raise IndexError('Index out of range for a matrix with {} '
+                                 'rows'.format(self.n))
+        upper = np.minimum(rows[:, np.newaxis], cols[np.newaxis, :])
+        lower = np.maximum(rows[:, np.newaxis], cols[np.newaxis, :])
+        return self.data[self._offsets[upper] + lower - upper]
+
+    def to_dense(self):
+        """Return the full matrix as a dense n-by-n ndarray."""
+        return self.tile(0, self.n, 0, self.n)
+
+    def condensed(self):
+        """Return the strict upper triangle as a 1-dimensional ndarray.
+
+        This is the "condensed" form used by scipy.spatial.distance and
+        scipy.cluster.hierarchy: the upper triangle without the
+        diagonal, row by row.
+        """
+        return np.delete(self.data, self._offsets)
+
+    def add_upper_tile(self, row_start, col_start, values):
+        """Add a tile of values onto the upper triangle in place.
+
+        values[r, c] is added onto entry (row_start + r, col_start + c)
+        whenever that entry is in the upper triangle (column >= row);
+        the rest of values is ignored. This is how the accumulation
+        code writes into packed count matrices: it only ever computes
+        tiles which lie on or above the diagonal.
+
+        Parameters
+        ----------
+        row_start : int
+            The first row to update.
+
+        col_start : int
+            The first column to update.
+
+        values : ndarray, shape (n_rows, n_cols)
+            The values to add.
+        """
+        (n_rows, n_cols) = values.shape
+        self._check_range(row_start, row_start + n_rows)
+        self._check_range(col_start, col_start + n_cols)
+        col_stop = col_start + n_cols
+        for r in range(n_rows):
+            i = row_start + r
+            first_col = max(i, col_start)
+            if first_col >= col_stop:
+                # This row of the tile is entirely below the diagonal,
+                # and so are all the rows after it.
+                break
+            first = self._offsets[i] + first_col - i
+            segment = self.data[first:first + col_stop - first_col]
+            np.add(segment, values[r, first_col - col_start:], out=segment,
+                   casting='unsafe')
+
+    def __iadd__(self, other):
+        if not isinstance(other, PackedSymmetricMatrix):
+            return NotImplemented
+        if other.shape != self.shape:
+            raise ValueError('Cannot add matrices of shapes {} and '
+                             '{}'.format(self.shape, other.shape))
+        for start in range(0, len(self.data), _CHUNK_ELEMENTS):
+            stop = start + _CHUNK_ELEMENTS
+            self.data[start:stop] += other.data[start:stop]
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The offsets are cheap to recompute.
+        del state['_offsets']
+        filename = self.filename
+        if filename is not None:
+            self.data.flush()
+            state['data'] = (filename, self.data.dtype.str)
+        return state
+
+    def __setstate__(self, state):
+        data = state.pop('data')
+        if isinstance(data, tuple):
+            (filename, dtype) = data
+            data = np.memmap(filename, dtype=np.dtype(dtype), mode='r+')
+        self.__init__(state['shape'][0], data=data)
+
+    def __repr__(self):
+        return 'PackedSymmetricMatrix(n={}, dtype={})'.format(self.n,
+                                                               self.dtype)
+
+
+def _read_rows(mat, start, stop, order=None):
+    """Read some rows of a square matrix as a dense float64 ndarray.
+
+    This is how code which streams over a matrix a stripe of rows at a
+    time reads it, no matter how the matrix is stored.
+
+    Parameters
+    ----------
+    mat : ndarray, PackedSymmetricMatrix or ConsensusRatio
+        The matrix. An ndarray can be an np.memmap. Anything which
+        isn't an ndarray must have the rows and take accessors of
+        PackedSymmetricMatrix.
+
+    start, stop : int
+        The range of rows to read.
+
+    order : ndarray or None, default=None
+        If given, read the matrix as if its rows and columns had been
+        permuted by order, i.e. return mat[order[start:stop]][:, order].
+        The permuted matrix is never built.
+
+    Returns
+    -------
+    ndarray, shape (stop - start, n)
+    """
+    if isinstance(mat, np.ndarray):
+        if order is None:
+            rows = mat[start:stop]
+        else:
+            rows = np.asarray(mat[order[start:stop]])[:, order]
+    elif order is None:
+        rows = mat.rows(start, stop)
+    else:
+        rows = mat.take(order[start:stop], order)
+    return np.asarray(rows, dtype=np.float64)
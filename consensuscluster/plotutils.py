@@ -1,25 +1,54 @@
 """Functions to help create plots.
+
+matplotlib is only imported the first time something here actually
+needs it, so the numpy-only parts of this module (like the
+downsampling) can be used without it.
 """
+import math
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from matplotlib.colors import Normalize
-from scipy.sparse import issparse
-from skimage.transform import resize  # TODO get rid of skimage dependency
 
+from ._validation import check_consensus_matrix
 from .misc import IS_TEST
+from .misc import effective_n_jobs
+from .misc import is_sparse
+from .misc import lazy_attributes
 from .misc import printif
 from .misc import (DEBUGLVL, USERLVL)
+from ._accumulate import ConsensusRatio
+from .packed import _CHUNK_ELEMENTS
+from .packed import _read_rows
+from . import tracing
 
-NOP_NORM = Normalize(0.0, 1.0)
-"""Instance of Normalize which is a no-op.
 
-Normally, to assign colors to values in the consensus matrix,
-matplotlib would rescale (normalize) the values in the matrix to be in
-[0,1], but that's not the desired behavior. We would like the values to
-simply be treated as values in [0,1] without modification, even if the
-actual minimum value is higher than 0 or the actual max is less than 1.
-The way to ensure that no normalization will be done is to provide our
-own Normalizer and make it a no-op. 
-"""
+def _make_nop_norm():
+    """Create NOP_NORM, an instance of Normalize which is a no-op.
+
+    Normally, to assign colors to values in the consensus matrix,
+    matplotlib would rescale (normalize) the values in the matrix to be
+    in [0,1], but that's not the desired behavior. We would like the
+    values to simply be treated as values in [0,1] without
+    modification, even if the actual minimum value is higher than 0 or
+    the actual max is less than 1. The way to ensure that no
+    normalization will be done is to provide our own Normalizer and
+    make it a no-op.
+
+    NOP_NORM itself is a module attribute which is created by this
+    function the first time it's accessed.
+    """
+    from matplotlib.colors import Normalize
+    return Normalize(0.0, 1.0)
+
+
+lazy_attributes(__name__, {'NOP_NORM': _make_nop_norm})
+
+
+def _nop_norm():
+    # Lazy attributes are only found through the module object, not as
+    # globals of the module's own code.
+    return sys.modules[__name__].NOP_NORM
 
 
 def _get_ax_size(ax, fig):
@@ -63,7 +92,494 @@ def _get_ax_size(ax, fig):
     return (int(width * 1.411), int(height * 1.365))
 
 
-def plot_consensus_heatmap(ordered_cmat, ax, fig, cmap, downsample, verbose):
+_DOWNSAMPLE_MODES = {
+    'mean': None,
+    'max': np.maximum,
+    'min': np.minimum
+}
+"""The modes supported by _downsample_stripes, and their reduction ufuncs.
+"""
+
+
+def _bin_weights(n, target_len):
+    """Work out how n samples are split among target_len equal bins.
+
+    Think of sample i as covering the interval [i, i+1), and bin b as
+    covering [b * n / target_len, (b+1) * n / target_len). When n is not
+    a multiple of target_len, some samples straddle the boundary
+    between two bins. Since target_len <= n, every bin is at least one
+    sample wide, so a sample overlaps at most two bins.
+
+    To keep everything in exact integer arithmetic, all lengths are
+    scaled up by target_len: each sample has total weight target_len,
+    and each bin has total weight n.
+
+    Returns
+    -------
+    bins : ndarray, shape (n,)
+        The first bin that each sample overlaps.
+
+    bin_starts : ndarray, shape (target_len,)
+        bin_starts[b] is the first sample whose first bin is b. Every
+        bin is some sample's first bin, so this is well-defined.
+
+    first_weights : ndarray, shape (n,)
+        The overlap of each sample with its first bin.
+
+    split : ndarray
+        The samples which also overlap the bin after their first one.
+        Their overlap with that bin is target_len - first_weights.
+    """
+    i = np.arange(n, dtype=np.int64)
+    bins = i * target_len // n
+    bin_starts = np.searchsorted(bins, np.arange(target_len))
+    # (bins + 1) * n is the (scaled) right edge of each sample's first
+    # bin, and (i + 1) * target_len is the right edge of the sample.
+    first_weights = np.minimum((bins + 1) * n - i * target_len, target_len)
+    split = np.flatnonzero(first_weights < target_len)
+    return bins, bin_starts, first_weights, split
+
+
+def _reduce_columns(rows, bin_starts, bins, first_weights, split, ufunc):
+    """Reduce the columns of a stripe of rows into bins.
+
+    See _downsample_stripes; ufunc is None for the mean (in which case
+    this computes weighted sums) and the reduction ufunc otherwise.
+    """
+    if ufunc is None:
+        out = np.add.reduceat(rows * first_weights, bin_starts, axis=1)
+        target_len = len(bin_starts)
+        out[:, bins[split] + 1] += \
+            rows[:, split] * (target_len - first_weights[split])
+    else:
+        out = ufunc.reduceat(rows, bin_starts, axis=1)
+        # Each bin receives at most one split sample from its left
+        # neighbor, so the fancy indexing here has no duplicates.
+        out[:, bins[split] + 1] = ufunc(out[:, bins[split] + 1],
+                                        rows[:, split])
+    return out
+
+
+def _downsample_rows(mat, row_lo, row_hi, bins, bin_starts, first_weights,
+                     split, ufunc, order):
+    """Reduce rows [row_lo, row_hi) of mat into bins; see _downsample_stripes.
+
+    The rows are read one stripe at a time. The sums (or maxes, or
+    mins) go into a new array whose first row is bin bins[row_lo], and
+    which has one extra row at the end for the last sample's share of
+    the bin after its first one. Bins which only some of their samples
+    overlap get partial results.
+
+    Returns
+    -------
+    first_bin : int
+        The bin of the first row of the result.
+
+    out : ndarray, shape (m, target_len)
+        The partial results.
+    """
+    n = mat.shape[0]
+    target_len = len(bin_starts)
+    first_bin = bins[row_lo]
+    shape = (bins[row_hi - 1] - first_bin + 2, target_len)
+    if ufunc is None:
+        out = np.zeros(shape, dtype=np.float64)
+    elif ufunc is np.maximum:
+        out = np.full(shape, -np.inf)
+    else:
+        out = np.full(shape, np.inf)
+    stripe_rows = max(_CHUNK_ELEMENTS // n, 1)
+    for start in range(row_lo, row_hi, stripe_rows):
+        stop = min(start + stripe_rows, row_hi)
+        rows = _read_rows(mat, start, stop, order)
+        reduced = _reduce_columns(rows, bin_starts, bins, first_weights,
+                                  split, ufunc)
+        # Now do the same thing to the rows of the stripe. They span
+        # one or more consecutive bins, and each bin can also receive
+        # (part of) a row from the previous stripe.
+        stripe_bins = bins[start:stop]
+        row_starts = np.flatnonzero(np.diff(stripe_bins)) + 1
+        row_starts = np.insert(row_starts, 0, 0)
+        dest = stripe_bins[row_starts] - first_bin
+        stripe_split = split[(split >= start) & (split < stop)]
+        next_bins = bins[stripe_split] + 1 - first_bin
+        if ufunc is None:
+            weights = first_weights[start:stop, np.newaxis]
+            out[dest] += np.add.reduceat(reduced * weights, row_starts,
+                                         axis=0)
+            out[next_bins] += reduced[stripe_split - start] * \
+                (target_len - first_weights[stripe_split, np.newaxis])
+        else:
+            out[dest] = ufunc(out[dest],
+                              ufunc.reduceat(reduced, row_starts, axis=0))
+            out[next_bins] = ufunc(out[next_bins],
+                                   reduced[stripe_split - start])
+    return first_bin, out
+
+
+def _downsample_stripes(mat, target_len, mode='mean', order=None,
+                        n_jobs=None):
+    """Downsample a square matrix by reducing blocks of entries.
+
+    The rows and columns are each divided into target_len equal-width
+    bins (see _bin_weights), and each entry of the output summarizes
+    the entries whose row and column fall in the corresponding pair of
+    bins. In 'mean' mode that's the overlap-weighted average, so an
+    entry which is split between two bins counts towards both in
+    proportion to its overlap. This makes the result correct for
+    non-integer ratios of n to target_len, rather than just dropping or
+    duplicating rows. In 'max' and 'min' mode, it's the max or min over
+    all entries which overlap the pair of bins at all.
+
+    The input is read one stripe of rows at a time, so apart from the
+    output, the only allocations are proportional to the stripe size.
+    With n_jobs, the output rows are split into equal ranges which are
+    computed by separate threads, each reading (only) the stripes of
+    input rows which overlap its range. The samples on the boundary of
+    two ranges are read by both.
+
+    Parameters
+    ----------
+    mat : ndarray, PackedSymmetricMatrix or ConsensusRatio
+        The square matrix to downsample, shape (n, n). It can be an
+        np.memmap.
+
+    target_len : int
+        Side length of the output. Must be at most n.
+
+    mode : {'mean', 'max', 'min'}, default='mean'
+        How to reduce each block.
+
+    order : ndarray or None, default=None
+        If given, downsample mat[order][:, order] instead of mat,
+        without ever building the reordered matrix.
+
+    n_jobs : int or None, default=None
+        The number of threads to use. None means 1; -1 means use all
+        CPUs. Each thread needs memory for its own stripe.
+
+    Returns
+    -------
+    ndarray, shape (target_len, target_len)
+    """
+    if mode not in _DOWNSAMPLE_MODES:
+        raise ValueError("mode must be one of 'mean', 'max' or 'min', got "
+                         "{}".format(mode))
+    ufunc = _DOWNSAMPLE_MODES[mode]
+    n = mat.shape[0]
+    assert 0 < target_len <= n
+    (bins, bin_starts, first_weights, split) = _bin_weights(n, target_len)
+    is_split = np.zeros(n, dtype=bool)
+    is_split[split] = True
+
+    def downsample_bins(bin_range):
+        (bin_lo, bin_hi) = bin_range
+        # Every sample which overlaps these bins: the ones which start
+        # in them, plus the one before if it reaches into them.
+        row_lo = bin_starts[bin_lo]
+        if row_lo > 0 and is_split[row_lo - 1]:
+            row_lo -= 1
+        row_hi = bin_starts[bin_hi] if bin_hi < target_len else n
+        (first_bin, partial) = _downsample_rows(
+            mat, row_lo, row_hi, bins, bin_starts, first_weights, split,
+            ufunc, order)
+        # Only these bins are complete.
+        return partial[bin_lo - first_bin:bin_hi - first_bin]
+
+    n_workers = min(effective_n_jobs(n_jobs), target_len)
+    if n_workers == 1:
+        out = downsample_bins((0, target_len))
+    else:
+        edges = np.linspace(0, target_len, n_workers + 1).astype(np.int64)
+        # numpy releases the GIL for the heavy lifting here, so threads
+        # run in parallel.
+        with ThreadPoolExecutor(n_workers) as pool:
+            out = np.concatenate(list(pool.map(downsample_bins,
+                                               zip(edges[:-1], edges[1:]))))
+    if ufunc is None:
+        # Each bin has a total (scaled) weight of n along each axis.
+        out /= float(n) * n
+    return out
+
+
+def _downsample_sparse(mat, target_len, mode='mean', order=None):
+    """Downsample a scipy.sparse matrix straight from its stored entries.
+
+    The result is the same as _downsample_stripes on the dense version
+    of mat (with the missing entries being 0), but the dense version is
+    never built: each stored entry is added into the (at most four)
+    output cells that its row and column overlap, so the work is
+    proportional to the number of stored entries. They're processed a
+    chunk of rows at a time to keep the temporaries small.
+
+    Parameters
+    ----------
+    mat : scipy.sparse matrix
+        The square matrix to downsample, shape (n, n). All of its
+        values must be non-negative.
+
+    target_len, mode, order
+        See _downsample_stripes.
+
+    Returns
+    -------
+    ndarray, shape (target_len, target_len)
+    """
+    if mode not in _DOWNSAMPLE_MODES:
+        raise ValueError("mode must be one of 'mean', 'max' or 'min', got "
+                         "{}".format(mode))
+    n = mat.shape[0]
+    assert 0 < target_len <= n
+    mat = mat.tocsr()
+    if not mat.has_canonical_format:
+        mat = mat.copy()
+        mat.sum_duplicates()
+    (bins, _, first_weights, split) = _bin_weights(n, target_len)
+    second_weights = target_len - first_weights
+    if order is not None:
+        # positions[i] is where sample i ends up after reordering.
+        positions = np.empty(n, dtype=np.int64)
+        positions[order] = np.arange(n)
+
+    n_cells = target_len * target_len
+    if mode == 'mean':
+        out = np.zeros(n_cells)
+    else:
+        # The missing entries are 0 and the stored ones are >= 0, so
+        # a cell's max is just the max of its stored entries (or 0).
+        out = np.zeros(n_cells) if mode == 'max' else np.full(n_cells, np.inf)
+        n_stored = np.zeros(n_cells, dtype=np.int64)
+    start = 0
+    while start < n:
+        # Take enough rows for about _CHUNK_ELEMENTS stored entries,
+        # but always at least one row.
+        stop = int(np.searchsorted(mat.indptr,
+                                   mat.indptr[start] + _CHUNK_ELEMENTS,
+                                   side='right')) - 1
+        stop = min(max(stop, start + 1), n)
+        chunk = mat[start:stop].tocoo()
+        rows = chunk.row.astype(np.int64) + start
+        cols = chunk.col.astype(np.int64)
+        values = chunk.data.astype(np.float64)
+        start = stop
+        if order is not None:
+            rows = positions[rows]
+            cols = positions[cols]
+        # Each sample overlaps its first bin, and maybe the next one.
+        row_parts = ((bins[rows], first_weights[rows]),
+                     (bins[rows] + 1, second_weights[rows]))
+        col_parts = ((bins[cols], first_weights[cols]),
+                     (bins[cols] + 1, second_weights[cols]))
+        for (row_bins, row_weights) in row_parts:
+            for (col_bins, col_weights) in col_parts:
+                weights = row_weights * col_weights
+                keep = weights > 0
+                cells = row_bins[keep] * target_len + col_bins[keep]
+                if mode == 'mean':
+                    out += np.bincount(cells,
+                                       weights=values[keep] * weights[keep],
+                                       minlength=n_cells)
+                else:
+                    _DOWNSAMPLE_MODES[mode].at(out, cells, values[keep])
+                    n_stored += np.bincount(cells, minlength=n_cells)
+    if mode == 'mean':
+        # As in _downsample_stripes, the weights are scaled by n along
+        # each axis.
+        out /= float(n) * n
+    elif mode == 'min':
+        # A cell's min is 0 unless every entry overlapping it is stored.
+        overlapping = np.bincount(bins, minlength=target_len) + \
+            np.bincount(bins[split] + 1, minlength=target_len)
+        full = n_stored == np.outer(overlapping, overlapping).ravel()
+        out[~full] = 0.0
+    return out.reshape(target_len, target_len)
+
+
+def _full_matrix(mat, order):
+    """Return the whole (reordered) matrix in a form imshow can take."""
+    if isinstance(mat, np.ndarray):
+        if order is None:
+            return mat
+        return np.asarray(mat)[np.ix_(order, order)]
+    if is_sparse(mat):
+        if order is not None:
+            mat = mat.tocsr()[order][:, order]
+        return mat.toarray()
+    # imshow needs the real thing.
+    if order is None:
+        return mat.to_dense()
+    return mat.take(order, order)
+
+
+def _downsample_to(mat, target_len, mode, order, n_jobs=None):
+    """Downsample mat to target_len, or return it whole if it's smaller.
+    """
+    n_samples = mat.shape[0]
+    if n_samples <= target_len:
+        return _full_matrix(mat, order)
+    # This reads the matrix one stripe of rows at a time, so it works
+    # the same way whether the matrix is an in-memory ndarray, a
+    # PackedSymmetricMatrix, a ConsensusRatio or an np.memmap.
+    with tracing.span('downsample', n=n_samples, target_len=target_len):
+        if is_sparse(mat):
+            # Rasterize the stored entries directly; there's nothing to
+            # gain from reading zeros.
+            return _downsample_sparse(mat, target_len, mode, order)
+        return _downsample_stripes(mat, target_len, mode, order, n_jobs)
+
+
+def _prepare_cmat(ordered_cmat, order, check_input, verbose):
+    """Turn a (connectivity, indicator) tuple into a ConsensusRatio and
+    validate the matrix and order according to check_input.
+    """
+    if isinstance(ordered_cmat, tuple):
+        (connectivity, indicator) = ordered_cmat
+        ordered_cmat = ConsensusRatio(connectivity, indicator)
+    if IS_TEST and check_input == 'none':
+        # Tests always get the thorough check.
+        check_input = 'full'
+    if check_input != 'none':
+        printif(
+            verbose >= DEBUGLVL,
+            'Now validating ordered_cmat (check_input={})'.format(check_input)
+        )
+    with tracing.span('check_input', mode=check_input):
+        check_consensus_matrix(ordered_cmat, check_input,
+                               name='ordered_cmat')
+        if order is not None and check_input != 'none':
+            if not np.array_equal(np.sort(order),
+                                  np.arange(ordered_cmat.shape[0])):
+                raise ValueError('order must be a permutation of the '
+                                 'samples')
+    return ordered_cmat
+
+
+def _colormap(cmap):
+    """Look up a Colormap the same way imshow's cmap param does."""
+    from matplotlib.cm import ScalarMappable
+    return ScalarMappable(cmap=cmap).get_cmap()
+
+
+def _colorize(values, cmap):
+    """Color a matrix of consensus values through a lookup table.
+
+    This gives the same colors as imshow does with NOP_NORM (i.e. the
+    values are used as they are, without rescaling), but skips
+    matplotlib's general-purpose pipeline: the values are quantized to
+    the index of their color (a uint8, for the usual colormaps with
+    256 colors) and the colors are then looked up in a table with one
+    RGBA entry per color.
+
+    Parameters
+    ----------
+    values : ndarray, shape (m, m)
+        Values in [0,1].
+
+    cmap : str or Colormap
+        As for plot_consensus_heatmap.
+
+    Returns
+    -------
+    indices : ndarray of unsigned int, shape (m, m)
+        The index of each value's color in lut.
+
+    lut : ndarray of uint8, shape (N, 4)
+        The RGBA color table, where N is the number of colors in cmap.
+    """
+    lut = _lut(cmap)
+    return _quantize(values, len(lut)), lut
+
+
+def _lut(cmap):
+    """Return the (N, 4) uint8 RGBA color table of a colormap."""
+    cmap = _colormap(cmap)
+    return cmap(np.arange(cmap.N), bytes=True)
+
+
+def _quantize(values, n_colors):
+    """Map values in [0,1] to the indices of their colors; see _colorize.
+    """
+    dtype = np.uint8 if n_colors <= 256 else np.min_scalar_type(n_colors)
+    # This is how Colormap.__call__ maps floats to colors: value v gets
+    # color int(v * N), except that 1.0 gets the last color.
+    scaled = np.multiply(values, n_colors, dtype=np.float64)
+    np.minimum(scaled, n_colors - 1, out=scaled)
+    return scaled.astype(dtype)
+
+
+def render_consensus_heatmap(ordered_cmat, size, cmap, filename=None,
+                             downsample_mode='mean', order=None,
+                             check_input='none', verbose=0, n_jobs=None):
+    """Render the consensus heatmap straight to an RGBA image.
+
+    This draws the same picture as plot_consensus_heatmap, but without
+    going through imshow at all: the consensus matrix is downsampled to
+    exactly size-by-size values (or, if it is smaller than that,
+    blown up by repeating values), the values are quantized to color
+    indices, and the colors are looked up in a table. The colors are
+    exactly those imshow would use with NOP_NORM. Besides the reading
+    of the matrix (see plot_consensus_heatmap), the only memory needed
+    is a few size-by-size arrays, which makes this the fastest way to
+    produce many heatmaps, e.g. as PNG files in a batch job.
+
+    Parameters
+    ----------
+    ordered_cmat : ndarray, PackedSymmetricMatrix, ConsensusRatio, tuple or sparse matrix
+        The consensus matrix to plot. See plot_consensus_heatmap.
+
+    size : positive int
+        The width and height of the image, in pixels.
+
+    cmap : str or Colormap
+        The colormap. See plot_consensus_heatmap.
+
+    filename : str, file-like or None, default=None
+        If given, the image is also written there as a PNG.
+
+    downsample_mode, order, check_input, n_jobs
+        See plot_consensus_heatmap.
+
+    verbose : non-negative int, default=0
+        Verbosity level of print statements. If this is 0, no output
+        will be produced.
+
+    Returns
+    -------
+    ndarray of uint8, shape (size, size, 4)
+        The RGBA image, with the first row at the top. It can be shown
+        with imshow (which then has no colormapping left to do), or
+        saved with matplotlib.pyplot.imsave.
+    """
+    printif(verbose >= DEBUGLVL, 'Entering render_consensus_heatmap')
+    if not isinstance(size, (int, np.integer)) or size < 1:
+        raise ValueError('size must be a positive int, got {}'.format(size))
+    ordered_cmat = _prepare_cmat(ordered_cmat, order, check_input, verbose)
+    n_samples = ordered_cmat.shape[0]
+    if n_samples == 0:
+        raise ValueError('Cannot render an empty consensus matrix')
+    values = _downsample_to(ordered_cmat, size, downsample_mode, order,
+                            n_jobs)
+    with tracing.span('colorize', side_len=size):
+        (indices, lut) = _colorize(values, cmap)
+        if n_samples < size:
+            # Nearest-neighbor upsampling; cheaper on the indices than
+            # on the colors.
+            nearest = np.arange(size) * n_samples // size
+            indices = indices[nearest][:, nearest]
+        rgba = lut[indices]
+    if filename is not None:
+        printif(verbose >= DEBUGLVL, 'Now writing the PNG')
+        from matplotlib.image import imsave
+        with tracing.span('write_png', side_len=size):
+            imsave(filename, rgba, format='png')
+    tracing.sample_memory('render_consensus_heatmap')
+    printif(verbose >= DEBUGLVL, 'Now exiting render_consensus_heatmap')
+    return rgba
+
+
+def plot_consensus_heatmap(ordered_cmat, ax, fig, cmap, downsample, verbose,
+                           downsample_mode='mean', order=None,
+                           check_input='none', rasterize=False, n_jobs=None):
     """Plot the given consensus matrix as a heatmap.
 
     This function plots the consensus heatmap onto the given Axes. The
@@ -84,15 +600,32 @@ def plot_consensus_heatmap(ordered_cmat, ax, fig, cmap, downsample, verbose):
     computations on it at plotting-time. To deal with this, we can
     downsample the consensus matrix before passing it to imshow. This
     just involves creating a smaller matrix that would look about the
-    same if plot, then plotting the smaller matrix.
+    same if plot, then plotting the smaller matrix. The downsampling
+    reads the consensus matrix a stripe of rows at a time, so besides
+    the (small) downsampled matrix it needs very little extra memory.
+    What's left of imshow's overhead can be avoided with rasterize,
+    which hands imshow an image whose colors are already computed.
 
     Parameters
     ----------
-    ordered_cmat : ndarray
+    ordered_cmat : ndarray, PackedSymmetricMatrix, ConsensusRatio or tuple
         This is the consensus matrix to plot. Must be a symmetric
-        2-dimensional ndarray with values between 0 and 1. The values
-        should have been reordered to group samples in the same cluster
-        together.
+        2-dimensional ndarray (or a PackedSymmetricMatrix) with values
+        between 0 and 1. The values should have been reordered to group
+        samples in the same cluster together. It can also be an
+        np.memmap; if downsample is True, a memory-mapped or packed
+        matrix is never loaded into memory as a whole. Instead of the
+        consensus matrix itself, you can also pass the counts it is
+        computed from, either as a ConsensusRatio or as a
+        (connectivity, indicator) tuple; the consensus values are then
+        computed one stripe at a time as they're plotted. Finally, it
+        can be a scipy.sparse matrix, such as the thresholded consensus
+        matrices from consensuscluster.sparse.threshold_consensus; when
+        downsampling, it is rasterized straight from its stored
+        entries. The consensus_matrices of results loaded with
+        consensuscluster.results.load_results are ConsensusRatio
+        objects over memory-mapped counts, so they can be passed
+        straight in, with their orders_by_k as order.
 
     ax : matplotlib Axes object
         The Axes onto which the heatmap will be drawn.
@@ -118,6 +651,46 @@ def plot_consensus_heatmap(ordered_cmat, ax, fig, cmap, downsample, verbose):
         Verbosity level of print statements. If this is 0, no output
         will be produced. If >= 1, some print statements will trigger.
 
+    downsample_mode: {'mean', 'max', 'min'}, default='mean'
+        How each block of the consensus matrix is summarized when
+        downsampling. 'mean' gives the most faithful picture; 'max'
+        and 'min' make sure that small blocks of high (or low)
+        consensus don't get averaged away.
+
+    order: ndarray or None, default=None
+        If given, ordered_cmat doesn't need to be reordered already:
+        the heatmap shows ordered_cmat[order][:, order] instead. When
+        downsampling, the reordering is done on the fly as the matrix
+        is read, so no reordered copy of the matrix is ever made. See
+        consensuscluster.ordering.consensus_order for a fast way to
+        compute an order from the cluster labels.
+
+    check_input: {'none', 'sampled', 'full'}, default='none'
+        How thoroughly to check that ordered_cmat is square, symmetric
+        and in [0,1] before plotting it. 'full' checks every entry, one
+        tile at a time, so it needs no extra memory to speak of but
+        does read the whole matrix (twice). 'sampled' spot-checks
+        random tiles, which takes O(n) time and is cheap enough to
+        always leave on. 'none' only checks the type and shape. When
+        running under pytest, 'none' is upgraded to 'full'.
+
+    rasterize: boolean, default=False
+        If True, the (possibly downsampled) matrix is colored here,
+        through a lookup table, and imshow gets an RGBA image instead
+        of the values. That skips most of the work imshow does at
+        draw time, which is where most of its time and memory goes.
+        When downsampling, the matrix is then downsampled all the way
+        to the size of the Axes in pixels. The returned image still
+        carries cmap and NOP_NORM, so colorbars work as usual. To skip
+        imshow entirely, see render_consensus_heatmap.
+
+    n_jobs: int or None, default=None
+        The number of threads used for downsampling. None means 1; -1
+        means use all CPUs. Each thread reduces its own range of rows
+        of the output, reading the rows of the matrix that overlap it
+        one stripe at a time, so each needs memory for a stripe (32MB).
+        Sparse matrices are always downsampled by a single thread.
+
     Returns
     -------
     matplotlib AxesImage object
@@ -128,32 +701,13 @@ def plot_consensus_heatmap(ordered_cmat, ax, fig, cmap, downsample, verbose):
         'Entering plot_consensus_heatmap'
     )
     assert isinstance(verbose, int)
-    if IS_TEST:
-        printif(
-            verbose >= DEBUGLVL,
-            'IS_TEST is true, so now validating ordered_cmat'
-        )
-        # We want to check that ordered_cmat is:
-        # * an ndarray
-        # * 2D
-        # * in [0,1]
-        # * symmetric
-        assert isinstance(ordered_cmat, np.ndarray)
-        assert not issparse(ordered_cmat)
-        assert ordered_cmat.ndim == 2
-        assert np.all(
-            np.logical_and(
-                ordered_cmat >= 0.0,
-                ordered_cmat <= 1.0
-            )
-        )
-        assert np.array_equal(ordered_cmat, ordered_cmat.T)  # check symmetric
+    ordered_cmat = _prepare_cmat(ordered_cmat, order, check_input, verbose)
 
     # Next, deal with downsampling and interpolation.
     (width, height) = _get_ax_size(ax, fig)
     assert width == height  # The Axes must be square.
     if not downsample:
-        mat_to_plot = ordered_cmat
+        mat_to_plot = _full_matrix(ordered_cmat, order)
     else:
         # Here, we will downsample the consensus matrix before passing
         # it to imshow. This is to reduce imshow's memory overhead.
@@ -175,11 +729,15 @@ def plot_consensus_heatmap(ordered_cmat, ax, fig, cmap, downsample, verbose):
         # four times the number of pixels in the Axes.
         n_samples = ordered_cmat.shape[0]
         target_len = 2 * width
-        if n_samples <= target_len:
-            mat_to_plot = ordered_cmat
-        else:
-            mat_to_plot = resize(ordered_cmat, (target_len, target_len))  # TODO choose mode
-            assert mat_to_plot.shape == (target_len, target_len)
+        if rasterize:
+            # The colors we compute are final, so there's no point in
+            # giving imshow more values than the Axes has pixels; box
+            # averaging straight down to the pixels is also more
+            # faithful than letting imshow pick the nearest values.
+            target_len = max(int(round(ax.get_window_extent().width)), 1)
+        mat_to_plot = _downsample_to(ordered_cmat, target_len,
+                                     downsample_mode, order, n_jobs)
+        assert mat_to_plot.shape == (min(n_samples, target_len),) * 2
     # The imshow function has an 'interpolation' parameter which
     # determines the algorithm that will be used for downsampling or
     # upsampling when rendering the image. This is IN ADDITION TO
@@ -204,13 +762,240 @@ def plot_consensus_heatmap(ordered_cmat, ax, fig, cmap, downsample, verbose):
     else:
         interpolation = 'nearest'
 
-    out = ax.imshow(
-        mat_to_plot,
-        cmap=cmap,
-        norm=NOP_NORM,
-        aspect='equal',
-        interpolation=interpolation,
-        origin='upper'
-    )  # TODO resample param
+    if rasterize:
+        with tracing.span('colorize', side_len=side_len):
+            (indices, lut) = _colorize(mat_to_plot, cmap)
+            mat_to_plot = lut[indices]
+    with tracing.span('imshow', side_len=side_len):
+        out = ax.imshow(
+            mat_to_plot,
+            cmap=cmap,
+            norm=_nop_norm(),
+            aspect='equal',
+            interpolation=interpolation,
+            origin='upper'
+        )  # TODO resample param
+    tracing.sample_memory('plot_consensus_heatmap')
     printif(verbose >= DEBUGLVL, 'Now exiting plot_consensus_heatmap')
     return out
+
+
+def _grid_geometry(fig, n_panels, n_cols):
+    """Lay out n_panels square Axes on fig, in a grid with n_cols columns.
+
+    Each cell of the grid gets a square Axes as big as possible, leaving
+    room for a title above it. All positions and sizes are rounded to
+    whole pixels, so that an image with side_len pixels fills an Axes
+    exactly.
+
+    Returns
+    -------
+    side_len : int
+        The side length of every Axes, in pixels.
+
+    rects : list of tuple
+        The [left, bottom, width, height] of each Axes (in the
+        fractions of the figure that add_axes expects), row by row.
+    """
+    from matplotlib import rcParams
+    from matplotlib.font_manager import FontProperties
+    n_rows = int(math.ceil(n_panels / float(n_cols)))
+    (fig_width, fig_height) = fig.get_size_inches() * fig.dpi
+    cell_width = fig_width / n_cols
+    cell_height = fig_height / n_rows
+    title_points = FontProperties(
+        size=rcParams['axes.titlesize']).get_size_in_points()
+    # Leave twice the font size for the title (and its padding).
+    title_height = 2 * title_points * fig.dpi / 72.0
+    margin = .05 * min(cell_width, cell_height)
+    side_len = int(min(cell_width - 2 * margin,
+                       cell_height - title_height - 2 * margin))
+    if side_len < 1:
+        raise ValueError('The figure is too small to hold {} heatmaps in '
+                         '{} columns'.format(n_panels, n_cols))
+    rects = []
+    for panel in range(n_panels):
+        (row, col) = divmod(panel, n_cols)
+        left = round(col * cell_width + (cell_width - side_len) / 2.0)
+        # Rows go down from the top, the figure's y axis goes up.
+        bottom = round(fig_height - (row + 1) * cell_height + margin)
+        rects.append((left / fig_width, bottom / fig_height,
+                      side_len / fig_width, side_len / fig_height))
+    return side_len, rects
+
+
+def plot_consensus_grid(consensus_matrices, fig, cmap, verbose, orders=None,
+                        n_cols=None, downsample_mode='mean',
+                        check_input='none', n_jobs=None):
+    """Plot the consensus heatmap for every K in a grid on one figure.
+
+    This is the usual overview for choosing K. Compared with calling
+    plot_consensus_heatmap once per K, the layout is worked out once
+    for all the panels, all the matrices are downsampled concurrently
+    (straight to the size of their Axes in pixels), and every panel is
+    colored through the same color table and given to imshow as a
+    finished RGBA image, as with plot_consensus_heatmap's rasterize.
+
+    Parameters
+    ----------
+    consensus_matrices : dict
+        Maps each K to its consensus matrix, in any of the forms
+        accepted by plot_consensus_heatmap. This is typically the
+        consensus_matrices_ attribute of a fitted ConsensusCluster.
+        The panels are in increasing order of K.
+
+    fig : matplotlib Figure object
+        The (empty) Figure on which to draw. Its size determines the
+        size of the panels.
+
+    cmap : str or Colormap
+        The colormap. See plot_consensus_heatmap.
+
+    verbose : non-negative int
+        Verbosity level of print statements. If this is 0, no output
+        will be produced.
+
+    orders : dict or None, default=None
+        If given, maps each K to the order in which to show the
+        samples, e.g. as computed by
+        consensuscluster.ordering.consensus_order from the labels for
+        that K. See the order param of plot_consensus_heatmap. If None,
+        every matrix is shown as it is, which only makes sense if it
+        has already been reordered.
+
+    n_cols : int or None, default=None
+        The number of columns of the grid. If None, the grid is as
+        close to square as possible.
+
+    downsample_mode, check_input
+        See plot_consensus_heatmap.
+
+    n_jobs : int or None, default=None
+        The number of threads used to downsample the matrices. None
+        means 1; -1 means use all CPUs.
+
+    Returns
+    -------
+    dict
+        Maps each K to the matplotlib AxesImage of its panel. The Axes
+        are available as the images' axes attribute.
+    """
+    printif(verbose >= DEBUGLVL, 'Entering plot_consensus_grid')
+    ks = sorted(consensus_matrices)
+    if not ks:
+        raise ValueError('consensus_matrices must not be empty')
+    if orders is None:
+        orders = {}
+    if n_cols is None:
+        n_cols = int(math.ceil(math.sqrt(len(ks))))
+    if n_cols < 1:
+        raise ValueError('n_cols must be positive, got {}'.format(n_cols))
+    n_cols = min(n_cols, len(ks))
+    (side_len, rects) = _grid_geometry(fig, len(ks), n_cols)
+    printif(verbose >= DEBUGLVL,
+            'Each panel is {} pixels wide'.format(side_len))
+    mats = [_prepare_cmat(consensus_matrices[k], orders.get(k), check_input,
+                          verbose) for k in ks]
+
+    def downsample(i):
+        return _downsample_to(mats[i], side_len, downsample_mode,
+                              orders.get(ks[i]))
+
+    n_workers = min(effective_n_jobs(n_jobs), len(ks))
+    with tracing.span('downsample_grid', panels=len(ks), workers=n_workers):
+        if n_workers == 1:
+            values = [downsample(i) for i in range(len(ks))]
+        else:
+            # The downsampling spends most of its time in numpy, which
+            # releases the GIL, so threads are enough.
+            with ThreadPoolExecutor(n_workers) as pool:
+                values = list(pool.map(downsample, range(len(ks))))
+    lut = _lut(cmap)
+    images = {}
+    for (k, rect, mat) in zip(ks, rects, values):
+        ax = fig.add_axes(rect)
+        with tracing.span('colorize', side_len=mat.shape[0]):
+            rgba = lut[_quantize(mat, len(lut))]
+        with tracing.span('imshow', side_len=mat.shape[0]):
+            images[k] = ax.imshow(rgba, cmap=cmap, norm=_nop_norm(),
+                                  aspect='equal', origin='upper',
+                                  interpolation='nearest')
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.set_title('K={}'.format(k))
+    tracing.sample_memory('plot_consensus_grid')
+    printif(verbose >= DEBUGLVL, 'Now exiting plot_consensus_grid')
+    return images
+
+
+def plot_cdf(cdfs, ax, verbose):
+    """Plot the consensus CDF for each K as a step curve.
+
+    This is the standard plot used to choose K: the CDF for the "right"
+    K is the last one to show a big jump in the area under it. The CDFs
+    can be computed with consensuscluster.metrics.cdf_from_counts or
+    consensuscluster.metrics.cdf_from_matrix.
+
+    Parameters
+    ----------
+    cdfs : dict
+        Maps each K to a (values, cdf) pair, as returned by the
+        functions in consensuscluster.metrics.
+
+    ax : matplotlib Axes object
+        The Axes onto which the curves will be drawn.
+
+    verbose: non-negative int
+        Verbosity level of print statements. If this is 0, no output
+        will be produced.
+
+    Returns
+    -------
+    list of matplotlib Line2D objects
+        One line per K, in increasing order of K.
+    """
+    printif(verbose >= DEBUGLVL, 'Entering plot_cdf')
+    lines = []
+    for k in sorted(cdfs):
+        (values, cdf) = cdfs[k]
+        # The CDF is 0 to the left of the smallest value and stays at
+        # its last value up to 1.
+        x = np.concatenate([[0.0], values, [1.0]])
+        y = np.concatenate([[0.0], cdf, cdf[-1:]])
+        (line,) = ax.step(x, y, where='post', label='K={}'.format(k))
+        lines.append(line)
+    ax.set_xlim(0.0, 1.0)
+    ax.set_ylim(0.0, 1.0)
+    ax.set_xlabel('Consensus')
+    ax.set_ylabel('CDF')
+    ax.legend()
+    return lines
+
+
+def plot_delta_area(deltas, ax, verbose):
+    """Plot the relative change in CDF area against K.
+
+    Parameters
+    ----------
+    deltas : dict
+        Maps each K to its delta, as returned by
+        consensuscluster.metrics.delta_area.
+
+    ax : matplotlib Axes object
+        The Axes onto which the curve will be drawn.
+
+    verbose: non-negative int
+        Verbosity level of print statements. If this is 0, no output
+        will be produced.
+
+    Returns
+    -------
+    matplotlib Line2D object
+    """
+    printif(verbose >= DEBUGLVL, 'Entering plot_delta_area')
+    ks = sorted(deltas)
+    (line,) = ax.plot(ks, [deltas[k] for k in ks], marker='o')
+    ax.set_xticks(ks)
+    ax.set_xlabel('K')
+    ax.set_ylabel('Relative change in area under CDF')
+    return line
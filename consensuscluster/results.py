@@ -0,0 +1,232 @@
+"""Saving the results of a fit, and loading them back without a refit.
+
+Pickling a fitted ConsensusCluster writes every consensus matrix out
+as a full float64 array and reads all of them back into memory when
+it's unpickled. For re-plotting and re-analysing results, none of that
+is needed: the consensus values are just ratios of the (compact,
+integer) counts, and everything else worth keeping is tiny by
+comparison.
+
+save_results writes a directory holding
+
+* results.json, the metadata: the format version, the number of
+  samples and resamples, the values of K, the area under each CDF and
+  the delta areas, and the name of every other file;
+* the indicator counts and the connectivity counts for each K, packed
+  (only the upper triangle, row by row; see PackedSymmetricMatrix) in
+  their integer dtype, as .npy files;
+* the labels, the consensus_order of the samples, and the exact CDF
+  (see metrics.cdf_from_counts) for each K, as .npy files.
+
+load_results memory-maps all of the .npy files, so loading takes no
+time and no memory however big the matrices are, and only the parts
+which are actually read are ever paged in. The consensus matrices it
+returns are ConsensusRatio objects over the memory-mapped counts, which
+plot_consensus_heatmap (and everything else in this package) reads one
+stripe at a time.
+"""
+import json
+import os
+
+import numpy as np
+
+from ._accumulate import ConsensusRatio
+from .metrics import cdf_area
+from .metrics import cdf_from_counts
+from .metrics import delta_area
+from .ordering import consensus_order
+from .packed import PackedSymmetricMatrix
+from .packed import _CHUNK_ELEMENTS
+from ._version import __version__
+from . import tracing
+
+FORMAT_VERSION = 1
+"""Version of the result format. Bumped on incompatible changes."""
+
+_META_FILENAME = 'results.json'
+
+
+def _save_packed(path, counts):
+    """Write a count matrix to path as packed data in a .npy file.
+
+    The file is written through a memory map, one chunk (or, for a
+    dense matrix, one row) at a time, so no copy of the counts is made.
+    """
+    n = counts.shape[0]
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=counts.dtype,
+                                    shape=(n * (n + 1) // 2,))
+    if isinstance(counts, PackedSymmetricMatrix):
+        for start in range(0, len(out), _CHUNK_ELEMENTS):
+            stop = start + _CHUNK_ELEMENTS
+            out[start:stop] = counts.data[start:stop]
+    else:
+        offsets = PackedSymmetricMatrix(n, data=out)._offsets
+        for i in range(n):
+            out[offsets[i]:offsets[i] + n - i] = counts[i, i:]
+    out.flush()
+
+
+def save_results(estimator, directory, max_block_size=500):
+    """Save the results of a fitted ConsensusCluster to a directory.
+
+    See the module docstring for what's saved. The directory is created
+    if needed, and results already in it are overwritten. results.json
+    is written last, so the directory only looks complete once it is.
+
+    Parameters
+    ----------
+    estimator : ConsensusCluster
+        A fitted estimator. Its storage doesn't matter; the counts are
+        always saved packed.
+
+    directory : str
+        Where to save the results.
+
+    max_block_size : int, default=500
+        Passed to consensus_order when computing the orders.
+    """
+    if not hasattr(estimator, 'labels_by_k_'):
+        raise ValueError('The estimator must be fitted before its results '
+                         'can be saved')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    k_values = sorted(estimator.connectivities_)
+    indicator = estimator.indicator_
+    files = {'indicator': 'indicator.npy'}
+    with tracing.span('save_results', n=indicator.shape[0]):
+        _save_packed(os.path.join(directory, files['indicator']), indicator)
+        areas = {}
+        for k in k_values:
+            connectivity = estimator.connectivities_[k]
+            labels = estimator.labels_by_k_[k]
+            (values, cdf) = cdf_from_counts(connectivity, indicator)
+            areas[k] = cdf_area(values, cdf)
+            order = consensus_order(ConsensusRatio(connectivity, indicator),
+                                    labels, max_block_size)
+            arrays = [('connectivity', None), ('labels', labels),
+                      ('order', order), ('cdf_values', values), ('cdf', cdf)]
+            for (name, array) in arrays:
+                key = '{}-k{}'.format(name, k)
+                files[key] = key + '.npy'
+                path = os.path.join(directory, files[key])
+                if array is None:
+                    _save_packed(path, connectivity)
+                else:
+                    np.save(path, array)
+        deltas = delta_area(areas)
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'consensuscluster_version': __version__,
+            'n_samples': int(indicator.shape[0]),
+            'n_resamples': int(estimator.n_resamples_),
+            'n_clusters': int(estimator.n_clusters),
+            'k_values': [int(k) for k in k_values],
+            'count_dtype': np.dtype(indicator.dtype).name,
+            'areas': dict((str(k), areas[k]) for k in k_values),
+            'delta_areas': dict((str(k), float(deltas[k]))
+                                for k in k_values),
+            'files': files,
+        }
+        tmp_path = os.path.join(directory, _META_FILENAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, os.path.join(directory, _META_FILENAME))
+
+
+class ConsensusResults(object):
+    """The results of a fit, as loaded by load_results.
+
+    Every array is memory-mapped (read-only) from its file.
+
+    Attributes
+    ----------
+    meta : dict
+        The contents of results.json.
+
+    n_clusters : int
+        The estimator's n_clusters.
+
+    n_resamples : int
+        The number of resamples the counts are from.
+
+    connectivities : dict
+        Maps each K to its connectivity counts, a
+        PackedSymmetricMatrix.
+
+    indicator : PackedSymmetricMatrix
+        The indicator counts.
+
+    consensus_matrices : dict
+        Maps each K to its consensus matrix, a ConsensusRatio over the
+        counts. Pass one to plot_consensus_heatmap along with
+        order=orders_by_k[k], or all of them to plot_consensus_grid
+        along with orders=orders_by_k.
+
+    labels_by_k : dict
+        Maps each K to the final cluster labels.
+
+    orders_by_k : dict
+        Maps each K to the consensus_order of the samples.
+
+    cdfs : dict
+        Maps each K to its (values, cdf) pair, as returned by
+        metrics.cdf_from_counts. Can be passed to plot_cdf.
+
+    areas : dict
+        Maps each K to the area under its CDF.
+
+    delta_areas : dict
+        Maps each K to its delta area. Can be passed to
+        plot_delta_area.
+    """
+    def __init__(self, directory, meta):
+        def load(key):
+            return np.load(os.path.join(directory, meta['files'][key]),
+                           mmap_mode='r')
+
+        def packed(key):
+            return PackedSymmetricMatrix(meta['n_samples'], data=load(key))
+
+        k_values = meta['k_values']
+        self.meta = meta
+        self.n_clusters = meta['n_clusters']
+        self.n_resamples = meta['n_resamples']
+        self.indicator = packed('indicator')
+        self.connectivities = {}
+        self.consensus_matrices = {}
+        self.labels_by_k = {}
+        self.orders_by_k = {}
+        self.cdfs = {}
+        for k in k_values:
+            self.connectivities[k] = packed('connectivity-k{}'.format(k))
+            self.consensus_matrices[k] = ConsensusRatio(
+                self.connectivities[k], self.indicator)
+            self.labels_by_k[k] = load('labels-k{}'.format(k))
+            self.orders_by_k[k] = load('order-k{}'.format(k))
+            self.cdfs[k] = (load('cdf_values-k{}'.format(k)),
+                            load('cdf-k{}'.format(k)))
+        self.areas = dict((k, meta['areas'][str(k)]) for k in k_values)
+        self.delta_areas = dict((k, meta['delta_areas'][str(k)])
+                                for k in k_values)
+
+
+def load_results(directory):
+    """Load results saved by save_results, memory-mapping every array.
+
+    Parameters
+    ----------
+    directory : str
+        The directory passed to save_results.
+
+    Returns
+    -------
+    ConsensusResults
+    """
+    with open(os.path.join(directory, _META_FILENAME)) as f:
+        meta = json.load(f)
+    if meta.get('format_version') != FORMAT_VERSION:
+        raise ValueError('The results in {} have format version {}, but '
+                         'only version {} can be read'.format(
+                             directory, meta.get('format_version'),
+                             FORMAT_VERSION))
+    return ConsensusResults(directory, meta)
@@ -0,0 +1,215 @@
+"""Data which is too big to load into memory.
+
+ConsensusCluster only ever needs the rows of X in one resample at a
+time, so X doesn't have to be an in-memory array. Wrap an on-disk
+array (e.g. an h5py Dataset or an np.memmap) in an ArraySource and pass
+that to fit instead: each resample then reads only the rows it draws,
+and everything else which needs to look at all of X (checking it, and
+computing the distances for ConsensusCluster's precompute param)
+streams over it a chunk of rows at a time. A bare np.memmap is wrapped
+automatically.
+
+fit also accepts an iterator (e.g. a generator) of chunks of rows,
+which is written to a memory-mapped file by spill_chunks first, since
+resampling needs random access to the rows.
+"""
+import mmap
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+from .packed import _CHUNK_ELEMENTS
+
+
+def _open_memmap(filename, dtype, shape, offset, order):
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape,
+                     offset=offset, order=order)
+
+
+def _memmap_args(data):
+    """Return the _open_memmap args which reopen data read-only.
+
+    None if data isn't an np.memmap of a whole file (rather than a
+    slice of one), which can't be reopened from its filename.
+    """
+    if not (isinstance(data, np.memmap) and isinstance(data.base, mmap.mmap)):
+        return None
+    order = 'F' if data.flags.f_contiguous and \
+        not data.flags.c_contiguous else 'C'
+    return (data.filename, data.dtype.str, data.shape, data.offset, order)
+
+
+class _SharedMemmap(np.memmap):
+    """An np.memmap which pickles as its filename, like ArraySource."""
+    def __reduce__(self):
+        return (_open_memmap, self._reopen_args)
+
+
+def _shared(data):
+    """Return data, as something which pickles as its filename if it's
+    an np.memmap of a whole file.
+
+    The unpickled copy is a read-only np.memmap of the same file, so
+    the file has to be flushed first.
+    """
+    args = _memmap_args(data)
+    if args is None:
+        return data
+    shared = data.view(_SharedMemmap)
+    shared._reopen_args = args
+    return shared
+
+
+class ArraySource(object):
+    """A 2-D array whose rows are read on demand.
+
+    Parameters
+    ----------
+    data : array-like
+        Anything with a 2-D shape which supports data[start:stop] and
+        data[indices] (for a sorted ndarray of row indices), each
+        returning an array of the rows. That includes h5py Datasets,
+        zarr arrays and np.memmap.
+
+    Attributes
+    ----------
+    shape : tuple
+        The shape of data.
+
+    dtype : numpy dtype
+        The dtype of data.
+
+    Notes
+    -----
+    With ConsensusCluster's executor='process', the source is pickled
+    and sent to every worker. An np.memmap (of a whole file, rather
+    than a slice of one) is sent as its filename and reopened by the
+    worker; other data must be picklable, and is sent as whatever it
+    pickles to. Use executor='thread' for data which can't be pickled,
+    like h5py Datasets.
+    """
+    def __init__(self, data):
+        if len(data.shape) != 2:
+            raise ValueError('An ArraySource must be 2-dimensional, got '
+                             'shape {}'.format(data.shape))
+        self.data = data
+        self.shape = tuple(data.shape)
+        self.dtype = np.dtype(data.dtype)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __getitem__(self, rows):
+        """Read some rows, given as a slice or a sorted array of indices.
+        """
+        return np.asarray(self.data[rows])
+
+    def iter_chunks(self, chunk_rows=None):
+        """Read the rows a chunk at a time.
+
+        Parameters
+        ----------
+        chunk_rows : int or None, default=None
+            The number of rows per chunk. If None, chunks have about
+            _CHUNK_ELEMENTS elements.
+
+        Yields
+        ------
+        start : int
+            The index of the first row in the chunk.
+
+        chunk : ndarray
+            The rows.
+        """
+        (n_rows, n_columns) = self.shape
+        if chunk_rows is None:
+            chunk_rows = max(_CHUNK_ELEMENTS // max(n_columns, 1), 1)
+        for start in range(0, n_rows, chunk_rows):
+            yield start, self[start:min(start + chunk_rows, n_rows)]
+
+    def __reduce__(self):
+        args = _memmap_args(self.data)
+        if args is not None:
+            # Reopen the file on the other side rather than copying the
+            # whole array into the pickle.
+            return (_from_memmap, args)
+        return (ArraySource, (self.data,))
+
+
+def _from_memmap(filename, dtype, shape, offset, order):
+    return ArraySource(_open_memmap(filename, dtype, shape, offset, order))
+
+
+def spill_chunks(chunks, directory=None):
+    """Write chunks of rows to a memory-mapped file.
+
+    Parameters
+    ----------
+    chunks : iterable of array-like
+        The rows, in chunks. Each chunk must be 2-D, and all of them
+        must have the same number of columns.
+
+    directory : str or None, default=None
+        Where to create the file, which is then left for the caller to
+        delete. If None, a new temporary directory is created, and it's
+        deleted along with the file once the returned ArraySource is
+        garbage collected.
+
+    Returns
+    -------
+    ArraySource
+        The rows, backed by an np.memmap of the file. Its dtype is
+        that of the first chunk if that's a float dtype, and float64
+        otherwise.
+    """
+    owned = directory is None
+    if owned:
+        directory = tempfile.mkdtemp(prefix='consensuscluster-')
+    (fd, filename) = tempfile.mkstemp(prefix='X-', suffix='.dat',
+                                      dir=directory)
+    try:
+        (n_rows, n_columns, dtype) = _write_chunks(fd, chunks)
+    except BaseException:
+        if owned:
+            shutil.rmtree(directory, True)
+        else:
+            os.remove(filename)
+        raise
+    source = ArraySource(_open_memmap(filename, dtype, (n_rows, n_columns),
+                                      0, 'C'))
+    if owned:
+        weakref.finalize(source, shutil.rmtree, directory, True)
+    return source
+
+
+def _write_chunks(fd, chunks):
+    """Write chunks of rows to the open file fd, closing it afterwards.
+
+    Returns the number of rows, the number of columns and the dtype.
+    """
+    n_rows = 0
+    n_columns = None
+    dtype = None
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in chunks:
+            chunk = np.asarray(chunk)
+            if chunk.ndim != 2:
+                raise ValueError('Each chunk must be 2-dimensional, got '
+                                 'shape {}'.format(chunk.shape))
+            if dtype is None:
+                n_columns = chunk.shape[1]
+                dtype = chunk.dtype if chunk.dtype.kind == 'f' else \
+                    np.dtype(np.float64)
+            elif chunk.shape[1] != n_columns:
+                raise ValueError('Every chunk must have {} columns, got '
+                                 'one with {}'.format(n_columns,
+                                                      chunk.shape[1]))
+            f.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+            n_rows += chunk.shape[0]
+    if n_rows == 0:
+        raise ValueError('No rows were read from the chunks')
+    return (n_rows, n_columns, dtype)
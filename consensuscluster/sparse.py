@@ -0,0 +1,93 @@
+"""Sparse, thresholded consensus matrices.
+
+With many clusters, most pairs of samples are almost never put in the
+same cluster, so most of the consensus matrix is (close to) 0. Dropping
+every value below a small threshold then leaves a sparse matrix which
+takes far less memory than even the packed representation, and which
+the metrics, the ordering and the heatmap can all work with directly.
+
+threshold_consensus builds such a matrix from any consensus matrix
+(including a ConsensusRatio, i.e. straight from the counts), reading
+it one stripe of rows at a time, so the dense matrix never has to
+exist in memory.
+"""
+import numpy as np
+import scipy.sparse
+
+from .packed import _CHUNK_ELEMENTS
+
+
+def _read_upper(mat, start, stop):
+    """Read rows [start, stop) of mat from column start onwards."""
+    if isinstance(mat, np.ndarray):
+        upper = mat[start:stop, start:]
+    else:
+        upper = mat.tile(start, stop, start, mat.shape[0])
+    return np.asarray(upper, dtype=np.float64)
+
+
+def threshold_consensus(consensus_matrix, threshold):
+    """Make a sparse copy of a consensus matrix, dropping small values.
+
+    Parameters
+    ----------
+    consensus_matrix : ndarray, PackedSymmetricMatrix or ConsensusRatio
+        The consensus matrix. Only its upper triangle is read, one
+        stripe of rows at a time. It can be an np.memmap.
+
+    threshold : float
+        Values below threshold are dropped (i.e. become 0). Must be in
+        (0,1].
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix of float64, shape (n, n)
+        The thresholded matrix. It's symmetric, and includes the
+        diagonal entries which are at least threshold.
+    """
+    if not 0.0 < threshold <= 1.0:
+        raise ValueError('threshold must be in (0,1], got '
+                         '{}'.format(threshold))
+    n = consensus_matrix.shape[0]
+    rows = []
+    cols = []
+    values = []
+    stripe_rows = max(_CHUNK_ELEMENTS // max(n, 1), 1)
+    for start in range(0, n, stripe_rows):
+        stop = min(start + stripe_rows, n)
+        upper = _read_upper(consensus_matrix, start, stop)
+        # The stripe also holds a little of the lower triangle (to the
+        # left of the diagonal in its first rows), which we skip.
+        (r, c) = np.nonzero(upper >= threshold)
+        keep = c >= r
+        r = r[keep] + start
+        c = c[keep] + start
+        rows.append(r)
+        cols.append(c)
+        values.append(upper[r - start, c - start])
+    if n == 0:
+        return scipy.sparse.csr_matrix((0, 0), dtype=np.float64)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    values = np.concatenate(values)
+    # Mirror the strict upper triangle to get the lower one.
+    strict = rows != cols
+    mat = scipy.sparse.coo_matrix(
+        (np.concatenate([values, values[strict]]),
+         (np.concatenate([rows, cols[strict]]),
+          np.concatenate([cols, rows[strict]]))),
+        shape=(n, n))
+    return mat.tocsr()
+
+
+def _canonical_csr(mat):
+    """Convert a scipy.sparse matrix to CSR with sorted, unique indices."""
+    mat = mat.tocsr(copy=True)
+    mat.sum_duplicates()
+    return mat
+
+
+def _upper_values(mat):
+    """Return the stored values in the strict upper triangle of mat."""
+    return scipy.sparse.triu(_canonical_csr(mat), k=1).data
+
@@ -20,9 +20,15 @@ def pytest_configure(config):
     import sys
 
     sys._called_from_test = True
+    # Importing this file imports the consensuscluster package, so misc
+    # may already have computed IS_TEST before the line above ran.
+    from consensuscluster import misc
+    misc.IS_TEST = True
 
 
 def pytest_unconfigure(config):
     import sys
 
     del sys._called_from_test
+    from consensuscluster import misc
+    misc.IS_TEST = False
@@ -5,10 +5,12 @@ from sklearn.utils.estimator_checks import check_estimator
 from consensuscluster import TemplateEstimator
 from consensuscluster import TemplateClassifier
 from consensuscluster import TemplateTransformer
+from consensuscluster import ConsensusCluster
 
 
 @pytest.mark.parametrize(
-    "Estimator", [TemplateEstimator, TemplateTransformer, TemplateClassifier]
+    "Estimator", [TemplateEstimator, TemplateTransformer, TemplateClassifier,
+                  ConsensusCluster]
 )
 def test_all_estimators(Estimator):
     return check_estimator(Estimator)
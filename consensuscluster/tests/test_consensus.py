@@ -0,0 +1,969 @@
+"""Contains tests for the ConsensusCluster estimator."""
+
+import gc
+import os
+import pickle
+
+import pytest
+import numpy as np
+import scipy.sparse
+from sklearn.cluster import KMeans
+from sklearn.datasets import make_blobs
+
+from consensuscluster import ConsensusCluster
+from consensuscluster import ConsensusRatio
+from consensuscluster import PackedSymmetricMatrix
+from consensuscluster._accumulate import accumulate_batch
+from consensuscluster._accumulate import consensus_ratio
+
+
+def _naive_counts(n_samples, subsamples, labelings):
+    """Compute the count matrices the slow way, with a pairwise loop.
+
+    This is the textbook definition, so we use it as the reference
+    for the vectorized implementation.
+    """
+    connectivity = np.zeros((n_samples, n_samples), dtype=np.int64)
+    indicator = np.zeros((n_samples, n_samples), dtype=np.int64)
+    for indices, labels in zip(subsamples, labelings):
+        for a in range(len(indices)):
+            for b in range(len(indices)):
+                i, j = indices[a], indices[b]
+                indicator[i, j] += 1
+                if labels[a] == labels[b]:
+                    connectivity[i, j] += 1
+    return connectivity, indicator
+
+
+def _dense(mat):
+    """Return mat as an ndarray, whether it's packed or not."""
+    if isinstance(mat, PackedSymmetricMatrix):
+        return mat.to_dense()
+    return mat
+
+
+@pytest.fixture
+def blobs():
+    return make_blobs(n_samples=60, centers=3, cluster_std=0.5,
+                      random_state=0)
+
+
+@pytest.mark.parametrize('n_resamples', [1, 5, 40])
+def test_accumulate_batch_matches_naive(n_resamples):
+    rng = np.random.RandomState(n_resamples)
+    n_samples = 23
+    subsamples = [np.sort(rng.choice(n_samples, 15, replace=False))
+                  for _ in range(n_resamples)]
+    # Use non-contiguous labels to check that they get remapped.
+    labelings = [rng.choice([-1, 3, 7], 15) for _ in range(n_resamples)]
+
+    connectivity = np.zeros((n_samples, n_samples), dtype=np.int32)
+    indicator = np.zeros((n_samples, n_samples), dtype=np.int32)
+    accumulate_batch(connectivity, indicator, subsamples, labelings)
+
+    (true_connectivity, true_indicator) = _naive_counts(
+        n_samples, subsamples, labelings)
+    assert np.array_equal(connectivity, true_connectivity)
+    assert np.array_equal(indicator, true_indicator)
+
+
+@pytest.mark.parametrize('n', [1, 2, 17])
+def test_iter_upper_chunks(n, monkeypatch):
+    from consensuscluster import _accumulate
+    # Use tiny chunks so that there are several of them.
+    monkeypatch.setattr(_accumulate, '_CHUNK_ELEMENTS', 10)
+    rng = np.random.RandomState(n)
+    a = rng.randint(10, size=(n, n))
+    a = a + a.T
+    b = a * 2
+    expected = a[np.triu_indices(n, 1)]
+    for mats in [(a, b), (PackedSymmetricMatrix.from_dense(a),
+                          PackedSymmetricMatrix.from_dense(b))]:
+        chunks = list(_accumulate._iter_upper_chunks(*mats))
+        first = np.concatenate([c[0] for c in chunks] + [[]])
+        second = np.concatenate([c[1] for c in chunks] + [[]])
+        assert np.array_equal(first, expected)
+        assert np.array_equal(second, 2 * expected)
+
+
+def test_consensus_ratio_never_drawn():
+    connectivity = np.array([[2, 1], [1, 0]])
+    indicator = np.array([[2, 0], [0, 0]])
+    consensus = consensus_ratio(connectivity, indicator)
+    assert np.array_equal(consensus, [[1.0, 0.0], [0.0, 0.0]])
+
+
+def test_consensus_cluster_blobs(blobs):
+    X, y = blobs
+    est = ConsensusCluster(n_clusters=3, n_resamples=20, random_state=0)
+    labels = est.fit_predict(X)
+    assert labels.shape == (X.shape[0],)
+    # The blobs are well-separated, so the clustering should be perfect
+    # up to a relabeling.
+    for cluster in range(3):
+        assert len(np.unique(labels[y == cluster])) == 1
+    assert len(np.unique(labels)) == 3
+
+    cmat = est.consensus_matrix_
+    assert cmat.shape == (X.shape[0], X.shape[0])
+    assert np.array_equal(cmat, cmat.T)
+    assert np.all(np.logical_and(cmat >= 0.0, cmat <= 1.0))
+    assert np.all(est.connectivity_ <= est.indicator_)
+
+
+def test_consensus_cluster_random_state(blobs):
+    X, _ = blobs
+    est1 = ConsensusCluster(n_clusters=3, n_resamples=10, random_state=42)
+    est2 = ConsensusCluster(n_clusters=3, n_resamples=10, random_state=42)
+    est1.fit(X)
+    est2.fit(X)
+    assert np.array_equal(est1.connectivity_, est2.connectivity_)
+    assert np.array_equal(est1.indicator_, est2.indicator_)
+
+
+@pytest.mark.parametrize(
+    'params',
+    [
+        {'n_clusters': 0},
+        {'n_resamples': 0},
+        {'resample_frac': 0.0},
+        {'resample_frac': 1.5},
+        {'n_clusters': 59, 'resample_frac': 0.5},
+        {'n_jobs': 0},
+        {'executor': 'dask'},
+        {'executor': object()},
+        {'storage': 'sparse'},
+        {'n_clusters': 2, 'k_range': [3, 4]},
+        {'n_clusters': 3, 'k_range': [0, 3]},
+        {'n_clusters': 3, 'k_range': [3, 49], 'resample_frac': 0.8},
+        {'tol': -1.0},
+        {'check_interval': 0},
+        {'precompute': 'euclidean'},
+        {'precompute': 3},
+        {'resume': True}
+    ]
+)
+def test_consensus_cluster_bad_params(blobs, params):
+    X, _ = blobs
+    with pytest.raises(ValueError):
+        ConsensusCluster(**params).fit(X)
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+@pytest.mark.parametrize('n_jobs', [2, 3])
+def test_consensus_cluster_n_jobs(blobs, executor, n_jobs):
+    """The counts must be identical no matter how many workers we use."""
+    X, _ = blobs
+    serial = ConsensusCluster(n_clusters=3, n_resamples=7, random_state=3)
+    parallel = ConsensusCluster(n_clusters=3, n_resamples=7, random_state=3,
+                                n_jobs=n_jobs, executor=executor)
+    serial.fit(X)
+    parallel.fit(X)
+    assert np.array_equal(serial.connectivity_, parallel.connectivity_)
+    assert np.array_equal(serial.indicator_, parallel.indicator_)
+    assert np.array_equal(serial.labels_, parallel.labels_)
+
+
+class _InlineExecutor(object):
+    """The least an executor needs: a submit which returns a Future."""
+    def __init__(self):
+        self.n_submitted = 0
+
+    def submit(self, func, *args, **kwargs):
+        from concurrent.futures import Future
+        self.n_submitted += 1
+        future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+
+@pytest.mark.parametrize('kind', ['thread', 'process', 'inline'])
+@pytest.mark.parametrize('storage', ['dense', 'memmap'])
+@pytest.mark.parametrize('n_jobs', [None, 5])
+def test_consensus_cluster_executor_instance(blobs, kind, storage, n_jobs,
+                                             tmpdir):
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import ThreadPoolExecutor
+    X, _ = blobs
+    params = dict(n_clusters=3, k_range=[2, 3], n_resamples=9,
+                  random_state=3, storage=storage, memmap_dir=str(tmpdir))
+    serial = ConsensusCluster(**params).fit(X)
+    if kind == 'thread':
+        executor = ThreadPoolExecutor(max_workers=2)
+    elif kind == 'process':
+        executor = ProcessPoolExecutor(max_workers=2)
+    else:
+        executor = _InlineExecutor()
+    result = ConsensusCluster(executor=executor, n_jobs=n_jobs,
+                              **params).fit(X)
+    # The executor is left running.
+    assert executor.submit(abs, -1).result() == 1
+    if kind != 'inline':
+        executor.shutdown()
+    for k in (2, 3):
+        assert np.array_equal(_dense(result.connectivities_[k]),
+                              _dense(serial.connectivities_[k]))
+    assert np.array_equal(_dense(result.indicator_), _dense(serial.indicator_))
+    assert np.array_equal(result.labels_, serial.labels_)
+    if kind == 'inline':
+        # With 5 batches, the merges also run on the executor for
+        # memmap storage, and in this process for dense storage.
+        n_batches = 1 if n_jobs is None else 5
+        n_merges = 4 if storage == 'memmap' and n_jobs else 0
+        assert executor.n_submitted == n_batches + n_merges + 1
+    if storage == 'memmap':
+        # Every partial count file was merged and deleted.
+        assert not [name for name in os.listdir(result.memmap_dir_)
+                    if name.startswith('batch')]
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+@pytest.mark.parametrize('storage', ['dense', 'memmap'])
+def test_consensus_cluster_rounds_share_pool(blobs, executor, storage,
+                                             monkeypatch):
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import ThreadPoolExecutor
+    from consensuscluster import _consensus
+    X, _ = blobs
+    X = X + np.random.RandomState(0).normal(scale=2.0, size=X.shape)
+    started = []
+    for name, base in [('ProcessPoolExecutor', ProcessPoolExecutor),
+                       ('ThreadPoolExecutor', ThreadPoolExecutor)]:
+        class Counted(base):
+            def __init__(self, *args, **kwargs):
+                started.append(self)
+                super(self.__class__, self).__init__(*args, **kwargs)
+        monkeypatch.setattr(_consensus, name, Counted)
+    # More workers than resamples per round, so rounds run ahead, and
+    # the ones which ran ahead of convergence are thrown away.
+    params = dict(n_clusters=3, k_range=[2, 3], n_resamples=40,
+                  random_state=0, tol=.02, check_interval=2, storage=storage)
+    serial = ConsensusCluster(**params).fit(X)
+    assert serial.converged_ and serial.n_resamples_ < 40
+    parallel = ConsensusCluster(n_jobs=5, executor=executor,
+                                **params).fit(X)
+    assert len(started) == 1
+    assert parallel.converged_
+    assert parallel.n_resamples_ == serial.n_resamples_
+    for k in (2, 3):
+        assert np.array_equal(_dense(parallel.connectivities_[k]),
+                              _dense(serial.connectivities_[k]))
+    assert np.array_equal(_dense(parallel.indicator_),
+                          _dense(serial.indicator_))
+    if storage == 'memmap':
+        assert not [name for name in os.listdir(parallel.memmap_dir_)
+                    if name.startswith('batch')]
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_consensus_cluster_merge_overflow(blobs, executor, monkeypatch):
+    from consensuscluster import _consensus
+    count_dtype = _consensus._count_dtype
+
+    def small_count_dtype(total):
+        # Let counts go down to uint8, so that the partial counts of a
+        # batch would overflow when merged if they were only allocated
+        # for the batch's own resamples.
+        return np.uint8 if total <= 255 else count_dtype(total)
+
+    monkeypatch.setattr(_consensus, '_count_dtype', small_count_dtype)
+    X, _ = blobs
+    params = dict(clusterer=KMeans(n_init=1), n_clusters=2, k_range=[2],
+                  n_resamples=400, random_state=0, executor=executor)
+    expected = ConsensusCluster(**params).fit(X)
+    result = ConsensusCluster(n_jobs=2, **params).fit(X)
+    # Each sample is drawn in more than 255 of the 400 resamples.
+    assert np.diagonal(expected.indicator_).min() > 255
+    assert np.array_equal(result.indicator_, expected.indicator_)
+    assert np.array_equal(result.connectivities_[2],
+                          expected.connectivities_[2])
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 5, 8, 9])
+def test_tree_reduce(n):
+    from concurrent.futures import Future
+    from consensuscluster._consensus import _run_now
+    from consensuscluster._consensus import _tree_reduce
+
+    def merge(a, b):
+        return '({} {})'.format(a, b)
+
+    def expected(nodes):
+        while len(nodes) > 1:
+            pairs = [nodes[i:i + 2] for i in range(0, len(nodes), 2)]
+            nodes = [merge(*p) if len(p) == 2 else p[0] for p in pairs]
+        return nodes[0]
+
+    rng = np.random.RandomState(n)
+    for _ in range(5):
+        futures = [Future() for _ in range(n)]
+        # Finish the futures in a random order; the tree must not care.
+        for i in rng.permutation(n):
+            futures[i].set_result(str(i))
+        assert _tree_reduce(futures, merge, _run_now) == \
+            expected([str(i) for i in range(n)])
+        assert _tree_reduce(futures, merge, _run_now, leaf=int) == \
+            expected(list(range(n)))
+
+
+def test_consensus_cluster_worker_copy(blobs):
+    X, _ = blobs
+    est = ConsensusCluster(n_clusters=3, n_resamples=2, random_state=0,
+                           executor=_InlineExecutor()).fit(X)
+    worker = est._worker_copy()
+    assert not hasattr(worker, 'indicator_')
+    assert not hasattr(worker, 'neighbors_')
+    assert worker.executor == 'process'
+
+
+def test_consensus_cluster_worker_copy_memmap_distances(blobs, tmpdir):
+    from sklearn.cluster import AgglomerativeClustering
+    X, _ = blobs
+    est = ConsensusCluster(AgglomerativeClustering(linkage='average'),
+                           n_clusters=3, n_resamples=2, random_state=0,
+                           precompute='euclidean', storage='memmap',
+                           memmap_dir=str(tmpdir)).fit(X)
+    assert isinstance(est.distances_, np.memmap)
+    data = pickle.dumps(est._worker_copy())
+    # The pickle holds the filename of distances_, not its contents.
+    assert len(data) < est.distances_.nbytes // 4
+    worker = pickle.loads(data)
+    assert isinstance(worker.distances_, np.memmap)
+    np.testing.assert_array_equal(worker.distances_, est.distances_)
+    # Without memmap storage, distances_ is copied as usual.
+    est.set_params(storage='dense').fit(X)
+    worker = pickle.loads(pickle.dumps(est._worker_copy()))
+    np.testing.assert_array_equal(worker.distances_, est.distances_)
+
+
+def test_consensus_cluster_packed_storage(blobs):
+    X, _ = blobs
+    dense = ConsensusCluster(n_clusters=3, n_resamples=10, random_state=5)
+    packed = ConsensusCluster(n_clusters=3, n_resamples=10, random_state=5,
+                              storage='packed', n_jobs=2, executor='thread')
+    dense.fit(X)
+    packed.fit(X)
+    assert isinstance(packed.connectivity_, PackedSymmetricMatrix)
+    assert np.array_equal(packed.connectivity_.to_dense(),
+                          dense.connectivity_)
+    assert np.array_equal(packed.indicator_.to_dense(), dense.indicator_)
+    assert np.array_equal(packed.consensus_matrix_.to_dense(),
+                          dense.consensus_matrix_)
+    assert np.array_equal(packed.labels_, dense.labels_)
+
+
+@pytest.mark.parametrize('n_jobs', [None, 2])
+def test_consensus_cluster_memmap_storage(blobs, tmpdir, n_jobs):
+    X, _ = blobs
+    dense = ConsensusCluster(n_clusters=3, n_resamples=10, random_state=6)
+    memmapped = ConsensusCluster(n_clusters=3, n_resamples=10,
+                                 random_state=6, storage='memmap',
+                                 memmap_dir=str(tmpdir), n_jobs=n_jobs)
+    dense.fit(X)
+    memmapped.fit(X)
+    assert os.path.dirname(memmapped.memmap_dir_) == str(tmpdir)
+    for attr in ['connectivity_', 'indicator_', 'consensus_matrix_']:
+        mat = getattr(memmapped, attr)
+        assert isinstance(mat.data, np.memmap)
+        assert np.array_equal(mat.to_dense(), getattr(dense, attr))
+    assert np.array_equal(memmapped.labels_, dense.labels_)
+    # The partial counts of the other workers should have been cleaned
+    # up, leaving one file per matrix.
+    assert len(os.listdir(memmapped.memmap_dir_)) == 3
+
+
+def test_consensus_cluster_memmap_dir_shared(blobs, tmpdir):
+    X, _ = blobs
+    params = dict(n_clusters=3, n_resamples=6, random_state=0,
+                  storage='memmap', memmap_dir=str(tmpdir))
+    first = ConsensusCluster(**params).fit(X)
+    indicator = first.indicator_.to_dense()
+    connectivity = first.connectivity_.to_dense()
+    # Fitting another estimator on other data in the same memmap_dir
+    # mustn't touch the first one's files.
+    second = ConsensusCluster(**params).fit(X[::-1] * 2)
+    assert second.memmap_dir_ != first.memmap_dir_
+    assert np.array_equal(first.indicator_.to_dense(), indicator)
+    assert np.array_equal(first.connectivity_.to_dense(), connectivity)
+
+    # A refit from scratch replaces (and deletes) the old directory.
+    old_dir = first.memmap_dir_
+    first.fit(X)
+    assert not os.path.exists(old_dir)
+    assert os.path.isdir(first.memmap_dir_)
+    # A pickled copy doesn't own the directory.
+    copy = pickle.loads(pickle.dumps(first))
+    del copy
+    gc.collect()
+    assert os.path.isdir(first.memmap_dir_)
+    # The estimator's own directory goes away along with it.
+    directory = first.memmap_dir_
+    del first
+    gc.collect()
+    assert not os.path.exists(directory)
+    assert os.path.isdir(second.memmap_dir_)
+
+
+def test_consensus_cluster_k_range(blobs):
+    X, y = blobs
+    sweep = ConsensusCluster(n_clusters=2, k_range=[4, 2, 3], n_resamples=8,
+                             random_state=7)
+    sweep.fit(X)
+    assert sorted(sweep.connectivities_) == [2, 3, 4]
+    assert sorted(sweep.consensus_matrices_) == [2, 3, 4]
+    for k in [2, 3, 4]:
+        assert len(np.unique(sweep.labels_by_k_[k])) == k
+        assert np.all(sweep.connectivities_[k] <= sweep.indicator_)
+    assert sweep.connectivity_ is sweep.connectivities_[2]
+    assert sweep.labels_ is sweep.labels_by_k_[2]
+
+    # The resamples don't depend on k_range, so the indicator counts
+    # (and, since K=2 is the first K run on each resample, the K=2
+    # results) are the same as a plain K=2 fit.
+    single = ConsensusCluster(n_clusters=2, n_resamples=8, random_state=7)
+    single.fit(X)
+    assert np.array_equal(sweep.indicator_, single.indicator_)
+    assert np.array_equal(sweep.connectivity_, single.connectivity_)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'packed'])
+def test_consensus_cluster_partial_fit(blobs, storage):
+    X, _ = blobs
+    full = ConsensusCluster(n_clusters=3, n_resamples=10, random_state=8,
+                            storage=storage)
+    full.fit(X)
+    incremental = ConsensusCluster(n_clusters=3, n_resamples=4,
+                                   random_state=8, storage=storage)
+    incremental.partial_fit(X)
+    assert incremental.n_resamples_ == 4
+    incremental.partial_fit(X)
+    incremental.set_params(n_resamples=2)
+    incremental.partial_fit(X)
+    assert incremental.n_resamples_ == 10
+    _assert_same_counts(full, incremental)
+
+
+def test_consensus_cluster_warm_start(blobs):
+    X, _ = blobs
+    full = ConsensusCluster(n_clusters=3, n_resamples=10, random_state=9)
+    full.fit(X)
+    warm = ConsensusCluster(n_clusters=3, n_resamples=3, random_state=9,
+                            warm_start=True, n_jobs=2, executor='thread')
+    warm.fit(X)
+    warm.set_params(n_resamples=10)
+    warm.fit(X)
+    assert warm.n_resamples_ == 10
+    _assert_same_counts(full, warm)
+
+    warm.set_params(n_resamples=5)
+    with pytest.raises(ValueError):
+        warm.fit(X)
+    with pytest.raises(ValueError):
+        warm.partial_fit(X[:-1])
+
+
+class _Preempted(Exception):
+    pass
+
+
+class _PreemptedKMeans(KMeans):
+    """KMeans which raises _Preempted once fits_left fits have been run."""
+    fits_left = 0
+
+    def fit_predict(self, X, y=None, sample_weight=None):
+        if _PreemptedKMeans.fits_left == 0:
+            raise _Preempted()
+        _PreemptedKMeans.fits_left -= 1
+        return super(_PreemptedKMeans, self).fit_predict(X)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'packed', 'memmap'])
+@pytest.mark.parametrize('tol', [None, 1e-3])
+def test_consensus_cluster_resume(blobs, storage, tol, tmpdir):
+    X, _ = blobs
+    X = X + np.random.RandomState(0).normal(scale=2.0, size=X.shape)
+    params = dict(n_clusters=3, k_range=[2, 3], n_resamples=20,
+                  check_interval=6, tol=tol, storage=storage)
+    full = ConsensusCluster(random_state=4, **params).fit(X)
+
+    checkpoint = str(tmpdir.join('checkpoint'))
+    # Two fits per resample, so this dies during resample 15, after the
+    # checkpoint at 12.
+    _PreemptedKMeans.fits_left = 29
+    with pytest.raises(_Preempted):
+        ConsensusCluster(_PreemptedKMeans(n_init=10), random_state=4,
+                         checkpoint=checkpoint, **params).fit(X)
+    # The entropy comes from the checkpoint, not random_state.
+    resumed = ConsensusCluster(random_state=None, checkpoint=checkpoint,
+                               resume=True, **params).fit(X)
+    assert resumed.entropy_ == full.entropy_
+    assert resumed.n_resamples_ == full.n_resamples_
+    assert resumed.converged_ == full.converged_
+    for k in (2, 3):
+        assert np.array_equal(_dense(resumed.connectivities_[k]),
+                              _dense(full.connectivities_[k]))
+        assert np.array_equal(resumed.labels_by_k_[k], full.labels_by_k_[k])
+    assert np.array_equal(_dense(resumed.indicator_), _dense(full.indicator_))
+    # Only the latest checkpoint's files are kept.
+    assert len(tmpdir.join('checkpoint').listdir()) == 4
+
+
+def test_consensus_cluster_resume_converged(blobs, tmpdir):
+    X, _ = blobs
+    checkpoint = str(tmpdir.join('checkpoint'))
+    params = dict(n_clusters=3, n_resamples=100, random_state=0, tol=1e-3,
+                  check_interval=5, checkpoint=checkpoint)
+    first = ConsensusCluster(**params).fit(X)
+    assert first.converged_
+    resumed = ConsensusCluster(resume=True, **params).fit(X)
+    assert resumed.converged_
+    assert resumed.n_resamples_ == first.n_resamples_ == 10
+
+
+def test_consensus_cluster_resume_mismatch(blobs, tmpdir):
+    X, _ = blobs
+    checkpoint = str(tmpdir.join('checkpoint'))
+    # With no checkpoint yet, resume just starts from scratch.
+    ConsensusCluster(n_clusters=3, n_resamples=4, check_interval=2,
+                     checkpoint=checkpoint, resume=True).fit(X)
+    for params in [{'n_clusters': 2}, {'resample_frac': .5},
+                   {'storage': 'packed'}, {'n_resamples': 3}]:
+        params = dict(dict(n_clusters=3, n_resamples=4), **params)
+        with pytest.raises(ValueError, match='checkpoint'):
+            ConsensusCluster(checkpoint=checkpoint, resume=True,
+                             **params).fit(X)
+    with pytest.raises(ValueError, match='checkpoint'):
+        ConsensusCluster(n_clusters=3, n_resamples=4, checkpoint=checkpoint,
+                         resume=True).fit(X[:50])
+
+
+def test_consensus_cluster_tol(blobs):
+    X, _ = blobs
+    # The blobs are so well-separated that the consensus values are all
+    # 0 or 1 from the very first resample, so the CDF can't change.
+    est = ConsensusCluster(n_clusters=3, n_resamples=100, random_state=0,
+                           tol=1e-3, check_interval=5)
+    est.fit(X)
+    assert est.converged_
+    assert est.n_resamples_ == 10
+
+    # With no resamples left to run, a warm start changes nothing.
+    est.set_params(warm_start=True, n_resamples=10)
+    est.fit(X)
+    assert est.converged_
+    assert est.n_resamples_ == 10
+    est._resample(X, 0, 48, [3])
+    assert est.converged_
+
+    est.set_params(tol=None, warm_start=False, n_resamples=100)
+    est.fit(X)
+    assert not est.converged_
+    assert est.n_resamples_ == 100
+
+
+def test_consensus_cluster_warm_start_after_tol(blobs):
+    X, _ = blobs
+    est = ConsensusCluster(n_clusters=3, n_resamples=100, random_state=0,
+                           tol=1e-3, check_interval=5, warm_start=True)
+    est.fit(X)
+    assert est.converged_
+    assert est.n_resamples_ == 10
+    # Without tol, a warm start runs all of the remaining resamples.
+    est.set_params(tol=None, n_resamples=200)
+    est.fit(X)
+    assert not est.converged_
+    assert est.n_resamples_ == 200
+    expected = ConsensusCluster(n_clusters=3, n_resamples=200,
+                                random_state=0).fit(X)
+    _assert_same_counts(expected, est)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'packed'])
+def test_consensus_ratio_view(storage):
+    rng = np.random.RandomState(0)
+    indicator = rng.randint(0, 5, size=(40, 40)).astype(np.uint16)
+    indicator = indicator + indicator.T
+    connectivity = np.minimum(rng.randint(0, 5, size=(40, 40)), 4)
+    connectivity = np.minimum(connectivity + connectivity.T,
+                              indicator).astype(np.uint16)
+    expected = consensus_ratio(connectivity, indicator)
+    if storage == 'packed':
+        connectivity = PackedSymmetricMatrix.from_dense(connectivity)
+        indicator = PackedSymmetricMatrix.from_dense(indicator)
+    view = ConsensusRatio(connectivity, indicator)
+    assert view.shape == (40, 40)
+    assert np.array_equal(view.to_dense(), expected)
+    assert np.array_equal(view.rows(5, 9), expected[5:9])
+    assert np.array_equal(view.tile(3, 30, 10, 12), expected[3:30, 10:12])
+    rows = rng.permutation(40)[:7]
+    assert np.array_equal(view.take(rows, rows), expected[np.ix_(rows, rows)])
+    (i, j) = np.triu_indices(40, 1)
+    assert np.array_equal(view.condensed(), expected[i, j])
+
+
+@pytest.mark.parametrize('storage', ['dense', 'packed', 'memmap'])
+def test_consensus_cluster_lazy_consensus(blobs, storage, tmpdir):
+    X, _ = blobs
+    eager = ConsensusCluster(n_clusters=3, k_range=[2, 3], n_resamples=10,
+                             random_state=10)
+    lazy = ConsensusCluster(n_clusters=3, k_range=[2, 3], n_resamples=10,
+                            random_state=10, storage=storage,
+                            memmap_dir=str(tmpdir), lazy_consensus=True)
+    eager.fit(X)
+    lazy.fit(X)
+    assert lazy.indicator_.dtype == np.uint16
+    for k in [2, 3]:
+        assert isinstance(lazy.consensus_matrices_[k], ConsensusRatio)
+        assert np.array_equal(lazy.consensus_matrices_[k].to_dense(),
+                              eager.consensus_matrices_[k])
+        assert np.array_equal(lazy.labels_by_k_[k], eager.labels_by_k_[k])
+    if storage == 'memmap':
+        # Only the counts are on disk.
+        assert len(os.listdir(lazy.memmap_dir_)) == 3
+
+
+@pytest.mark.parametrize('storage', ['dense', 'packed', 'memmap'])
+def test_consensus_cluster_widen_counts(blobs, storage, tmpdir):
+    X, _ = blobs
+    full = ConsensusCluster(n_clusters=3, n_resamples=8, random_state=11,
+                            storage=storage, memmap_dir=str(tmpdir.mkdir('a')))
+    full.fit(X)
+    incremental = ConsensusCluster(n_clusters=3, n_resamples=4,
+                                   random_state=11, storage=storage,
+                                   memmap_dir=str(tmpdir.mkdir('b')))
+    incremental.partial_fit(X)
+    assert incremental.indicator_.dtype == np.uint16
+    # Pretend that a lot more resamples are coming.
+    incremental._widen_counts(1 << 20)
+    assert incremental.indicator_.dtype == np.uint32
+    assert incremental.connectivities_[3].dtype == np.uint32
+    incremental.partial_fit(X)
+    _assert_same_counts(full, incremental)
+    if storage == 'memmap':
+        # The narrow files were replaced by the wide ones.
+        names = sorted(os.listdir(incremental.memmap_dir_))
+        assert names == ['connectivity-k3-uint32.dat', 'consensus-k3.dat',
+                         'indicator-uint32.dat']
+
+
+def _assert_same_counts(est1, est2):
+    def dense(mat):
+        if isinstance(mat, PackedSymmetricMatrix):
+            return mat.to_dense()
+        return mat
+    assert np.array_equal(dense(est1.connectivity_),
+                          dense(est2.connectivity_))
+    assert np.array_equal(dense(est1.indicator_), dense(est2.indicator_))
+    assert np.array_equal(est1.labels_, est2.labels_)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'memmap'])
+@pytest.mark.parametrize('n_jobs', [None, 2])
+def test_consensus_cluster_precompute(blobs, storage, n_jobs, tmpdir,
+                                      monkeypatch):
+    from sklearn.cluster import AgglomerativeClustering
+    from sklearn.metrics import euclidean_distances
+    from consensuscluster import _consensus
+    # Use small chunks so that the distances take several of them.
+    monkeypatch.setattr(_consensus, '_CHUNK_ELEMENTS', 7 * 60)
+    X, _ = blobs
+    base = AgglomerativeClustering(linkage='average')
+    params = dict(n_clusters=3, k_range=[2, 3, 4], n_resamples=8,
+                  random_state=2, storage=storage, n_jobs=n_jobs,
+                  memmap_dir=str(tmpdir))
+    plain = ConsensusCluster(base, **params).fit(X)
+    precomputed = ConsensusCluster(base, precompute='euclidean',
+                                   **params).fit(X)
+    assert not hasattr(plain, 'distances_')
+    distances = precomputed.distances_
+    assert distances.dtype == np.float32
+    assert isinstance(distances, np.memmap) == (storage == 'memmap')
+    np.testing.assert_allclose(distances, euclidean_distances(X), rtol=1e-5,
+                               atol=1e-5)
+    assert np.all(np.diagonal(distances) == 0)
+    for k in [2, 3, 4]:
+        assert np.array_equal(_dense(precomputed.connectivities_[k]),
+                              _dense(plain.connectivities_[k]))
+    assert np.array_equal(precomputed.labels_, plain.labels_)
+
+
+def test_consensus_cluster_precompute_affinity(blobs):
+    from sklearn.cluster import SpectralClustering
+    from sklearn.metrics import adjusted_rand_score
+    from sklearn.metrics.pairwise import rbf_kernel
+    X, y = blobs
+    cc = ConsensusCluster(SpectralClustering(), n_clusters=3, n_resamples=5,
+                          random_state=0, precompute=rbf_kernel).fit(X)
+    np.testing.assert_allclose(cc.distances_, rbf_kernel(X), rtol=1e-6)
+    assert adjusted_rand_score(y, cc.labels_) == 1.0
+
+
+class _SparseOnlyKMeans(KMeans):
+    """KMeans which checks that each resample it gets is still sparse."""
+    def fit_predict(self, X, y=None, sample_weight=None):
+        assert scipy.sparse.issparse(X)
+        return super(_SparseOnlyKMeans, self).fit_predict(X)
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+@pytest.mark.parametrize('n_jobs', [None, 2])
+def test_consensus_cluster_sparse_input(blobs, executor, n_jobs):
+    X, _ = blobs
+    X = np.abs(X)
+    X[X < 1] = 0.0
+    params = dict(n_clusters=3, n_resamples=6, random_state=1,
+                  n_jobs=n_jobs, executor=executor)
+    dense = ConsensusCluster(**params).fit(X)
+    for fmt in ['csr', 'csc', 'coo']:
+        sparse_X = scipy.sparse.csr_matrix(X).asformat(fmt)
+        result = ConsensusCluster(_SparseOnlyKMeans(n_init=10),
+                                  **params).fit(sparse_X)
+        assert np.array_equal(result.connectivity_, dense.connectivity_)
+        assert np.array_equal(result.indicator_, dense.indicator_)
+        assert np.array_equal(result.labels_, dense.labels_)
+
+
+@pytest.mark.parametrize('precompute', [None, 'euclidean'])
+def test_consensus_cluster_sparse_input_dense_clusterer(blobs, precompute):
+    """Clusterers without sparse support get densified resamples."""
+    from sklearn.cluster import AgglomerativeClustering
+    X, _ = blobs
+    base = AgglomerativeClustering(linkage='average')
+    params = dict(n_clusters=3, n_resamples=6, random_state=1,
+                  precompute=precompute)
+    dense = ConsensusCluster(base, **params).fit(X)
+    result = ConsensusCluster(base, **params).fit(scipy.sparse.csr_matrix(X))
+    assert np.array_equal(result.connectivity_, dense.connectivity_)
+    assert np.array_equal(result.labels_, dense.labels_)
+
+
+def test_accepts_sparse():
+    from consensuscluster._consensus import _accepts_sparse
+    from sklearn.cluster import AgglomerativeClustering
+
+    class Untagged(object):
+        """A clusterer from before scikit-learn 1.6, with no tags."""
+
+    assert _accepts_sparse(None)
+    assert _accepts_sparse(KMeans())
+    assert not _accepts_sparse(AgglomerativeClustering())
+    assert not _accepts_sparse(Untagged())
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_consensus_cluster_predict(blobs, sparse, monkeypatch):
+    from consensuscluster import _consensus
+    from sklearn.metrics import euclidean_distances
+    # Use small batches so that predict takes several of them.
+    monkeypatch.setattr(_consensus, '_PREDICT_BATCH_SIZE', 7)
+    X, _ = blobs
+    cc = ConsensusCluster(n_clusters=3, k_range=[2, 3], n_resamples=5,
+                          random_state=0)
+    cc.fit(scipy.sparse.csr_matrix(X) if sparse else X)
+    new_X = np.random.RandomState(0).uniform(X.min(), X.max(),
+                                             size=(40, X.shape[1]))
+    closest = np.argmin(euclidean_distances(new_X, X), axis=1)
+    if sparse:
+        new_X = scipy.sparse.csr_matrix(new_X)
+    assert np.array_equal(cc.predict(new_X), cc.labels_[closest])
+    assert np.array_equal(cc.predict(new_X, k=2),
+                          cc.labels_by_k_[2][closest])
+    # The training samples are their own nearest neighbors.
+    assert np.array_equal(cc.predict(X), cc.labels_)
+
+
+def test_consensus_cluster_predict_metric(blobs):
+    from sklearn.cluster import AgglomerativeClustering
+    from sklearn.metrics import pairwise_distances
+    X, _ = blobs
+    cc = ConsensusCluster(AgglomerativeClustering(linkage='average'),
+                          n_clusters=3, n_resamples=5, random_state=0,
+                          precompute='manhattan').fit(X)
+    assert cc.neighbors_.metric == 'manhattan'
+    new_X = X[:10] + .1
+    closest = np.argmin(pairwise_distances(new_X, X, metric='manhattan'),
+                        axis=1)
+    assert np.array_equal(cc.predict(new_X), cc.labels_[closest])
+
+
+def test_consensus_cluster_predict_errors(blobs):
+    from sklearn.exceptions import NotFittedError
+    X, _ = blobs
+    cc = ConsensusCluster(n_clusters=3, n_resamples=2, random_state=0)
+    with pytest.raises(NotFittedError):
+        cc.predict(X)
+    cc.fit(X)
+    with pytest.raises(ValueError, match='features'):
+        cc.predict(X[:, :1])
+    with pytest.raises(ValueError, match='k=4'):
+        cc.predict(X, k=4)
+
+
+class _RowsOnly(object):
+    """An on-disk-like array which only supports reading rows."""
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.reads = []
+
+    def __getitem__(self, rows):
+        if not isinstance(rows, slice):
+            assert np.all(np.diff(rows) > 0)
+        self.reads.append(rows)
+        return self.data[rows]
+
+
+def _memmap_copy(X, path):
+    mm = np.memmap(str(path), dtype=X.dtype, mode='w+', shape=X.shape)
+    mm[:] = X
+    mm.flush()
+    return np.memmap(str(path), dtype=X.dtype, mode='r', shape=X.shape)
+
+
+@pytest.mark.parametrize('kind', ['memmap', 'source', 'iterator'])
+@pytest.mark.parametrize('executor,n_jobs', [('thread', None),
+                                             ('thread', 2),
+                                             ('process', 2)])
+def test_consensus_cluster_array_source(blobs, kind, executor, n_jobs,
+                                        tmpdir):
+    from consensuscluster import ArraySource
+    X, _ = blobs
+    params = dict(n_clusters=3, k_range=[2, 3], n_resamples=6,
+                  random_state=1, n_jobs=n_jobs, executor=executor)
+    expected = ConsensusCluster(**params).fit(X)
+    if kind == 'memmap':
+        source = _memmap_copy(X, tmpdir.join('X.dat'))
+    elif kind == 'source':
+        if executor == 'process':
+            # _RowsOnly would be pickled as a copy, which is fine, but
+            # then we couldn't see what was read.
+            source = ArraySource(_memmap_copy(X, tmpdir.join('X.dat')))
+        else:
+            rows_only = _RowsOnly(X)
+            source = ArraySource(rows_only)
+    else:
+        source = (X[start:start + 7] for start in range(0, len(X), 7))
+    result = ConsensusCluster(memmap_dir=str(tmpdir), **params).fit(source)
+    for k in (2, 3):
+        assert np.array_equal(result.connectivities_[k],
+                              expected.connectivities_[k])
+        assert np.array_equal(result.labels_by_k_[k],
+                              expected.labels_by_k_[k])
+    assert np.array_equal(result.indicator_, expected.indicator_)
+    assert result.neighbors_ is None
+    if kind == 'source' and executor == 'thread':
+        # Every read was either a chunk (for the check) or one resample.
+        resample_reads = [r for r in rows_only.reads
+                          if not isinstance(r, slice)]
+        assert len(resample_reads) == 6
+        assert all(len(r) == 48 for r in resample_reads)
+    with pytest.raises(ValueError, match='neighbors_'):
+        result.predict(X)
+
+
+def test_consensus_cluster_array_source_precompute(blobs, monkeypatch):
+    from sklearn.cluster import AgglomerativeClustering
+    from sklearn.metrics.pairwise import rbf_kernel
+    from consensuscluster import ArraySource
+    from consensuscluster import sources
+    # Use small chunks so that the distances are computed in blocks.
+    monkeypatch.setattr(sources, '_CHUNK_ELEMENTS', 25)
+    X, _ = blobs
+    base = AgglomerativeClustering(linkage='average')
+    params = dict(n_clusters=3, n_resamples=4, random_state=0)
+    for precompute in ['manhattan', rbf_kernel]:
+        expected = ConsensusCluster(base, precompute=precompute,
+                                    **params).fit(X)
+        result = ConsensusCluster(base, precompute=precompute,
+                                  **params).fit(ArraySource(_RowsOnly(X)))
+        np.testing.assert_allclose(result.distances_, expected.distances_,
+                                   rtol=1e-6)
+        assert np.array_equal(result.labels_, expected.labels_)
+
+
+def test_array_source_pickle_reopens_memmap(blobs, tmpdir):
+    import pickle
+    from consensuscluster import ArraySource
+    X, _ = blobs
+    source = ArraySource(_memmap_copy(X, tmpdir.join('X.dat')))
+    data = pickle.dumps(source)
+    # The pickle holds the filename, not the data.
+    assert len(data) < X.nbytes // 4
+    copy = pickle.loads(data)
+    assert isinstance(copy.data, np.memmap)
+    np.testing.assert_array_equal(copy[np.arange(0, 60, 3)], X[::3])
+    # A slice of a memmap isn't a whole file, so it's copied instead.
+    sliced = pickle.loads(pickle.dumps(ArraySource(source.data[5:])))
+    np.testing.assert_array_equal(sliced[0:3], X[5:8])
+
+
+def test_array_source_errors(blobs, tmpdir):
+    from consensuscluster import ArraySource
+    from consensuscluster.sources import spill_chunks
+    X, _ = blobs
+    with pytest.raises(ValueError, match='2-dimensional'):
+        ArraySource(X[0])
+    with pytest.raises(ValueError, match='columns'):
+        spill_chunks([X[:5], X[5:, :1]], str(tmpdir))
+    with pytest.raises(ValueError, match='No rows'):
+        spill_chunks(iter([]), str(tmpdir))
+    # Nothing is left behind by a failed spill.
+    assert tmpdir.listdir() == []
+    bad = X.copy()
+    bad[40, 0] = np.nan
+    with pytest.raises(ValueError, match='NaN'):
+        ConsensusCluster(n_resamples=2).fit(ArraySource(bad))
+    with pytest.raises(ValueError, match='minimum of 2'):
+        ConsensusCluster(n_resamples=2).fit(iter([X[:1]]))
+
+
+def _spill_files(directory):
+    return [os.path.join(root, name)
+            for (root, _, names) in os.walk(directory)
+            for name in names if name.startswith('X-')]
+
+
+def test_consensus_cluster_spill_cleanup(blobs, tmpdir):
+    X, _ = blobs
+
+    def chunks():
+        return (X[start:start + 7] for start in range(0, len(X), 7))
+
+    cc = ConsensusCluster(n_clusters=3, n_resamples=2, random_state=0,
+                          memmap_dir=str(tmpdir))
+    cc.fit(chunks())
+    first = _spill_files(str(tmpdir))
+    assert len(first) == 1
+    # A new fit replaces the previous spill rather than adding to it.
+    cc.fit(chunks())
+    assert len(_spill_files(str(tmpdir))) == 1
+    assert _spill_files(str(tmpdir)) != first
+    del cc
+    gc.collect()
+    assert _spill_files(str(tmpdir)) == []
+
+
+def test_consensus_cluster_iterator_continue(blobs):
+    X, _ = blobs
+    cc = ConsensusCluster(n_clusters=3, n_resamples=2, random_state=0,
+                          warm_start=True)
+    cc.partial_fit(iter([X]))
+    with pytest.raises(ValueError, match='iterator'):
+        cc.partial_fit(iter([X]))
+    with pytest.raises(ValueError, match='iterator'):
+        cc.fit(iter([X]))
+    # Without warm_start, fit starts over, so an iterator is fine.
+    cc.set_params(warm_start=False).fit(iter([X]))
+    assert cc.n_resamples_ == 2
+
+
+def test_spill_chunks_owns_directory(blobs):
+    from consensuscluster.sources import spill_chunks
+    X, _ = blobs
+    source = spill_chunks([X[:30], X[30:]])
+    directory = os.path.dirname(source.data.filename)
+    np.testing.assert_array_equal(source[0:60], X)
+    del source
+    gc.collect()
+    assert not os.path.exists(directory)
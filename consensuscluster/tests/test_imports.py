@@ -0,0 +1,86 @@
+"""Tests that importing the package stays cheap.
+
+Each test runs in a fresh interpreter, since the test session itself
+has long since imported everything.
+"""
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+_HEAVY_MODULES = ['sklearn', 'scipy', 'matplotlib', 'skimage']
+
+_IMPORT_BUDGET_SECONDS = 0.5
+"""How long importing the compute core may take, on top of numpy.
+
+This is very generous (it normally takes a few milliseconds), so that
+the test doesn't fail on slow CI machines. It's meant to catch someone
+adding an eager import of something heavy.
+"""
+
+
+def _run(code):
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def test_compute_core_imports_only_numpy():
+    imported = _run(
+        'import json, sys\n'
+        'import consensuscluster\n'
+        'import consensuscluster.packed\n'
+        'import consensuscluster._accumulate\n'
+        'import consensuscluster.metrics\n'
+        'import consensuscluster.plotutils\n'
+        'from consensuscluster import PackedSymmetricMatrix\n'
+        'heavy = {}\n'
+        'print(json.dumps([m for m in heavy if m in sys.modules]))\n'
+        .format(_HEAVY_MODULES))
+    assert imported == []
+
+
+def test_import_time():
+    elapsed = _run(
+        'import json, time\n'
+        'import numpy\n'
+        'start = time.perf_counter()\n'
+        'import consensuscluster\n'
+        'import consensuscluster.metrics\n'
+        'print(json.dumps(time.perf_counter() - start))\n')
+    assert elapsed < _IMPORT_BUDGET_SECONDS
+
+
+@pytest.mark.parametrize('name,module', [
+    ('ConsensusCluster', 'sklearn'),
+    ('TemplateEstimator', 'sklearn'),
+])
+def test_lazy_attributes(name, module):
+    result = _run(
+        'import json, sys\n'
+        'import consensuscluster\n'
+        'before = {module!r} in sys.modules\n'
+        'cls = getattr(consensuscluster, {name!r})\n'
+        'after = {module!r} in sys.modules\n'
+        'print(json.dumps([before, after, cls.__name__,\n'
+        '                  {name!r} in dir(consensuscluster)]))\n'
+        .format(name=name, module=module))
+    assert result == [False, True, name, True]
+
+
+def test_plotutils_loads_matplotlib_on_first_use():
+    result = _run(
+        'import json, sys\n'
+        'from consensuscluster import plotutils\n'
+        'before = "matplotlib" in sys.modules\n'
+        'norm = plotutils.NOP_NORM\n'
+        'print(json.dumps([before, "matplotlib" in sys.modules,\n'
+        '                  norm is plotutils.NOP_NORM]))\n')
+    assert result == [False, True, True]
+
+
+def test_unknown_attribute():
+    import consensuscluster
+    with pytest.raises(AttributeError):
+        consensuscluster.not_a_real_attribute
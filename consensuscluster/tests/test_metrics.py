@@ -0,0 +1,114 @@
+"""Contains tests for the CDF and delta-area utilities."""
+
+import pytest
+import numpy as np
+from matplotlib.figure import Figure
+
+from consensuscluster import PackedSymmetricMatrix
+from consensuscluster import metrics
+from consensuscluster.metrics import cdf_from_counts
+from consensuscluster.metrics import cdf_from_matrix
+from consensuscluster.metrics import evaluate_cdf
+from consensuscluster.metrics import cdf_area
+from consensuscluster.metrics import delta_area
+from consensuscluster.plotutils import plot_cdf
+from consensuscluster.plotutils import plot_delta_area
+
+
+def _random_counts(n, n_resamples, seed):
+    """Make some symmetric count matrices which look like real ones."""
+    rng = np.random.RandomState(seed)
+    indicator = rng.randint(n_resamples + 1, size=(n, n))
+    indicator = np.triu(indicator) + np.triu(indicator, 1).T
+    connectivity = (rng.random_sample((n, n)) * (indicator + 1)).astype(int)
+    connectivity = np.minimum(connectivity, indicator)
+    connectivity = np.triu(connectivity) + np.triu(connectivity, 1).T
+    return connectivity, indicator
+
+
+def _sorted_cdf(connectivity, indicator):
+    """The naive way: pull out the values and sort them."""
+    (rows, cols) = np.triu_indices(connectivity.shape[0], 1)
+    conn = connectivity[rows, cols]
+    ind = indicator[rows, cols]
+    values = np.sort(conn[ind > 0] / ind[ind > 0].astype(float))
+    (unique, counts) = np.unique(values, return_counts=True)
+    return unique, np.cumsum(counts) / float(len(values))
+
+
+@pytest.mark.parametrize('packed', [True, False])
+@pytest.mark.parametrize('n', [2, 25, 60])
+# Chunks of 50 are too small for a dense histogram of 12 resamples, so
+# they're reduced with np.unique instead.
+@pytest.mark.parametrize('chunk_elements', [50, 1000])
+def test_cdf_from_counts(n, packed, chunk_elements, monkeypatch):
+    from consensuscluster import _accumulate
+    monkeypatch.setattr(_accumulate, '_CHUNK_ELEMENTS', chunk_elements)
+    (connectivity, indicator) = _random_counts(n, 12, n)
+    (true_values, true_cdf) = _sorted_cdf(connectivity, indicator)
+    if packed:
+        connectivity = PackedSymmetricMatrix.from_dense(connectivity)
+        indicator = PackedSymmetricMatrix.from_dense(indicator)
+    (values, cdf) = cdf_from_counts(connectivity, indicator)
+    assert np.array_equal(values, true_values)
+    assert np.allclose(cdf, true_cdf)
+
+
+@pytest.mark.parametrize('packed', [True, False])
+def test_cdf_from_counts_many_resamples(packed, monkeypatch):
+    # A dense histogram over every possible (indicator, connectivity)
+    # pair would need about 10^12 bins here.
+    from consensuscluster import _accumulate
+    monkeypatch.setattr(_accumulate, '_CHUNK_ELEMENTS', 200)
+    (connectivity, indicator) = _random_counts(50, 1000000, 0)
+    connectivity = connectivity.astype(np.uint32)
+    indicator = indicator.astype(np.uint32)
+    (true_values, true_cdf) = _sorted_cdf(connectivity, indicator)
+    if packed:
+        connectivity = PackedSymmetricMatrix.from_dense(connectivity)
+        indicator = PackedSymmetricMatrix.from_dense(indicator)
+    (values, cdf) = cdf_from_counts(connectivity, indicator)
+    assert np.array_equal(values, true_values)
+    assert np.allclose(cdf, true_cdf)
+
+
+def test_cdf_from_matrix():
+    (connectivity, indicator) = _random_counts(40, 10, 0)
+    indicator = np.maximum(indicator, 1)
+    cmat = connectivity / indicator.astype(float)
+    (true_values, true_cdf) = _sorted_cdf(connectivity, indicator)
+    (values, cdf) = cdf_from_matrix(cmat, n_bins=1000)
+    # The binned CDF should agree with the exact one at the bin edges
+    # (up to floating-point error in the edges themselves).
+    assert np.allclose(cdf, evaluate_cdf(true_values, true_cdf,
+                                         values + 1e-12))
+
+
+def test_evaluate_cdf():
+    values = np.array([0.0, 0.5, 1.0])
+    cdf = np.array([0.25, 0.5, 1.0])
+    points = [-1.0, 0.0, 0.3, 0.5, 0.99, 1.0]
+    assert np.array_equal(evaluate_cdf(values, cdf, points),
+                          [0.0, 0.25, 0.25, 0.5, 0.5, 1.0])
+
+
+def test_cdf_area_and_delta():
+    values = np.array([0.0, 0.5, 1.0])
+    assert cdf_area(values, np.array([0.5, 0.5, 1.0])) == .75
+    assert cdf_area(values, np.array([0.25, 0.5, 1.0])) == .75
+    assert cdf_area(np.array([1.0]), np.array([1.0])) == 0.0
+    deltas = delta_area({2: .5, 3: .75, 4: .75})
+    assert deltas == {2: .5, 3: .5, 4: 0.0}
+
+
+def test_plot_cdf():
+    cdfs = {}
+    for k in [2, 3]:
+        cdfs[k] = cdf_from_counts(*_random_counts(20, 5, k))
+    fig = Figure()
+    (ax1, ax2) = fig.subplots(1, 2)
+    lines = plot_cdf(cdfs, ax1, 0)
+    assert len(lines) == 2
+    areas = dict((k, cdf_area(*cdfs[k])) for k in cdfs)
+    line = plot_delta_area(delta_area(areas), ax2, 0)
+    assert list(line.get_xdata()) == [2, 3]
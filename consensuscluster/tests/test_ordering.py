@@ -0,0 +1,91 @@
+"""Contains tests for consensus_order."""
+
+import pytest
+import numpy as np
+
+from consensuscluster import PackedSymmetricMatrix
+from consensuscluster import ordering
+from consensuscluster.ordering import consensus_order
+
+
+def _shuffled_blocks(sizes, seed):
+    """Make a noisy block consensus matrix with its samples shuffled.
+
+    Blocks 0 and 1 (if there are two) have a fairly high consensus
+    between them, and every
+    other pair of blocks has none.
+
+    Returns
+    -------
+    cmat : ndarray
+        The shuffled consensus matrix.
+
+    labels : ndarray
+        The block of each (shuffled) sample.
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.repeat(np.arange(len(sizes)), sizes)
+    between = np.zeros((len(sizes), len(sizes)))
+    if len(sizes) > 1:
+        between[0, 1] = between[1, 0] = .6
+    np.fill_diagonal(between, 1.0)
+    cmat = between[labels][:, labels]
+    noise = rng.uniform(0, .1, size=cmat.shape)
+    cmat = np.abs(cmat - (noise + noise.T) / 2)
+    np.fill_diagonal(cmat, 1.0)
+    shuffle = rng.permutation(len(labels))
+    return cmat[np.ix_(shuffle, shuffle)], labels[shuffle]
+
+
+def _check_order(order, labels):
+    """Check that order is a permutation which keeps clusters together."""
+    assert np.array_equal(np.sort(order), np.arange(len(labels)))
+    ordered = labels[order]
+    # Each label appears in exactly one contiguous run.
+    runs = ordered[np.insert(np.diff(ordered) != 0, 0, True)]
+    assert len(runs) == len(np.unique(labels))
+
+
+@pytest.mark.parametrize('max_block_size', [0, 15, 500])
+@pytest.mark.parametrize('storage', ['dense', 'packed'])
+def test_consensus_order(max_block_size, storage, monkeypatch):
+    # Use tiny stripes so that the streaming code is exercised.
+    monkeypatch.setattr(ordering, '_CHUNK_ELEMENTS', 200)
+    (cmat, labels) = _shuffled_blocks([30, 10, 25, 1, 2], 0)
+    mat = cmat
+    if storage == 'packed':
+        mat = PackedSymmetricMatrix.from_dense(cmat)
+    order = consensus_order(mat, labels, max_block_size=max_block_size)
+    _check_order(order, labels)
+    # Clusters 0 and 1 should be next to each other.
+    ordered = labels[order]
+    runs = list(ordered[np.insert(np.diff(ordered) != 0, 0, True)])
+    assert abs(runs.index(0) - runs.index(1)) == 1
+    # The result doesn't depend on how the matrix is stored.
+    assert np.array_equal(
+        order, consensus_order(cmat, labels, max_block_size=max_block_size))
+
+
+def test_consensus_order_big_blocks():
+    """Samples in big blocks are sorted by their consensus with the block."""
+    (cmat, labels) = _shuffled_blocks([20, 20], 1)
+    # Make one sample an outlier in its cluster.
+    outlier = np.flatnonzero(labels == 0)[0]
+    row = cmat[outlier].copy()
+    row[labels == 0] /= 4
+    row[outlier] = 1.0
+    cmat[outlier] = cmat[:, outlier] = row
+    order = consensus_order(cmat, labels, max_block_size=0)
+    _check_order(order, labels)
+    block = order[labels[order] == 0]
+    assert block[-1] == outlier
+
+
+def test_consensus_order_single_cluster():
+    (cmat, labels) = _shuffled_blocks([7], 2)
+    _check_order(consensus_order(cmat, labels), labels)
+
+
+def test_consensus_order_bad_labels():
+    with pytest.raises(ValueError):
+        consensus_order(np.eye(5), np.zeros(4))
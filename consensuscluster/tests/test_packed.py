@@ -0,0 +1,104 @@
+"""Contains unit tests for PackedSymmetricMatrix."""
+
+import pytest
+import numpy as np
+
+from consensuscluster import PackedSymmetricMatrix
+
+
+def _random_symmetric(n, seed):
+    rng = np.random.RandomState(seed)
+    mat = rng.random_sample((n, n))
+    return mat + mat.T
+
+
+@pytest.mark.parametrize('n', [1, 2, 7, 30])
+def test_round_trip(n):
+    mat = _random_symmetric(n, n)
+    packed = PackedSymmetricMatrix.from_dense(mat)
+    assert packed.shape == (n, n)
+    assert packed.data.shape == (n * (n + 1) // 2,)
+    assert np.array_equal(packed.to_dense(), mat)
+    for i in range(n):
+        assert np.array_equal(packed.row(i), mat[i])
+
+
+@pytest.mark.parametrize(
+    'bounds',
+    [(0, 30, 0, 30), (3, 9, 0, 30), (10, 20, 2, 5), (2, 5, 10, 20),
+     (5, 25, 7, 11), (4, 4, 0, 30), (29, 30, 29, 30)]
+)
+def test_tile(bounds):
+    (r0, r1, c0, c1) = bounds
+    mat = _random_symmetric(30, 0)
+    packed = PackedSymmetricMatrix.from_dense(mat)
+    assert np.array_equal(packed.tile(r0, r1, c0, c1), mat[r0:r1, c0:c1])
+    assert np.array_equal(packed.rows(r0, r1), mat[r0:r1])
+
+
+def test_take():
+    mat = _random_symmetric(30, 1)
+    packed = PackedSymmetricMatrix.from_dense(mat)
+    rng = np.random.RandomState(0)
+    rows = rng.permutation(30)[:12]
+    cols = rng.randint(30, size=20)
+    assert np.array_equal(packed.take(rows, cols), mat[np.ix_(rows, cols)])
+    with pytest.raises(IndexError):
+        packed.take([0, 30], [1])
+
+
+def test_tile_out_of_range():
+    packed = PackedSymmetricMatrix(5)
+    with pytest.raises(IndexError):
+        packed.tile(0, 6, 0, 5)
+
+
+def test_condensed():
+    from scipy.spatial.distance import squareform
+    mat = _random_symmetric(12, 1)
+    packed = PackedSymmetricMatrix.from_dense(mat)
+    assert np.array_equal(packed.condensed(),
+                          squareform(mat, checks=False))
+
+
+@pytest.mark.parametrize('tile_len', [1, 3, 4, 9])
+def test_add_upper_tile(tile_len):
+    n = 9
+    mat = _random_symmetric(n, 2)
+    packed = PackedSymmetricMatrix(n)
+    for row_start in range(0, n, tile_len):
+        row_stop = min(row_start + tile_len, n)
+        for col_start in range(row_start, n, tile_len):
+            col_stop = min(col_start + tile_len, n)
+            packed.add_upper_tile(row_start, col_start,
+                                  mat[row_start:row_stop, col_start:col_stop])
+    assert np.array_equal(packed.to_dense(), mat)
+
+
+def test_iadd():
+    a = _random_symmetric(6, 3)
+    b = _random_symmetric(6, 4)
+    packed = PackedSymmetricMatrix.from_dense(a)
+    packed += PackedSymmetricMatrix.from_dense(b)
+    assert np.allclose(packed.to_dense(), a + b)
+
+
+def test_bad_data_shape():
+    with pytest.raises(ValueError):
+        PackedSymmetricMatrix(4, data=np.zeros(11))
+
+
+def test_memmap(tmpdir):
+    import pickle
+    mat = _random_symmetric(10, 5)
+    filename = str(tmpdir.join('packed.dat'))
+    packed = PackedSymmetricMatrix.memmap(filename, 10)
+    assert packed.filename is not None
+    packed += PackedSymmetricMatrix.from_dense(mat)
+    # Pickling should only record the file, and unpickling should see
+    # the data which was written to it.
+    unpickled = pickle.loads(pickle.dumps(packed))
+    assert isinstance(unpickled.data, np.memmap)
+    assert np.array_equal(unpickled.to_dense(), mat)
+    reopened = PackedSymmetricMatrix.memmap(filename, 10, mode='r')
+    assert np.array_equal(reopened.to_dense(), mat)
@@ -0,0 +1,320 @@
+"""Contains tests for plot_consensus_heatmap and its helpers."""
+
+import pytest
+import numpy as np
+from matplotlib.figure import Figure
+
+from consensuscluster import ConsensusRatio
+from consensuscluster import PackedSymmetricMatrix
+from consensuscluster import plotutils
+from consensuscluster.plotutils import plot_consensus_heatmap
+from consensuscluster.plotutils import _downsample_stripes
+
+
+def _block_cmat(n, n_blocks, seed):
+    """Make a noisy, block-diagonal, symmetric "consensus matrix"."""
+    rng = np.random.RandomState(seed)
+    labels = np.sort(rng.randint(n_blocks, size=n))
+    cmat = (labels[:, None] == labels[None, :]).astype(np.float64)
+    noise = rng.uniform(0, .2, size=(n, n))
+    cmat = np.abs(cmat - (noise + noise.T) / 2)
+    return cmat
+
+
+def _square_fig(scale=1.0, dpi=100):
+    """Make a Figure with a single Axes which _get_ax_size sees as square.
+
+    plot_consensus_heatmap requires that _get_ax_size report the same
+    width and height. Since _get_ax_size scales the width and height by
+    different fudge factors, the Figure's aspect ratio has to undo them.
+    """
+    fig = Figure(figsize=(1.365 * scale, 1.411 * scale), dpi=dpi)
+    return fig, fig.add_axes([0, 0, 1, 1])
+
+
+def _overlaps(n, target_len):
+    """Brute-force the overlap of each sample with each bin.
+
+    Sample i covers [i, i+1) and bin b covers
+    [b * n / target_len, (b+1) * n / target_len).
+    """
+    overlaps = np.zeros((n, target_len))
+    width = n / float(target_len)
+    for i in range(n):
+        for b in range(target_len):
+            overlaps[i, b] = max(
+                min(i + 1, (b + 1) * width) - max(i, b * width), 0.0)
+    return overlaps
+
+
+@pytest.mark.parametrize('n', [10, 99, 100, 517])
+@pytest.mark.parametrize('target_len', [1, 3, 10, 77])
+@pytest.mark.parametrize('mode', ['mean', 'max', 'min'])
+def test_downsample_stripes(n, target_len, mode, monkeypatch):
+    if target_len > n:
+        return
+    # Use tiny stripes so that bins get split between stripes.
+    monkeypatch.setattr(plotutils, '_CHUNK_ELEMENTS', 3 * n)
+    cmat = _block_cmat(n, 3, n)
+    out = _downsample_stripes(cmat, target_len, mode)
+    assert out.shape == (target_len, target_len)
+
+    overlaps = _overlaps(n, target_len)
+    if mode == 'mean':
+        expected = overlaps.T.dot(cmat).dot(overlaps)
+        expected /= (n / float(target_len)) ** 2
+    else:
+        reduce = np.max if mode == 'max' else np.min
+        expected = np.empty((target_len, target_len))
+        for a in range(target_len):
+            for b in range(target_len):
+                block = cmat[overlaps[:, a] > 1e-9][:, overlaps[:, b] > 1e-9]
+                expected[a, b] = reduce(block)
+    assert np.allclose(out, expected)
+
+
+def test_downsample_stripes_bad_mode():
+    with pytest.raises(ValueError):
+        _downsample_stripes(np.eye(10), 5, 'median')
+
+
+def test_downsample_stripes_packed():
+    cmat = _block_cmat(300, 4, 0)
+    packed = PackedSymmetricMatrix.from_dense(cmat)
+    assert np.allclose(_downsample_stripes(packed, 70),
+                       _downsample_stripes(cmat, 70))
+
+
+@pytest.mark.parametrize('storage', ['dense', 'packed'])
+def test_downsample_stripes_order(storage, monkeypatch):
+    n = 250
+    monkeypatch.setattr(plotutils, '_CHUNK_ELEMENTS', 7 * n)
+    cmat = _block_cmat(n, 4, 2)
+    order = np.random.RandomState(0).permutation(n)
+    mat = cmat
+    if storage == 'packed':
+        mat = PackedSymmetricMatrix.from_dense(cmat)
+    assert np.allclose(_downsample_stripes(mat, 60, order=order),
+                       _downsample_stripes(cmat[np.ix_(order, order)], 60))
+
+
+def test_downsample_stripes_memmap(tmpdir):
+    cmat = _block_cmat(300, 4, 0)
+    mmap = np.memmap(str(tmpdir.join('cmat.dat')), dtype=np.float64,
+                     mode='w+', shape=cmat.shape)
+    mmap[:] = cmat
+    assert np.allclose(_downsample_stripes(mmap, 70),
+                       _downsample_stripes(cmat, 70))
+
+
+@pytest.mark.parametrize('downsample', [True, False])
+@pytest.mark.parametrize('storage', ['dense', 'packed', 'memmap'])
+@pytest.mark.parametrize('mode', ['mean', 'max'])
+def test_plot_consensus_heatmap(downsample, storage, mode, tmpdir):
+    n = 400
+    cmat = _block_cmat(n, 3, 1)
+    if storage == 'packed':
+        mat = PackedSymmetricMatrix.from_dense(cmat)
+    elif storage == 'memmap':
+        mat = np.memmap(str(tmpdir.join('cmat.dat')), dtype=np.float64,
+                        mode='w+', shape=cmat.shape)
+        mat[:] = cmat
+    else:
+        mat = cmat
+    fig, ax = _square_fig()
+    img = plot_consensus_heatmap(mat, ax, fig, 'Blues', downsample, 0,
+                                 downsample_mode=mode)
+    shape = img.get_array().shape
+    if downsample:
+        assert shape[0] == shape[1] < n
+    else:
+        assert shape == (n, n)
+
+
+@pytest.mark.parametrize('downsample', [True, False])
+@pytest.mark.parametrize('storage', ['dense', 'packed'])
+def test_plot_consensus_heatmap_order(downsample, storage):
+    n = 400
+    cmat = _block_cmat(n, 3, 1)
+    order = np.random.RandomState(1).permutation(n)
+    shuffled = np.empty_like(cmat)
+    # Undo the permutation, so that plotting shuffled in the given
+    # order shows the original block matrix.
+    shuffled[np.ix_(order, order)] = cmat
+    mat = shuffled
+    if storage == 'packed':
+        mat = PackedSymmetricMatrix.from_dense(shuffled)
+    fig, ax = _square_fig()
+    expected = plot_consensus_heatmap(cmat, ax, fig, 'Blues', downsample, 0)
+    fig, ax = _square_fig()
+    img = plot_consensus_heatmap(mat, ax, fig, 'Blues', downsample, 0,
+                                 order=order)
+    assert np.allclose(img.get_array(), expected.get_array())
+
+
+@pytest.mark.parametrize('downsample', [True, False])
+def test_plot_consensus_heatmap_counts(downsample):
+    rng = np.random.RandomState(3)
+    n = 300
+    indicator = rng.randint(1, 50, size=(n, n)).astype(np.uint16)
+    indicator = indicator + indicator.T
+    connectivity = (indicator * _block_cmat(n, 3, 2)).astype(np.uint16)
+    cmat = connectivity / indicator.astype(np.float64)
+    fig, ax = _square_fig()
+    expected = plot_consensus_heatmap(cmat, ax, fig, 'Blues', downsample, 0)
+    for counts in [(connectivity, indicator),
+                   ConsensusRatio(PackedSymmetricMatrix.from_dense(connectivity),
+                                  PackedSymmetricMatrix.from_dense(indicator))]:
+        fig, ax = _square_fig()
+        img = plot_consensus_heatmap(counts, ax, fig, 'Blues', downsample, 0)
+        assert np.allclose(img.get_array(), expected.get_array())
+
+
+@pytest.mark.parametrize('cmap', ['Blues', 'viridis', 'tab10'])
+def test_colorize_matches_colormap(cmap):
+    from matplotlib.cm import ScalarMappable
+    values = np.random.RandomState(0).uniform(size=(40, 40))
+    values[0, :3] = [0.0, 1.0, .5]
+    (indices, lut) = plotutils._colorize(values, cmap)
+    assert indices.dtype == np.uint8
+    expected = ScalarMappable(norm=plotutils.NOP_NORM,
+                              cmap=cmap).to_rgba(values, bytes=True)
+    np.testing.assert_array_equal(lut[indices], expected)
+
+
+@pytest.mark.parametrize('downsample', [True, False])
+def test_plot_consensus_heatmap_rasterize(downsample):
+    cmat = _block_cmat(300, 4, 0)
+    (fig, ax) = _square_fig(scale=.5)
+    img = plot_consensus_heatmap(cmat, ax, fig, 'Blues', downsample, 0,
+                                 rasterize=True)
+    rgba = img.get_array()
+    assert rgba.dtype == np.uint8
+    side_len = 300
+    if downsample:
+        # Downsampled all the way to the Axes' size in pixels.
+        side_len = int(round(ax.get_window_extent().width))
+        assert side_len < 300
+    assert rgba.shape == (side_len, side_len, 4)
+    values = cmat
+    if downsample:
+        values = _downsample_stripes(cmat, side_len)
+    (indices, lut) = plotutils._colorize(values, 'Blues')
+    np.testing.assert_array_equal(rgba, lut[indices])
+    # The colorbar still works off of cmap and NOP_NORM.
+    assert img.norm is plotutils.NOP_NORM
+    assert img.get_cmap().name == 'Blues'
+
+
+@pytest.mark.parametrize('size', [50, 120, 400])
+def test_render_consensus_heatmap(size):
+    import io
+    from matplotlib.image import imread
+    cmat = _block_cmat(120, 3, 0)
+    order = np.random.RandomState(1).permutation(120)
+    png = io.BytesIO()
+    rgba = plotutils.render_consensus_heatmap(cmat, size, 'viridis',
+                                              filename=png, order=order)
+    assert rgba.shape == (size, size, 4)
+    assert rgba.dtype == np.uint8
+    values = cmat[np.ix_(order, order)]
+    if size < 120:
+        values = _downsample_stripes(values, size)
+    (indices, lut) = plotutils._colorize(values, 'viridis')
+    if size > 120:
+        # Each value is repeated to cover the pixels it's nearest to.
+        nearest = np.arange(size) * 120 // size
+        indices = indices[nearest][:, nearest]
+    np.testing.assert_array_equal(rgba, lut[indices])
+    png.seek(0)
+    saved = np.round(imread(png, format='png') * 255).astype(np.uint8)
+    np.testing.assert_array_equal(saved, rgba)
+
+
+@pytest.mark.parametrize('size', [0, -3, 2.5])
+def test_render_consensus_heatmap_bad_size(size):
+    with pytest.raises(ValueError, match='size'):
+        plotutils.render_consensus_heatmap(_block_cmat(10, 2, 0), size,
+                                           'Blues')
+
+
+@pytest.mark.parametrize('n_jobs', [None, 3])
+def test_plot_consensus_grid(n_jobs):
+    ks = [2, 3, 4, 5, 6]
+    mats = dict((k, _block_cmat(200, k, k)) for k in ks)
+    orders = {3: np.random.RandomState(0).permutation(200)}
+    # Also pass one matrix as counts.
+    mats[4] = (np.round(mats[4] * 10).astype(np.uint16),
+               np.full((200, 200), 10, dtype=np.uint16))
+    fig = Figure(figsize=(6, 4), dpi=50)
+    images = plotutils.plot_consensus_grid(mats, fig, 'Blues', 0,
+                                           orders=orders, n_jobs=n_jobs)
+    assert sorted(images) == ks
+    assert len(fig.axes) == len(ks)
+    (side_len, _) = plotutils._grid_geometry(fig, len(ks), 3)
+    assert side_len < 200
+    for k in ks:
+        image = images[k]
+        extent = image.axes.get_window_extent()
+        assert round(extent.width) == round(extent.height) == side_len
+        assert image.axes.get_title() == 'K={}'.format(k)
+        values = mats[k]
+        if k == 4:
+            values = values[0] / 10.0
+        if k in orders:
+            values = values[np.ix_(orders[k], orders[k])]
+        (indices, lut) = plotutils._colorize(
+            _downsample_stripes(values, side_len), 'Blues')
+        np.testing.assert_array_equal(image.get_array(), lut[indices])
+
+
+def test_plot_consensus_grid_n_cols():
+    mats = dict((k, _block_cmat(30, k, k)) for k in [2, 3, 4])
+    fig = Figure(figsize=(6, 2), dpi=50)
+    images = plotutils.plot_consensus_grid(mats, fig, 'Blues', 0, n_cols=3)
+    lefts = [images[k].axes.get_position().x0 for k in [2, 3, 4]]
+    bottoms = [images[k].axes.get_position().y0 for k in [2, 3, 4]]
+    assert lefts == sorted(lefts)
+    assert len(set(np.round(bottoms, 6))) == 1
+
+
+def test_plot_consensus_grid_errors():
+    with pytest.raises(ValueError, match='empty'):
+        plotutils.plot_consensus_grid({}, Figure(), 'Blues', 0)
+    mats = dict((k, _block_cmat(30, k, k)) for k in range(2, 12))
+    with pytest.raises(ValueError, match='too small'):
+        plotutils.plot_consensus_grid(mats, Figure(figsize=(.5, .5), dpi=20),
+                                      'Blues', 0)
+
+
+@pytest.mark.parametrize('n_jobs', [2, 3, 7])
+@pytest.mark.parametrize('mode', ['mean', 'max', 'min'])
+@pytest.mark.parametrize('storage', ['dense', 'packed', 'counts'])
+def test_downsample_stripes_n_jobs(n_jobs, mode, storage, monkeypatch):
+    # Use tiny stripes so that each thread reads several of them.
+    monkeypatch.setattr(plotutils, '_CHUNK_ELEMENTS', 5 * 157)
+    cmat = _block_cmat(157, 4, 0)
+    order = np.random.RandomState(0).permutation(157)
+    if storage == 'packed':
+        mat = PackedSymmetricMatrix.from_dense(cmat)
+    elif storage == 'counts':
+        mat = ConsensusRatio(np.round(cmat * 20).astype(np.uint16),
+                             np.full((157, 157), 20, dtype=np.uint16))
+    else:
+        mat = cmat
+    for target_len in [1, 10, 23, 100]:
+        expected = _downsample_stripes(mat, target_len, mode, order)
+        result = _downsample_stripes(mat, target_len, mode, order,
+                                     n_jobs=n_jobs)
+        np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+
+def test_plot_consensus_heatmap_n_jobs():
+    cmat = _block_cmat(400, 3, 0)
+    images = []
+    for n_jobs in [None, 4]:
+        (fig, ax) = _square_fig(scale=.5)
+        images.append(plot_consensus_heatmap(cmat, ax, fig, 'Blues', True, 0,
+                                             n_jobs=n_jobs).get_array())
+    assert images[0].shape[0] < 400
+    np.testing.assert_allclose(images[1], images[0], rtol=1e-12)
@@ -0,0 +1,102 @@
+"""Contains tests for saving and loading fitted results."""
+
+import json
+import os
+
+import pytest
+import numpy as np
+from matplotlib.figure import Figure
+from sklearn.datasets import make_blobs
+
+from consensuscluster import ConsensusCluster
+from consensuscluster import ConsensusRatio
+from consensuscluster import PackedSymmetricMatrix
+from consensuscluster.metrics import cdf_from_counts
+from consensuscluster.ordering import consensus_order
+from consensuscluster.plotutils import plot_cdf
+from consensuscluster.plotutils import plot_consensus_heatmap
+from consensuscluster.results import load_results
+from consensuscluster.results import save_results
+
+
+def _dense(mat):
+    if isinstance(mat, PackedSymmetricMatrix):
+        return mat.to_dense()
+    return mat
+
+
+@pytest.fixture
+def blobs():
+    X, _ = make_blobs(n_samples=50, centers=3, cluster_std=2.0,
+                      random_state=0)
+    return X
+
+
+@pytest.mark.parametrize('storage', ['dense', 'packed', 'memmap'])
+def test_save_load_results(blobs, storage, tmpdir):
+    est = ConsensusCluster(n_clusters=3, k_range=[2, 3, 4], n_resamples=8,
+                           random_state=0, storage=storage).fit(blobs)
+    directory = str(tmpdir.join('results'))
+    save_results(est, directory)
+    results = load_results(directory)
+
+    assert results.n_clusters == 3
+    assert results.n_resamples == 8
+    assert isinstance(results.indicator.data, np.memmap)
+    assert results.indicator.dtype == np.uint16
+    np.testing.assert_array_equal(results.indicator.to_dense(),
+                                  _dense(est.indicator_))
+    for k in (2, 3, 4):
+        connectivity = results.connectivities[k]
+        assert isinstance(connectivity.data, np.memmap)
+        np.testing.assert_array_equal(connectivity.to_dense(),
+                                      _dense(est.connectivities_[k]))
+        assert isinstance(results.consensus_matrices[k], ConsensusRatio)
+        np.testing.assert_allclose(results.consensus_matrices[k].to_dense(),
+                                   _dense(est.consensus_matrices_[k]))
+        np.testing.assert_array_equal(results.labels_by_k[k],
+                                      est.labels_by_k_[k])
+        np.testing.assert_array_equal(
+            results.orders_by_k[k],
+            consensus_order(est.consensus_matrices_[k], est.labels_by_k_[k]))
+        (values, cdf) = cdf_from_counts(est.connectivities_[k],
+                                        est.indicator_)
+        np.testing.assert_array_equal(results.cdfs[k][0], values)
+        np.testing.assert_array_equal(results.cdfs[k][1], cdf)
+    assert sorted(results.delta_areas) == [2, 3, 4]
+    assert results.delta_areas[2] == results.areas[2]
+
+
+def test_plot_loaded_results(blobs, tmpdir):
+    est = ConsensusCluster(n_clusters=3, n_resamples=6,
+                           random_state=0).fit(blobs)
+    directory = str(tmpdir)
+    save_results(est, directory)
+    results = load_results(directory)
+    order = results.orders_by_k[3]
+    images = []
+    for cmat in (est.consensus_matrix_, results.consensus_matrices[3]):
+        # See _square_fig in test_plot_consensus_heatmap.py.
+        fig = Figure(figsize=(1.365 * .3, 1.411 * .3), dpi=100)
+        ax = fig.add_axes([0, 0, 1, 1])
+        plot_consensus_heatmap(cmat, ax, fig, 'Blues', True, 0, order=order)
+        images.append(ax.get_images()[0].get_array())
+    np.testing.assert_allclose(images[1], images[0])
+    fig = Figure()
+    assert len(plot_cdf(results.cdfs, fig.add_subplot(1, 1, 1), 0)) == 1
+
+
+def test_results_errors(blobs, tmpdir):
+    directory = str(tmpdir)
+    with pytest.raises(ValueError, match='fitted'):
+        save_results(ConsensusCluster(), directory)
+    save_results(ConsensusCluster(n_clusters=3, n_resamples=2,
+                                  random_state=0).fit(blobs), directory)
+    path = os.path.join(directory, 'results.json')
+    with open(path) as f:
+        meta = json.load(f)
+    meta['format_version'] = 99
+    with open(path, 'w') as f:
+        json.dump(meta, f)
+    with pytest.raises(ValueError, match='format version 99'):
+        load_results(directory)
@@ -0,0 +1,195 @@
+"""Contains tests for the sparse, thresholded consensus matrices."""
+
+import pytest
+import numpy as np
+import scipy.sparse
+
+from matplotlib.figure import Figure
+
+from consensuscluster import ConsensusCluster
+from consensuscluster import ConsensusRatio
+from consensuscluster import PackedSymmetricMatrix
+from consensuscluster import sparse
+from consensuscluster.sparse import threshold_consensus
+from consensuscluster._validation import check_consensus_matrix
+from consensuscluster.metrics import cdf_from_matrix
+from consensuscluster.ordering import consensus_order
+from consensuscluster import plotutils
+from consensuscluster.plotutils import _downsample_sparse
+from consensuscluster.plotutils import plot_consensus_heatmap
+from consensuscluster.plotutils import _downsample_stripes
+
+
+def _counts(n, n_resamples=20, seed=0):
+    """Make random (connectivity, indicator) counts with lots of zeros."""
+    rng = np.random.RandomState(seed)
+    indicator = rng.randint(1, n_resamples + 1, size=(n, n))
+    indicator = np.triu(indicator) + np.triu(indicator, 1).T
+    connectivity = rng.randint(0, n_resamples + 1, size=(n, n))
+    connectivity = np.triu(connectivity) + np.triu(connectivity, 1).T
+    connectivity = np.minimum(connectivity, indicator)
+    connectivity[rng.uniform(size=(n, n)) < .7] = 0
+    connectivity = np.triu(connectivity) + np.triu(connectivity, 1).T
+    np.fill_diagonal(indicator, n_resamples)
+    np.fill_diagonal(connectivity, n_resamples)
+    return connectivity.astype(np.uint16), indicator.astype(np.uint16)
+
+
+def _cmat(n, seed=0):
+    (connectivity, indicator) = _counts(n, seed=seed)
+    return connectivity / indicator.astype(np.float64)
+
+
+@pytest.mark.parametrize('kind', ['dense', 'packed', 'ratio'])
+@pytest.mark.parametrize('n', [0, 1, 7, 60])
+@pytest.mark.parametrize('threshold', [.05, .5, 1.0])
+def test_threshold_consensus(kind, n, threshold, monkeypatch):
+    # Use small stripes so that there's more than one of them.
+    monkeypatch.setattr(sparse, '_CHUNK_ELEMENTS', 100)
+    (connectivity, indicator) = _counts(n)
+    cmat = connectivity / indicator.astype(np.float64) if n else \
+        np.zeros((0, 0))
+    if kind == 'dense':
+        mat = cmat
+    elif kind == 'packed':
+        mat = PackedSymmetricMatrix.from_dense(cmat)
+    else:
+        mat = ConsensusRatio(connectivity, indicator)
+    result = threshold_consensus(mat, threshold)
+    assert scipy.sparse.isspmatrix_csr(result)
+    assert result.dtype == np.float64
+    expected = np.where(cmat >= threshold, cmat, 0.0)
+    np.testing.assert_array_equal(result.toarray(), expected)
+    assert result.nnz == np.count_nonzero(cmat >= threshold)
+
+
+@pytest.mark.parametrize('threshold', [0, -.5, 1.5])
+def test_threshold_consensus_bad_threshold(threshold):
+    with pytest.raises(ValueError):
+        threshold_consensus(_cmat(5), threshold)
+
+
+@pytest.mark.parametrize('mode', ['mean', 'max', 'min'])
+@pytest.mark.parametrize('target_len', [1, 7, 13, 40])
+@pytest.mark.parametrize('use_order', [False, True])
+def test_downsample_sparse_matches_dense(mode, target_len, use_order,
+                                         monkeypatch):
+    # Use small chunks so that there's more than one of them.
+    monkeypatch.setattr(plotutils, '_CHUNK_ELEMENTS', 50)
+    cmat = np.where(_cmat(40) >= .3, _cmat(40), 0.0)
+    # Make one block fully stored, so that min has something to find.
+    cmat[:10, :10] = .5
+    order = np.random.RandomState(1).permutation(40) if use_order else None
+    expected = _downsample_stripes(cmat, target_len, mode, order)
+    result = _downsample_sparse(scipy.sparse.csr_matrix(cmat), target_len,
+                                mode, order)
+    np.testing.assert_allclose(result, expected, atol=1e-12)
+
+
+def test_downsample_sparse_non_canonical():
+    # Duplicate entries in a COO matrix are added together.
+    coo = scipy.sparse.coo_matrix(([.25, .25, .5, .5], ([0, 0, 1, 2],
+                                                        [1, 1, 0, 2])),
+                                  shape=(4, 4))
+    np.testing.assert_allclose(
+        _downsample_sparse(coo, 2, 'max'),
+        _downsample_stripes(coo.toarray(), 2, 'max'))
+
+
+def test_cdf_from_matrix_sparse():
+    cmat = np.where(_cmat(50) >= .3, _cmat(50), 0.0)
+    (values, cdf) = cdf_from_matrix(scipy.sparse.csr_matrix(cmat))
+    (expected_values, expected_cdf) = cdf_from_matrix(cmat)
+    np.testing.assert_array_equal(values, expected_values)
+    np.testing.assert_allclose(cdf, expected_cdf)
+
+
+@pytest.mark.parametrize('mode', ['sampled', 'full'])
+def test_check_consensus_matrix_sparse(mode):
+    cmat = scipy.sparse.csr_matrix(np.where(_cmat(30) >= .3, _cmat(30), 0.0))
+    check_consensus_matrix(cmat, mode)
+    check_consensus_matrix(cmat.tocoo(), mode)
+
+    bad_range = cmat.copy()
+    bad_range.data[:] = 2.0
+    with pytest.raises(ValueError, match='in \\[0,1\\]'):
+        check_consensus_matrix(bad_range, mode)
+
+    asymmetric = scipy.sparse.csr_matrix(([.5], ([0], [1])), shape=(30, 30))
+    with pytest.raises(ValueError, match='symmetric'):
+        check_consensus_matrix(asymmetric, 'full')
+
+    with pytest.raises(ValueError, match='square'):
+        check_consensus_matrix(scipy.sparse.csr_matrix((3, 4)), mode)
+
+
+def test_check_consensus_matrix_sparse_none(monkeypatch):
+    # 'none' mode shouldn't even make the canonical CSR copy.
+    cmat = scipy.sparse.csr_matrix(([2.0], ([0], [1])), shape=(30, 30))
+
+    def tocsr(*args, **kwargs):
+        raise AssertionError('tocsr was called')
+
+    monkeypatch.setattr(cmat, 'tocsr', tocsr)
+    check_consensus_matrix(cmat, 'none')
+
+
+@pytest.mark.parametrize('max_block_size', [0, 500])
+def test_consensus_order_sparse(max_block_size):
+    rng = np.random.RandomState(0)
+    labels = rng.randint(4, size=80)
+    cmat = np.where(labels[:, np.newaxis] == labels, .9, 0.0)
+    cmat[rng.uniform(size=(80, 80)) < .2] = 0.0
+    cmat = np.minimum(cmat, cmat.T)
+    np.fill_diagonal(cmat, 1.0)
+    sparse_order = consensus_order(scipy.sparse.csr_matrix(cmat), labels,
+                                   max_block_size)
+    dense_order = consensus_order(cmat, labels, max_block_size)
+    np.testing.assert_array_equal(np.sort(sparse_order), np.arange(80))
+    # The sums are computed differently, so ties might be broken
+    # differently, but each cluster must still be contiguous.
+    changes = np.count_nonzero(np.diff(labels[sparse_order]))
+    assert changes == 3
+    np.testing.assert_array_equal(labels[sparse_order], labels[dense_order])
+
+
+@pytest.mark.parametrize('downsample', [False, True])
+def test_plot_consensus_heatmap_sparse(downsample):
+    cmat = np.where(_cmat(60) >= .3, _cmat(60), 0.0)
+    order = np.random.RandomState(0).permutation(60)
+    images = []
+    for mat in (cmat, scipy.sparse.csr_matrix(cmat)):
+        # See _square_fig in test_plot_consensus_heatmap.py.
+        fig = Figure(figsize=(1.365 * .3, 1.411 * .3), dpi=100)
+        ax = fig.add_axes([0, 0, 1, 1])
+        plot_consensus_heatmap(mat, ax, fig, 'Blues', downsample, 0,
+                               order=order, check_input='full')
+        images.append(ax.get_images()[0].get_array())
+    np.testing.assert_allclose(images[1], images[0], atol=1e-12)
+
+
+def test_estimator_sparse_threshold():
+    X = np.concatenate([np.random.RandomState(0).normal(size=(20, 2)),
+                        np.random.RandomState(1).normal(size=(20, 2)) + 8])
+    params = dict(n_clusters=2, k_range=[2, 3], n_resamples=10,
+                  random_state=0)
+    dense = ConsensusCluster(**params).fit(X)
+    thresholded = ConsensusCluster(sparse_threshold=.2, **params).fit(X)
+    for k in (2, 3):
+        np.testing.assert_array_equal(thresholded.labels_by_k_[k],
+                                      dense.labels_by_k_[k])
+        expected = dense.consensus_matrices_[k]
+        expected = np.where(expected >= .2, expected, 0.0)
+        result = thresholded.consensus_matrices_[k]
+        assert scipy.sparse.isspmatrix_csr(result)
+        np.testing.assert_allclose(result.toarray(), expected)
+    assert thresholded.consensus_matrix_ is \
+        thresholded.consensus_matrices_[2]
+
+
+@pytest.mark.parametrize('sparse_threshold', [0, 1.5])
+def test_estimator_bad_sparse_threshold(sparse_threshold):
+    X = np.random.RandomState(0).normal(size=(20, 2))
+    with pytest.raises(ValueError, match='sparse_threshold'):
+        ConsensusCluster(n_resamples=2,
+                         sparse_threshold=sparse_threshold).fit(X)
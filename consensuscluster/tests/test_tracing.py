@@ -0,0 +1,97 @@
+"""Contains tests for the tracing module."""
+
+import pytest
+import numpy as np
+from matplotlib.figure import Figure
+
+from consensuscluster import ConsensusCluster
+from consensuscluster import tracing
+from consensuscluster.plotutils import plot_consensus_heatmap
+
+
+def _blobs():
+    rng = np.random.RandomState(0)
+    return np.concatenate([rng.normal(0, .1, size=(20, 2)),
+                           rng.normal(5, .1, size=(20, 2))])
+
+
+def test_disabled_by_default():
+    assert not tracing.enabled()
+    assert tracing.span('anything') is tracing._NULL_SPAN
+    # These must be harmless no-ops.
+    tracing.count('anything')
+    tracing.sample_memory('anything')
+
+
+def test_collect():
+    events = []
+    with tracing.collect(callback=events.append) as collector:
+        assert tracing.enabled()
+        for _ in range(3):
+            with tracing.span('work', size=5):
+                pass
+        tracing.count('items', 2)
+        tracing.count('items')
+        tracing.sample_memory('peak')
+    assert not tracing.enabled()
+
+    summary = collector.summary()
+    assert summary['spans']['work']['count'] == 3
+    assert summary['spans']['work']['total_seconds'] >= \
+        summary['spans']['work']['max_seconds'] >= 0
+    assert summary['counters'] == {'items': 3}
+    assert [e['type'] for e in events] == ['span'] * 3 + ['count'] * 2 + \
+        ['memory'] * ('peak' in summary['peak_rss_bytes'])
+    assert events[0]['name'] == 'work' and events[0]['size'] == 5
+
+
+def test_merge():
+    with tracing.collect() as first:
+        with tracing.span('a'):
+            pass
+        tracing.count('c', 4)
+    second = tracing.Collector()
+    second.merge(first.summary())
+    second.merge(first.summary())
+    summary = second.summary()
+    assert summary['spans']['a']['count'] == 2
+    assert summary['counters'] == {'c': 8}
+
+
+def test_span_records_on_exception():
+    with tracing.collect() as collector:
+        with pytest.raises(RuntimeError):
+            with tracing.span('failing'):
+                raise RuntimeError()
+    assert collector.summary()['spans']['failing']['count'] == 1
+
+
+@pytest.mark.parametrize('n_jobs,executor', [(None, 'process'),
+                                             (2, 'thread'),
+                                             (2, 'process')])
+def test_fit_is_traced(n_jobs, executor):
+    estimator = ConsensusCluster(n_resamples=6, k_range=[2, 3],
+                                 random_state=0, n_jobs=n_jobs,
+                                 executor=executor)
+    with tracing.collect() as collector:
+        estimator.fit(_blobs())
+    summary = collector.summary()
+    spans = summary['spans']
+    assert spans['resample']['count'] == 6
+    assert spans['cluster']['count'] == 12
+    assert summary['counters'] == {'resamples': 6, 'clusterer_fits': 12}
+    for name in ('fit', 'accumulate', 'consensus', 'linkage'):
+        assert name in spans
+
+
+def test_plot_is_traced():
+    rng = np.random.RandomState(0)
+    cmat = rng.uniform(size=(300, 300))
+    cmat = (cmat + cmat.T) / 2
+    fig = Figure(figsize=(1.365, 1.411), dpi=50)
+    ax = fig.add_axes([0, 0, 1, 1])
+    with tracing.collect() as collector:
+        plot_consensus_heatmap(cmat, ax, fig, 'Blues', True, 0)
+    spans = collector.summary()['spans']
+    assert spans['downsample']['count'] == 1
+    assert spans['imshow']['count'] == 1
@@ -0,0 +1,90 @@
+"""Contains tests for check_consensus_matrix."""
+
+import pytest
+import numpy as np
+from matplotlib.figure import Figure
+
+from consensuscluster import PackedSymmetricMatrix
+from consensuscluster import _validation
+from consensuscluster._validation import check_consensus_matrix
+from consensuscluster.plotutils import plot_consensus_heatmap
+
+
+def _cmat(n, seed=0):
+    rng = np.random.RandomState(seed)
+    cmat = rng.uniform(size=(n, n))
+    return (cmat + cmat.T) / 2
+
+
+@pytest.mark.parametrize('mode', ['none', 'sampled', 'full'])
+@pytest.mark.parametrize('n', [0, 1, 5, 100])
+def test_valid(mode, n, monkeypatch):
+    monkeypatch.setattr(_validation, '_TILE', 7)
+    cmat = _cmat(n)
+    check_consensus_matrix(cmat, mode)
+    check_consensus_matrix(PackedSymmetricMatrix.from_dense(cmat), mode)
+
+
+@pytest.mark.parametrize('corruption', ['range', 'nan', 'asymmetric'])
+def test_full_finds_single_bad_entry(corruption, monkeypatch):
+    # Use small tiles so that the bad entry isn't in the first one.
+    monkeypatch.setattr(_validation, '_TILE', 16)
+    cmat = _cmat(100)
+    if corruption == 'range':
+        cmat[70, 20] = cmat[20, 70] = 1.5
+    elif corruption == 'nan':
+        cmat[70, 20] = cmat[20, 70] = np.nan
+    else:
+        cmat[70, 20] += .01
+    with pytest.raises(ValueError):
+        check_consensus_matrix(cmat, 'full')
+    # Nothing but the type and shape is checked in 'none' mode.
+    check_consensus_matrix(cmat, 'none')
+
+
+def test_full_packed():
+    packed = PackedSymmetricMatrix.from_dense(_cmat(50))
+    packed.data[-3] = -.5
+    with pytest.raises(ValueError):
+        check_consensus_matrix(packed, 'full')
+
+
+@pytest.mark.parametrize('storage', ['dense', 'packed'])
+def test_sampled_finds_widespread_problems(storage):
+    # Counts rather than consensus values: wrong almost everywhere.
+    cmat = _cmat(300) * 10
+    if storage == 'packed':
+        cmat = PackedSymmetricMatrix.from_dense(cmat)
+    with pytest.raises(ValueError):
+        check_consensus_matrix(cmat, 'sampled', random_state=0)
+
+
+def test_sampled_finds_asymmetry():
+    rng = np.random.RandomState(0)
+    with pytest.raises(ValueError):
+        check_consensus_matrix(rng.uniform(size=(300, 300)), 'sampled',
+                               random_state=0)
+
+
+@pytest.mark.parametrize('bad', [np.zeros((3, 4)), np.zeros(5), [[1.0]]])
+def test_bad_shape_or_type(bad):
+    with pytest.raises(ValueError):
+        check_consensus_matrix(bad, 'none')
+
+
+def test_bad_mode():
+    with pytest.raises(ValueError):
+        check_consensus_matrix(np.eye(3), 'some')
+
+
+def test_plot_consensus_heatmap_check_input():
+    cmat = _cmat(50)
+    cmat[3, 4] = 2.0
+    fig = Figure(figsize=(1.365, 1.411), dpi=50)
+    ax = fig.add_axes([0, 0, 1, 1])
+    # Under pytest, the default is upgraded to 'full'.
+    with pytest.raises(ValueError):
+        plot_consensus_heatmap(cmat, ax, fig, 'Blues', True, 0)
+    with pytest.raises(ValueError):
+        plot_consensus_heatmap(_cmat(50), ax, fig, 'Blues', True, 0,
+                               order=np.zeros(50, dtype=int))
@@ -0,0 +1,271 @@
+"""Lightweight instrumentation: timed spans, counters and memory samples.
+
+The code in this package marks the interesting stages of its work
+(resampling, running the base clusterer, accumulating the counts,
+downsampling, imshow, ...) with named spans, and bumps counters as it
+goes. None of that is recorded unless a Collector is attached, and
+when none is, every hook returns after checking a single global, so
+the instrumentation can stay in the hot paths.
+
+The easiest way to use it is the collect context manager::
+
+    from consensuscluster import tracing
+
+    with tracing.collect() as collector:
+        ConsensusCluster(n_clusters=3).fit(X)
+    print(collector.summary())
+
+The summary is a plain dict (see Collector.summary), so it's easy to
+log or dump as JSON. To see events as they happen instead, give the
+Collector a callback, e.g. tracing.collect(callback=print).
+
+Work done by worker processes (n_jobs with executor='process') is
+recorded in the worker and merged into the attached collectors when
+the worker's results come back, so it shows up in the summary. The
+callback, however, only sees events from the main process.
+"""
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_collectors = []
+"""The attached collectors. Instrumentation is disabled when empty."""
+
+
+def enabled():
+    """Return whether any collector is attached."""
+    return bool(_collectors)
+
+
+def _peak_rss_bytes():
+    """Return the peak resident set size of this process, or None.
+
+    None is returned where it can't be measured (Windows).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else.
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+class Collector(object):
+    """Records the spans, counters and memory samples it is sent.
+
+    Attach it with add_collector (or use the collect context manager),
+    run some code, then call summary. It is safe to use from several
+    threads at once.
+
+    Parameters
+    ----------
+    callback : callable or None, default=None
+        If given, called with a dict describing every event as it is
+        recorded. Every event has the keys 'type' (one of 'span',
+        'count' or 'memory') and 'name'. Spans also have 'seconds' and
+        any extra fields given to span, counts have 'value', and memory
+        samples have 'peak_rss_bytes'.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._spans = {}
+        self._counters = {}
+        self._memory = {}
+
+    def _add_span(self, name, seconds, count=1, max_seconds=None):
+        if max_seconds is None:
+            max_seconds = seconds
+        with self._lock:
+            stats = self._spans.get(name)
+            if stats is None:
+                stats = self._spans[name] = {'count': 0,
+                                             'total_seconds': 0.0,
+                                             'max_seconds': 0.0}
+            stats['count'] += count
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], max_seconds)
+
+    def _add_count(self, name, value):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def _add_memory(self, name, peak):
+        with self._lock:
+            self._memory[name] = max(self._memory.get(name, 0), peak)
+
+    def _event(self, event):
+        if self.callback is not None:
+            self.callback(event)
+
+    def merge(self, summary):
+        """Add the contents of another collector's summary to this one.
+
+        Parameters
+        ----------
+        summary : dict
+            As returned by Collector.summary.
+        """
+        for (name, stats) in summary['spans'].items():
+            self._add_span(name, stats['total_seconds'], stats['count'],
+                           stats['max_seconds'])
+        for (name, value) in summary['counters'].items():
+            self._add_count(name, value)
+        for (name, peak) in summary['peak_rss_bytes'].items():
+            self._add_memory(name, peak)
+
+    def summary(self):
+        """Return everything recorded so far.
+
+        Returns
+        -------
+        dict
+            With three keys:
+
+            * 'spans' maps each span name to a dict with its 'count',
+              'total_seconds' and 'max_seconds'.
+            * 'counters' maps each counter name to its total.
+            * 'peak_rss_bytes' maps each memory sample name to the
+              largest peak RSS (of any process) seen when it was taken.
+        """
+        with self._lock:
+            return {
+                'spans': dict((name, dict(stats))
+                              for (name, stats) in self._spans.items()),
+                'counters': dict(self._counters),
+                'peak_rss_bytes': dict(self._memory),
+            }
+
+
+def add_collector(collector):
+    """Start sending instrumentation to collector."""
+    _collectors.append(collector)
+
+
+def remove_collector(collector):
+    """Stop sending instrumentation to collector."""
+    _collectors.remove(collector)
+
+
+@contextmanager
+def collect(callback=None):
+    """Attach a new Collector for the duration of a with block.
+
+    Parameters
+    ----------
+    callback : callable or None, default=None
+        Passed on to Collector.
+
+    Yields
+    ------
+    Collector
+    """
+    collector = Collector(callback)
+    add_collector(collector)
+    try:
+        yield collector
+    finally:
+        remove_collector(collector)
+
+
+class _NullSpan(object):
+    """What span returns when instrumentation is disabled."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self._start
+        event = None
+        for collector in list(_collectors):
+            collector._add_span(self.name, seconds)
+            if collector.callback is not None:
+                if event is None:
+                    event = dict(self.fields, type='span', name=self.name,
+                                 seconds=seconds)
+                collector._event(event)
+        return False
+
+
+def span(name, **fields):
+    """Time a block of code.
+
+    Use it as a context manager::
+
+        with tracing.span('cluster', k=k):
+            ...
+
+    Parameters
+    ----------
+    name : str
+        The name under which the time is recorded.
+
+    **fields
+        Extra information passed on to the collectors' callbacks (but
+        not kept in the summary).
+    """
+    if not _collectors:
+        return _NULL_SPAN
+    return _Span(name, fields)
+
+
+def count(name, value=1):
+    """Add value to the counter called name."""
+    if not _collectors:
+        return
+    for collector in list(_collectors):
+        collector._add_count(name, value)
+        collector._event({'type': 'count', 'name': name, 'value': value})
+
+
+def sample_memory(name):
+    """Record the current peak memory of the process under name."""
+    if not _collectors:
+        return
+    peak = _peak_rss_bytes()
+    if peak is None:
+        return
+    for collector in list(_collectors):
+        collector._add_memory(name, peak)
+        collector._event({'type': 'memory', 'name': name,
+                          'peak_rss_bytes': peak})
+
+
+def merge(summary):
+    """Merge a summary recorded elsewhere into every attached collector."""
+    for collector in list(_collectors):
+        collector.merge(summary)
+
+
+def _run_collected(func, *args, **kwargs):
+    """Call func under a fresh collector; return its result and summary.
+
+    This is what worker processes run when instrumentation is enabled
+    in the main process, since the collectors attached there don't
+    exist in the worker.
+    """
+    with collect() as collector:
+        result = func(*args, **kwargs)
+    return result, collector.summary()
@@ -21,7 +21,7 @@ URL = 'https://github.com/vicramr/consensuscluster'
 LICENSE = 'BSD-3-Clause'
 DOWNLOAD_URL = 'https://github.com/vicramr/consensuscluster'
 VERSION = __version__
-INSTALL_REQUIRES = ['numpy', 'scipy', 'scikit-learn', 'scikit-image']
+INSTALL_REQUIRES = ['numpy', 'scipy>=1.2', 'scikit-learn']
 CLASSIFIERS = ['Intended Audience :: Science/Research',
                'Intended Audience :: Developers',
                'License :: OSI Approved',